@@ -8,15 +8,11 @@ import os
 
 sys.path.insert(0, '../')
 from client_cmdmanager import *
+from tree_walker import dir_size
 
 
 def get_dir_size(start_path = '.'):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
+    return dir_size(start_path)
 
 def load_config():
     with open('../config.json', 'r') as config_file:
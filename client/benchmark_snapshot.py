@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Memory of the whole DirSnapshotManager on a synthetic directory: the
+SnapshotTree that is merkle tree, { md5: [path] } index and md5 cache at
+once, against the three separate structures it replaces (a dictionary of
+lists, a MerkleTree and a { abs_path: (stat, md5) } cache).
+
+    python benchmark_snapshot.py --files 100000
+
+Every layout is loaded in its own process: the size is the sum of
+sys.getsizeof of every object reachable from it, each object counted once,
+and the RSS is the growth of the process while it's loaded. The read time
+is a lookup of the paths of every md5, as the synchronization does.
+"""
+
+import subprocess
+import argparse
+import tempfile
+import hashlib
+import shutil
+import types
+import json
+import time
+import sys
+import os
+
+import client_daemon
+from client_daemon import DirSnapshotManager
+from merkle_tree import MerkleTree
+
+
+def synthetic_tree(root, files, files_per_dir, duplicates):
+    """ write the files, one file out of duplicates is a copy of another """
+    for i in xrange(files):
+        dir_id = i // files_per_dir
+        dir_path = os.path.join(
+            root, "projects", "project_{}".format(dir_id // 50), "src", "module_{}".format(dir_id))
+        if i % files_per_dir == 0:
+            os.makedirs(dir_path)
+        content_id = i - 1 if duplicates and i % duplicates == 0 else i
+        with open(os.path.join(dir_path, "file_{}.py".format(i)), "w") as f:
+            f.write(str(content_id))
+
+
+def deep_size(obj):
+    seen = set()
+    to_visit = [obj]
+    size = 0
+    while to_visit:
+        obj = to_visit.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            to_visit.extend(obj.keys())
+            to_visit.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            to_visit.extend(obj)
+        if hasattr(obj, "__dict__"):
+            to_visit.append(obj.__dict__)
+        if hasattr(obj, "__slots__"):
+            to_visit.extend(getattr(obj, name) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def load_manager(root, snapshot_file):
+    """ the daemon: one SnapshotTree """
+    client_daemon.CONFIG_DIR_PATH = root
+    manager = DirSnapshotManager(snapshot_file)
+    return manager, manager.local_full_snapshot
+
+
+def load_separate(root, snapshot_file):
+    """ the layout before SnapshotTree: index, tree and md5 cache apart """
+    snapshot = {}
+    md5_cache = {}
+    for dir_path, _, names in os.walk(root):
+        for name in names:
+            abs_path = os.path.join(dir_path, name)
+            stat = os.stat(abs_path)
+            with open(abs_path, "rb") as f:
+                file_md5 = hashlib.md5(f.read()).hexdigest()
+            md5_cache[abs_path] = ((stat.st_size, stat.st_mtime, stat.st_ino), file_md5)
+            snapshot.setdefault(file_md5, []).append(abs_path[len(root) + 1:])
+    tree = MerkleTree.from_snapshot(snapshot)
+    return (snapshot, tree, md5_cache), snapshot
+
+
+def measure(layout, root, snapshot_file):
+    load = {"DirSnapshotManager": load_manager, "separate": load_separate}[layout]
+    start_rss = rss()
+    start = time.time()
+    loaded, snapshot = load(root, snapshot_file)
+    load_time = time.time() - start
+    rss_growth = rss() - start_rss
+    start = time.time()
+    for file_md5 in snapshot:
+        snapshot[file_md5][0]
+    read_time = time.time() - start
+    return deep_size(loaded), rss_growth, load_time, read_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--files-per-dir", type=int, default=100)
+    parser.add_argument("--duplicates", type=int, default=10,
+                        help="one file out of DUPLICATES is a copy (0 for none)")
+    # the measure of a single layout, in the process started by main
+    parser.add_argument("--layout", help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.layout:
+        snapshot_file = os.path.join(args.root, os.pardir, "snapshot_file.json")
+        print json.dumps(measure(args.layout, args.root, snapshot_file))
+        return
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(work_dir, "share")
+        synthetic_tree(root, args.files, args.files_per_dir, args.duplicates)
+        with open(os.path.join(work_dir, "snapshot_file.json"), "w") as f:
+            json.dump({"timestamp": 0, "snapshot": ""}, f)
+        results = {}
+        for layout in ("separate", "DirSnapshotManager"):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), "--layout", layout, "--root", root])
+            size, rss_growth, load_time, read_time = results[layout] = json.loads(output)
+            print "{:<18} {:>7.1f} MB {:>6.1f} bytes/file  RSS +{:.1f} MB  load {:.2f}s  read {:.3f}s".format(
+                layout, size / 2.0 ** 20, float(size) / args.files, rss_growth / 2.0 ** 20,
+                load_time, read_time)
+    finally:
+        shutil.rmtree(work_dir)
+    print "DirSnapshotManager uses {:.0%} of the memory".format(
+        float(results["DirSnapshotManager"][0]) / results["separate"][0])
+
+
+if __name__ == "__main__":
+    main()
@@ -116,6 +116,16 @@ class RawBoxExecuter(object):
             self.comm_sock.send_message(command_type, param)
             self.print_response(self.comm_sock.read_message())
 
+    def _status(self):
+        """ show what the daemon is doing """
+        self.comm_sock.send_message('status', {})
+        self.print_response(self.comm_sock.read_message())
+
+    def _set_limits(self, limits):
+        """ change the bandwidth limits of the daemon, {} only shows them """
+        self.comm_sock.send_message('set_limits', limits)
+        self.print_response(self.comm_sock.read_message())
+
     def print_response(self, response):
         ''' print response from the daemon.
             the response is a dictionary as:
@@ -196,6 +206,26 @@ class RawBoxCmd(cmd.Cmd):
         else:
             Message('INFO', self.do_delete.__doc__)
 
+    def do_status(self, line=None):
+        """
+        show the synchronization status of the daemon
+        """
+        self.executer._status()
+
+    def do_limit(self, line):
+        """
+        show or change the bandwidth limits of the daemon in KB/s, 0 for no limit
+        limit [upload=<KB/s>] [download=<KB/s>]
+        """
+        limits = {}
+        for arg in line.split():
+            direction, _, value = arg.partition("=")
+            if direction not in ("upload", "download") or not value:
+                self.error("error, use upload=<KB/s> and download=<KB/s>")
+                return
+            limits[direction] = value
+        self.executer._set_limits(limits)
+
     def do_q(self, line=None):
         """ exit from RawBox"""
         if take_input('[Exit] are you sure? y/n ') == 'y':
@@ -2,36 +2,166 @@
 #-*- coding: utf-8 -*-
 
 
-# inotify observer unable to detect 'dragging file to trash' events
-# from https://github.com/gorakhargosh/watchdog/issues/46 use polling solution
+# watchdog inotify observer unable to detect 'dragging file to trash' events
+# from https://github.com/gorakhargosh/watchdog/issues/46 our InotifyObserver
+# pairs the moves itself, polling is left for systems without inotify
 
-# from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver as Observer
+from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
 from requests.auth import HTTPBasicAuth
 import ConfigParser
 import requests
+import collections
+import contextlib
+import threading
+import email.utils
 import argparse
 import hashlib
+import random
+import struct
+import mmap
+import urllib
+import uuid
 import logging
+import tempfile
 import shutil
 import time
 import json
+import zlib
+import sys
 import os
-
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# modules shared with the server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from compression import compressible, UNCOMPRESSED_SIZE_HEADER
 from communication_system import CmdMessageServer
+from inotify_observer import InotifyObserver, TreeRescanEvent, inotify_available
+from path_filters import IgnoreRules, SelectiveSync, IGNORE_FILE
+from tree_walker import TreeWalker
+from snapshot_index import SnapshotTree
+from snapshot_index import Md5Index
+from snapshot_index import pack_stat
+from snapshot_index import unpack_stat
 import asyncore
 
 SERVER_URL = "localhost"
 SERVER_PORT = "5000"
 API_PREFIX = "API/v1"
+READ_BLOCK_SIZE = 64 * 1024
+DOWNLOAD_PREFIX = ".rawbox-"
+DOWNLOAD_SUFFIX = ".part"
 CONFIG_DIR_PATH = ""
 FILE_CONFIG = "config.ini"
+WATCHER = "auto"
+SETTLE_WINDOW = "2"
+OUTBOX_FILE_PATH = "outbox.jsonl"
+# seconds between the attempts to reach the server with queued changes
+OUTBOX_RETRY_DELAY = 10
+# failed attempts of a request before giving up when the daemon is running
+MAX_RETRIES = 2
+# seconds, the retry delay doubles at each failure up to the max
+RETRY_BASE_DELAY = "1"
+RETRY_MAX_DELAY = "60"
+# seconds between the synchronizations, doubled while nothing changes
+SYNC_MIN_INTERVAL = "5"
+SYNC_MAX_INTERVAL = "300"
+# subtrees excluded from the sync and included again inside them, one per line
+SYNC_EXCLUDE = ""
+SYNC_INCLUDE = ""
+# KB/s of the transfers in each direction, 0 for no limit
+UPLOAD_LIMIT = "0"
+DOWNLOAD_LIMIT = "0"
+# contents deleted or overwritten by the sync kept to avoid downloading them
+# again, MB (0 to disable); it must be on the filesystem of the sync root,
+# a relative path is in the directory of the snapshot file
+BLOB_CACHE_PATH = "blob_cache"
+BLOB_CACHE_SIZE = "512"
+# transfers up to this size go before the bigger ones waiting on a limit
+SMALL_TRANSFER_SIZE = 1024 * 1024
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# zlib level of the compressed uploads, 1 is the fastest
+COMPRESS_LEVEL = 1
+# a compressed upload is sent only if it's smaller by at least this fraction
+COMPRESS_MIN_SAVING = 0.1
+# bytes of a delta or manifest body kept in memory before spilling on disk
+COMPRESS_SPOOL_SIZE = 1024 * 1024
+# bytes compressed to decide whether an upload is worth compressing
+COMPRESS_SAMPLE_SIZE = 256 * 1024
+# modified files from this size are sent as rsync deltas of the server version
+DELTA_MIN_SIZE = 1024 * 1024
+# the delta is abandoned for a full upload once more than this fraction of
+# the file is new
+DELTA_MAX_LITERAL = 0.5
+# operations of an rsync delta: "C" + offset, length in the server version
+# of the file and "L" + length followed by the literal bytes
+DELTA_COPY = struct.Struct(">QI")
+DELTA_LITERAL = struct.Struct(">I")
+ADLER_MOD = 65521
+# files from this size are uploaded by content-defined chunks, only the
+# chunks the server lacks are sent (also when they come from other files)
+CHUNKED_MIN_SIZE = 4 * 1024 * 1024
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+# a chunk ends after CHUNK_WINDOW bytes whose digits (a fixed random base 4
+# digit for each byte value, the same on every client) spell CHUNK_ANCHOR,
+# about every 64KB: the cuts depend only on the content around them and
+# move with it. The digits are a str.translate of the data and the anchor
+# a str.find, both in C
+CHUNK_WINDOW = 8
+CHUNK_DIGITS = "".join(str(int(hashlib.md5(str(i)).hexdigest(), 16) & 3) for i in xrange(256))
+CHUNK_ANCHOR = "33022211"
+# bytes translated at a time, most chunks end long before CHUNK_MAX_SIZE
+CHUNK_SCAN_SIZE = 32 * 1024
+# ioctl sharing the blocks of a file with another one (btrfs, xfs)
+FICLONE = 0x40049409
+# answers of an overloaded server, the request is retried
+RETRY_STATUS_CODES = (429, 503)
+# the full snapshot is streamed by the server a file per line, sorted by path,
+# and compared with the local tree in batches of SYNC_BATCH_SIZE different files
+NDJSON_MIMETYPE = "application/x-ndjson"
+SYNC_BATCH_SIZE = 5000
+# seconds an event expected on a path written by the daemon is waited for
+IGNORE_TTL = 5
+# seconds between two saves of the md5 cache, it's saved also at shutdown
+MD5_CACHE_SAVE_INTERVAL = 60
+EVENT_KINDS = ("created", "modified", "deleted", "moved")
 
 logger = logging.getLogger('RawBox')
 logger.setLevel(logging.DEBUG)
 
 
+def is_download_file(path):
+    """ check if path is a temporary file of a download in progress """
+    name = os.path.basename(path)
+    return name.startswith(DOWNLOAD_PREFIX) and name.endswith(DOWNLOAD_SUFFIX)
+
+
+def reflink(src_file, dst_file):
+    """
+    make dst_file a copy on write clone of src_file, return False if the
+    filesystem (or the os) doesn't support it
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def default_file_mode():
+    """ mode of a new file: 0666 less the umask of the process """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
 def get_relpath(abs_path):
     """form absolute path return relative path """
     if abs_path.startswith(CONFIG_DIR_PATH):
@@ -46,15 +176,521 @@ def get_abspath(rel_path):
     return rel_path
 
 
+def weak_checksum(block):
+    """ adler32 of a block, the checksum rolled by rsync_delta """
+    return zlib.adler32(block) & 0xffffffff
+
+
+def rsync_delta(file_object, signatures, out):
+    """
+    write in out the rsync delta of file_object against the server version
+    described by signatures (see Files._signatures in the server) and
+    return the md5 of the file, or None if a full upload is cheaper.
+    The blocks are looked up at the current offset first, hashing them
+    with zlib; the checksum is rolled byte by byte only after a mismatch
+    to find again the alignment (e.g. after an insertion), for at most a block.
+    """
+    block_size = signatures["block_size"]
+    table = {}
+    for index, (weak, strong) in enumerate(signatures["blocks"]):
+        table.setdefault(weak, []).append((strong, index))
+    size = os.fstat(file_object.fileno()).st_size
+    if not size:
+        return None
+    data = mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def find(start, length, weak):
+        window = data[start:start + length]
+        for strong, index in table.get(weak, ()):
+            if hashlib.md5(window).hexdigest() == strong:
+                return index
+        return None
+
+    copy = [0, 0]  # offset, length of the copy to write, merged while contiguous
+    state = {"literal": 0}
+
+    def write_copy():
+        if copy[1]:
+            out.write("C" + DELTA_COPY.pack(copy[0], copy[1]))
+            copy[1] = 0
+
+    def write_literal(start, end):
+        if start >= end:
+            return
+        write_copy()
+        state["literal"] += end - start
+        while start < end:
+            length = min(end - start, COMPRESS_SPOOL_SIZE)
+            out.write("L" + DELTA_LITERAL.pack(length))
+            out.write(data[start:start + length])
+            start += length
+
+    def add_copy(index, length):
+        offset = index * block_size
+        if copy[1] and copy[0] + copy[1] == offset:
+            copy[1] += length
+        else:
+            write_copy()
+            copy[0], copy[1] = offset, length
+
+    try:
+        position = literal_start = 0
+        while position + block_size <= size:
+            weak = weak_checksum(data[position:position + block_size])
+            index = find(position, block_size, weak)
+            if index is not None:
+                write_literal(literal_start, position)
+                add_copy(index, block_size)
+                position = literal_start = position + block_size
+                continue
+            a, b = weak & 0xffff, weak >> 16
+            start, end = position, min(position + block_size, size - block_size)
+            while position < end:
+                out_byte, in_byte = ord(data[position]), ord(data[position + block_size])
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                position += 1
+                weak = b << 16 | a
+                if weak in table and find(position, block_size, weak) is not None:
+                    break
+            else:
+                position = start + block_size
+            literal = state["literal"] + position - literal_start
+            if literal > DELTA_MAX_LITERAL * size:
+                return None
+        if literal_start < size:
+            # the last block of the server version can be shorter
+            tail = size - position
+            index = find(position, tail, weak_checksum(data[position:])) if tail > 0 else None
+            if index is not None:
+                write_literal(literal_start, position)
+                add_copy(index, tail)
+            else:
+                write_literal(literal_start, size)
+        write_copy()
+        if state["literal"] > DELTA_MAX_LITERAL * size:
+            return None
+        file_md5 = hashlib.md5()
+        for offset in xrange(0, size, READ_BLOCK_SIZE):
+            file_md5.update(data[offset:offset + READ_BLOCK_SIZE])
+        return file_md5.hexdigest()
+    finally:
+        data.close()
+
+
+def chunk_cut(data, start, end):
+    """
+    end of the chunk starting at start: the first position from
+    start + CHUNK_MIN_SIZE where the anchor matches, else end
+    """
+    # the anchor depends only on the last CHUNK_WINDOW bytes, the ones
+    # before the minimum size aren't translated
+    begin = start + CHUNK_MIN_SIZE - CHUNK_WINDOW
+    if begin + CHUNK_WINDOW >= end:
+        return end
+    while True:
+        block_end = min(begin + CHUNK_SCAN_SIZE, end)
+        position = data[begin:block_end].translate(CHUNK_DIGITS).find(CHUNK_ANCHOR)
+        if position >= 0:
+            return begin + position + CHUNK_WINDOW
+        if block_end == end:
+            return end
+        # the next block repeats the last bytes, for the anchors across the two
+        begin = block_end - CHUNK_WINDOW + 1
+
+
+def chunk_file(file_object):
+    """
+    md5 of the file and list of its content-defined chunks as
+    (md5, offset, length)
+    """
+    size = os.fstat(file_object.fileno()).st_size
+    if not size:
+        return hashlib.md5().hexdigest(), []
+    data = mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        file_md5 = hashlib.md5()
+        chunks = []
+        start = 0
+        while start < size:
+            cut = chunk_cut(data, start, min(start + CHUNK_MAX_SIZE, size))
+            chunk = data[start:cut]
+            file_md5.update(chunk)
+            chunks.append((hashlib.md5(chunk).hexdigest(), start, cut - start))
+            start = cut
+        return file_md5.hexdigest(), chunks
+    finally:
+        data.close()
+
+
+class FileRanges(object):
+    """
+    file object reading the (offset, length) ranges of a file one after
+    the other, as if they were a file
+    """
+
+    def __init__(self, file_object, ranges):
+        self.file_object = file_object
+        self.name = file_object.name
+        self.all_ranges = list(ranges)
+        self.ranges = collections.deque(self.all_ranges)
+        self.left = 0
+
+    def seek(self, offset):
+        """ back to the start of the first range, the only offset supported """
+        if offset:
+            raise IOError("FileRanges can only seek to 0")
+        self.ranges = collections.deque(self.all_ranges)
+        self.left = 0
+
+    def read(self, size):
+        while not self.left and self.ranges:
+            offset, self.left = self.ranges.popleft()
+            self.file_object.seek(offset)
+        block = self.file_object.read(min(size, self.left))
+        self.left -= len(block)
+        return block
+
+    def close(self):
+        self.file_object.close()
+
+
+class MultipartFileStream(object):
+    """
+    multipart/form-data body of an upload read from disk block by block,
+    the file is hashed while it's sent and the md5 field follows it
+    (file_md5 skips the hashing when the md5 is already known,
+    throttle(size) is called before each block is sent);
+    with encoding "gzip" the file is compressed while it's sent and a
+    file_encoding field tells it to the server, along with its size
+    (file_size) to decode it, the md5 is still the one of the file (the
+    same fields go with the other encodings); the size of a compressed
+    body is unknown, len is None and requests sends it chunked;
+    with the block signatures of the server version only an rsync delta
+    is sent, along with the base_md5 it applies to; with the chunks of the
+    file (already on the server) only their list is sent; with chunk_data
+    the body is made of those chunks only, for the chunk store, gzipped
+    as a file
+    """
+
+    def __init__(self, abs_path, file_md5=None, throttle=None, encoding=None,
+                 signatures=None, chunks=None, chunk_data=None):
+        self.file_object = open(abs_path, 'rb')
+        self.throttle = throttle
+        self.file_md5 = file_md5
+        self.encoding = None
+        self.compressor = None
+        self.fields = []
+        self.file_size = os.fstat(self.file_object.fileno()).st_size
+        if chunk_data:
+            self._chunk_data(chunk_data)
+        elif chunks:
+            self._manifest(chunks)
+        elif signatures:
+            self._delta(signatures)
+        if encoding == "gzip" and self.encoding is None:
+            self._compress()
+        self.hasher = hashlib.md5() if self.file_md5 is None else None
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+        self.head = (
+            "--{}\r\n"
+            "Content-Disposition: form-data; name=\"file_content\"; filename=\"{}\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).format(self.boundary, urllib.quote(os.path.basename(abs_path)))
+        if self.compressor:
+            self.len = None
+        else:
+            self.len = len(self.head) + self.file_size + len(self._tail("0" * 32))
+        self.buffer = self.head
+        self.to_read = self.file_size
+
+    def _compress(self):
+        """
+        gzip the file while it's sent if its first COMPRESS_SAMPLE_SIZE
+        bytes save at least COMPRESS_MIN_SAVING of them
+        """
+        sample = self.file_object.read(COMPRESS_SAMPLE_SIZE)
+        self.file_object.seek(0)
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = len(compressor.compress(sample)) + len(compressor.flush())
+        if compressed > len(sample) * (1 - COMPRESS_MIN_SAVING):
+            return
+        self.fields.append(("file_size", self.file_size))
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.encoding = "gzip"
+
+    def _manifest(self, chunks):
+        """
+        replace the body with the md5 of the chunks, one per line
+        (file_md5 must be the one of the file)
+        """
+        manifest = tempfile.SpooledTemporaryFile(COMPRESS_SPOOL_SIZE)
+        for chunk_md5, _, _ in chunks:
+            manifest.write(chunk_md5 + "\n")
+        self.fields.append(("file_size", self.file_size))
+        self.file_size = manifest.tell()
+        self.file_object.close()
+        manifest.seek(0)
+        self.file_object = manifest
+        self.encoding = "chunks"
+
+    def _chunk_data(self, chunks):
+        """
+        replace the body with the given chunks of the file, one after the
+        other, each listed as <md5>:<length> in a chunks field
+        """
+        self.file_object = FileRanges(
+            self.file_object, [(offset, length) for _, offset, length in chunks])
+        self.file_size = sum(length for _, _, length in chunks)
+        self.fields.extend(
+            ("chunks", "{}:{}".format(chunk_md5, length))
+            for chunk_md5, _, length in chunks
+        )
+
+    def _delta(self, signatures):
+        """
+        replace the body with the rsync delta of the file, if it's worth it
+        """
+        delta = tempfile.SpooledTemporaryFile(COMPRESS_SPOOL_SIZE)
+        file_md5 = rsync_delta(self.file_object, signatures, delta)
+        if file_md5 is None:
+            delta.close()
+            return
+        self.file_md5 = file_md5
+        self.fields.append(("file_size", self.file_size))
+        self.file_size = delta.tell()
+        self.file_object.close()
+        delta.seek(0)
+        self.file_object = delta
+        self.encoding = "rsync-delta"
+        self.fields.append(("base_md5", signatures["md5"]))
+
+    def _tail(self, file_md5):
+        fields = list(self.fields)
+        if self.encoding:
+            fields.insert(0, ("file_encoding", self.encoding))
+        fields.append(("file_md5", file_md5))
+        return "".join(
+            (
+                "\r\n--{0}\r\n"
+                "Content-Disposition: form-data; name=\"{1}\"\r\n\r\n"
+                "{2}"
+            ).format(self.boundary, name, value)
+            for name, value in fields
+        ) + "\r\n--{}--\r\n".format(self.boundary)
+
+    def _fill(self):
+        # the compressor can keep a whole block for itself
+        while not self.buffer and self.file_object:
+            if self.to_read:
+                block = self.file_object.read(min(READ_BLOCK_SIZE, self.to_read))
+                if not block:
+                    # the file shrank: abort the request rather than send bytes
+                    # that were never read, its modify event uploads it again
+                    raise IOError("{} changed while uploading".format(self.file_object.name))
+                self.to_read -= len(block)
+                if self.hasher:
+                    self.hasher.update(block)
+                if self.compressor:
+                    block = self.compressor.compress(block)
+                    if not self.to_read:
+                        block += self.compressor.flush()
+                if self.throttle and block:
+                    self.throttle(len(block))
+                self.buffer = block
+            else:
+                self.close()
+                self.buffer = self._tail(self.hexdigest())
+
+    def read(self, size=-1):
+        chunks = []
+        while size < 0 or size > 0:
+            if not self.buffer:
+                self._fill()
+                if not self.buffer:
+                    break
+            chunk = self.buffer if size < 0 else self.buffer[:size]
+            self.buffer = self.buffer[len(chunk):]
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return "".join(chunks)
+
+    def __iter__(self):
+        block = self.read(READ_BLOCK_SIZE)
+        while block:
+            yield block
+            block = self.read(READ_BLOCK_SIZE)
+
+    def hexdigest(self):
+        if self.file_md5 is None:
+            self.file_md5 = self.hasher.hexdigest()
+        return self.file_md5
+
+    def close(self):
+        if self.file_object:
+            self.file_object.close()
+            self.file_object = None
+
+
+class TokenBucket(object):
+    """
+    bandwidth limit of the transfers in a direction: every block waits for
+    as many tokens as its bytes and the tokens come back at rate bytes per
+    second, up to burst (rate 0 means no limit). A block bigger than the
+    tokens left borrows them, the next ones wait for the debt to be paid.
+    The blocks of the PRIORITY_INTERACTIVE transfers go before the
+    PRIORITY_BULK ones waiting on the same bucket.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Condition(threading.Lock())
+        # transfers waiting for tokens, by priority
+        self.waiting = [0, 0]
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """ change the limit, also while transfers are waiting """
+        with self.lock:
+            self.rate = rate
+            self.burst = burst or max(rate, READ_BLOCK_SIZE)
+            self.tokens = self.burst
+            self.updated = time.time()
+            self.lock.notify_all()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount, priority=PRIORITY_BULK):
+        """ wait until amount bytes can be transferred """
+        with self.lock:
+            self.waiting[priority] += 1
+            try:
+                while self.rate:
+                    self._refill(time.time())
+                    if not any(self.waiting[:priority]) and self.tokens > 0:
+                        self.tokens -= amount
+                        return
+                    # woken up earlier by set_rate and by the other transfers
+                    self.lock.wait(max(-self.tokens / self.rate, 0.01))
+            finally:
+                self.waiting[priority] -= 1
+                self.lock.notify_all()
+
+
+def transfer_priority(size):
+    """ priority class of a transfer of size bytes """
+    if size is not None and size <= SMALL_TRANSFER_SIZE:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BULK
+
+
+class ServerUnreachable(Exception):
+    """ a request failed more than max_retries times or its endpoint is known down """
+    pass
+
+
+def parse_retry_after(value):
+    """ seconds to wait from a Retry-After header (delta seconds or HTTP date) """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class CircuitBreaker(object):
+    """
+    state of an endpoint: after failure_threshold consecutive failures it's
+    open and requests fail fast until a jittered open time has elapsed, then
+    a single probe request decides if it's closed again or open for twice
+    the time (up to max_open_time)
+    """
+
+    def __init__(self, failure_threshold=3, open_time=5, max_open_time=300):
+        self.failure_threshold = failure_threshold
+        self.base_open_time = open_time
+        self.max_open_time = max_open_time
+        self.open_time = open_time
+        self.failures = 0
+        self.state = "closed"
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def wait_time(self, now):
+        """ 0 if a request can be sent, else the seconds to wait """
+        with self.lock:
+            if self.state == "closed":
+                return 0
+            if self.state == "open" and now >= self.retry_at:
+                self.state = "half-open"
+                return 0
+            if self.state == "half-open":
+                return 1.0  # another request is probing the endpoint
+            return self.retry_at - now
+
+    def success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.open_time = self.base_open_time
+
+    def failure(self, now, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half-open":
+                self.open_time = min(self.open_time * 2, self.max_open_time)
+            elif self.failures < self.failure_threshold and retry_after is None:
+                return
+            self.state = "open"
+            # full jitter, the clients don't come back all together
+            delay = random.uniform(0, self.open_time)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self.retry_at = now + delay
+
+    def abandon(self, now):
+        """ a probe ended without an answer from the server """
+        with self.lock:
+            if self.state == "half-open":
+                self.state = "open"
+                self.retry_at = now
+
+
 class ServerCommunicator(object):
 
-    def __init__(self, server_url, username, password, snapshot_manager):
+    def __init__(self, server_url, username, password, snapshot_manager, max_retries=None,
+                 retry_base_delay=float(RETRY_BASE_DELAY), retry_max_delay=float(RETRY_MAX_DELAY),
+                 upload_limit=float(UPLOAD_LIMIT), download_limit=float(DOWNLOAD_LIMIT)):
         if username and password:
             self.auth = HTTPBasicAuth(username, password)
         else:
             self.auth = None
         self.server_url = server_url
         self.snapshot_manager = snapshot_manager
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.breakers = {}
+        # seconds between the synchronizations suggested by the server
+        self.poll_interval = None
+        # compression of the uploads, once the server says it accepts it
+        self.upload_encoding = None
+        # modified files sent as rsync deltas, once the server accepts them
+        self.delta_uploads = False
+        # big files sent by chunks, once the server has a chunk store
+        self.chunked_uploads = False
+        # limits in KB/s, shared by the outbox and the synchronization
+        self.upload_bucket = TokenBucket(upload_limit * 1024)
+        self.download_bucket = TokenBucket(download_limit * 1024)
+        # the snapshot is updated by the two threads of the outbox
+        self.snapshot_lock = threading.RLock()
         self.msg = {
             "result": "",
             "details": []
@@ -75,45 +711,259 @@ class ServerCommunicator(object):
     def setExecuter(self, executer):
         self.executer = executer
 
-    def _try_request(self, callback, success='', error='', retry_delay=2, *args, **kwargs):
-        """ try a request until it's a success """
+    def set_limits(self, param):
+        """
+        change the bandwidth limits while the daemon runs,
+        param = {"upload": <KB/s>, "download": <KB/s>}, 0 for no limit
+        """
+        buckets = (("upload", self.upload_bucket), ("download", self.download_bucket))
+        limits = []
+        # both checked before changing either
+        for direction, bucket in buckets:
+            if direction not in param:
+                continue
+            try:
+                limit = float(param[direction])
+            except (TypeError, ValueError):
+                limit = -1
+            if limit < 0:
+                return {"result": "error", "details": ["invalid {} limit".format(direction)]}
+            limits.append((bucket, limit))
+        for bucket, limit in limits:
+            bucket.set_rate(limit * 1024)
+        details = []
+        for direction, bucket in buckets:
+            if bucket.rate:
+                details.append("{}: {:g} KB/s".format(direction, bucket.rate / 1024))
+            else:
+                details.append("{}: no limit".format(direction))
+        return {"result": "ok", "details": details}
+
+    def _breaker(self, url):
+        """ the circuit breaker of the endpoint (files, actions, tree...) of url """
+        endpoint = url[len(self.server_url):].lstrip("/").split("/")[0]
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker()
+        return self.breakers[endpoint]
+
+    def _backoff(self, failures, retry_delay):
+        """ exponential backoff with full jitter """
+        return random.uniform(0, min(self.retry_max_delay, retry_delay * 2 ** (failures - 1)))
+
+    def _try_request(self, callback, success='', error='', retry_delay=None, *args, **kwargs):
+        """
+        try a request until it's a success, waiting an exponential backoff
+        (or the Retry-After of a 503/429 answer) between the attempts;
+        with max_retries set raise ServerUnreachable after max_retries retries
+        or at once if the endpoint circuit breaker is open
+        """
+        if retry_delay is None:
+            retry_delay = self.retry_base_delay
+        breaker = self._breaker(kwargs.get("url", ""))
+        failures = 0
         while True:
+            wait = breaker.wait_time(time.time())
+            if wait > 0:
+                if self.max_retries is not None:
+                    raise ServerUnreachable(error)
+                time.sleep(wait)
+                continue
+            retry_after = None
             try:
                 request_result = callback(
                     auth=self.auth,
                     *args, **kwargs)
-                if request_result.status_code == 401:
-                    logger.error("user not logged")
-                else:
-                    logger.info(success)
-                return request_result
             except requests.exceptions.RequestException:
-                time.sleep(retry_delay)
                 logger.warning(error)
+            except BaseException:
+                breaker.abandon(time.time())
+                raise
+            else:
+                if request_result.status_code not in RETRY_STATUS_CODES:
+                    breaker.success()
+                    if request_result.status_code == 401:
+                        logger.error("user not logged")
+                    else:
+                        logger.info(success)
+                    return request_result
+                retry_after = parse_retry_after(request_result.headers.get("Retry-After"))
+                logger.warning("{} (server busy)".format(error))
+            breaker.failure(time.time(), retry_after)
+            failures += 1
+            if self.max_retries is not None and failures > self.max_retries:
+                raise ServerUnreachable(error)
+            if retry_after is None:
+                retry_after = self._backoff(failures, retry_delay)
+            time.sleep(retry_after)
 
     def synchronize(self, operation_handler):
-        """Synchronize client and server"""
-
-        server_url = "{}/files/".format(self.server_url)
+        """
+        Synchronize client and server
+            compare the root hash of the server merkle tree with the local one
+            and exchange only the directories whose hash differs; the
+            directories only on server, or the whole tree when too many files
+            differ, are compared with the snapshot streamed by the server
+        return True if something changed, False if already synchronized
+        and None if the server didn't answer
+        """
+        server_url = "{}/tree/".format(self.server_url)
         request = {"url": server_url}
         sync = self._try_request(
+            requests.get, "getTree success", "getTree fail", **request)
+
+        if sync.status_code == 404:
+            # server without the merkle tree api
+            return self.full_synchronize()
+        if sync.status_code != 200:
+            return None
+
+        try:
+            self.poll_interval = float(sync.headers["X-Poll-Interval"])
+        except (KeyError, ValueError):
+            self.poll_interval = None
+        if "gzip" in sync.headers.get("Accept-Encoding", ""):
+            self.upload_encoding = "gzip"
+        else:
+            self.upload_encoding = None
+        self.delta_uploads = "rsync-delta" in sync.headers.get("Accept-Encoding", "")
+        self.chunked_uploads = "chunks" in sync.headers.get("Accept-Encoding", "")
+        server_root = sync.json()
+        server_timestamp = float(server_root['timestamp'])
+        with self.snapshot_lock:
+            if server_root['hash'] == self.snapshot_manager.global_md5():
+                logger.debug("synchronized")
+                self.snapshot_manager.save_snapshot(server_timestamp)
+                return False
+
+            # the streamed directories change the local files before the
+            # plan is executed, the state of the whole sync is the one before
+            local_synced = self.snapshot_manager.local_check()
+            server_snapshot, client_snapshot, stream_dirs = self.snapshot_manager.merkle_diff(
+                server_root, self.get_tree_node)
+            command_list = self.snapshot_manager.syncronize_dispatcher(
+                server_timestamp, server_snapshot, client_snapshot, local_synced)
+            command_list = self.snapshot_manager.optimize_plan(
+                command_list, server_snapshot, client_snapshot)
+        # the hashes differ also for the files this client ignores
+        changed = bool(command_list)
+        # the streamed directories first: a file moved into one of them is
+        # copied before the plan deletes its source
+        for dir_path in stream_dirs:
+            sync = self.get_snapshot_stream(dir_path)
+            if not self._is_stream(sync):
+                sync.close()
+                return None
+            changed = self._execute_stream(sync, dir_path, local_synced)[1] or changed
+        self.executer.syncronize_executer(command_list)
+        with self.snapshot_lock:
+            self.snapshot_manager.save_timestamp(server_timestamp)
+        return changed
+
+    def get_snapshot_stream(self, dir_path=""):
+        """
+        request the snapshot of the server streamed a file per line, only
+        the files under dir_path if given; the response has to be closed
+        """
+        server_url = "{}/files/".format(self.server_url)
+        params = {"format": "ndjson"}
+        if dir_path:
+            params["prefix"] = dir_path
+        request = {"url": server_url, "params": params, "stream": True}
+        return self._try_request(
             requests.get, "getFile success", "getFile fail", **request)
 
-        if sync.status_code != 401:
-            server_snapshot = sync.json()['snapshot']
+    def _is_stream(self, sync):
+        return sync.status_code == 200 and \
+            sync.headers.get("Content-Type", "").startswith(NDJSON_MIMETYPE)
+
+    def full_synchronize(self):
+        """Synchronize client and server comparing the full snapshots"""
 
-            server_timestamp = float(sync.json()['timestamp'])
+        sync = self.get_snapshot_stream()
+        if self._is_stream(sync):
+            return self.stream_synchronize(sync)
+        try:
+            snapshot = sync.json() if sync.status_code != 401 else None
+        finally:
+            sync.close()
+        if snapshot is not None:
+            server_snapshot = snapshot['snapshot']
+
+            server_timestamp = float(snapshot['timestamp'])
             logger.debug("".format("SERVER SAY: ", server_snapshot, server_timestamp, "\n"))
-            command_list = self.snapshot_manager.syncronize_dispatcher(server_timestamp, server_snapshot)
+            with self.snapshot_lock:
+                command_list = self.snapshot_manager.syncronize_dispatcher(server_timestamp, server_snapshot)
+                command_list = self.snapshot_manager.optimize_plan(command_list, server_snapshot)
             self.executer.syncronize_executer(command_list)
+            with self.snapshot_lock:
+                self.snapshot_manager.save_timestamp(server_timestamp)
+            return bool(command_list)
+
+    def stream_synchronize(self, sync):
+        """
+        Synchronize with the snapshot the server streams sorted by path,
+        a JSON per line: the timestamp and then the files; each batch of
+        commands is executed as soon as its part of the snapshot is compared
+        """
+        server_timestamp, changed = self._execute_stream(sync)
+        with self.snapshot_lock:
             self.snapshot_manager.save_timestamp(server_timestamp)
+        return changed
+
+    def _execute_stream(self, sync, dir_path="", local_synced=None):
+        """
+        execute a batch at time the commands of a streamed snapshot, the
+        one of dir_path if given; return (server timestamp, changed)
+        """
+        try:
+            lines = sync.iter_lines(chunk_size=READ_BLOCK_SIZE)
+            server_timestamp = float(json.loads(next(lines))["timestamp"])
+            server_files = (json.loads(line) for line in lines if line)
+            changed = False
+            for command_list, server_snapshot, client_snapshot in \
+                    self.snapshot_manager.stream_dispatcher(
+                        server_timestamp, server_files, dir_path, local_synced):
+                with self.snapshot_lock:
+                    command_list = self.snapshot_manager.optimize_plan(
+                        command_list, server_snapshot, client_snapshot)
+                self.executer.syncronize_executer(command_list)
+                changed = changed or bool(command_list)
+        finally:
+            # also when the dispatcher stops early or raises
+            sync.close()
+        return server_timestamp, changed
+
+    def get_tree_node(self, dir_path, recursive=False):
+        """
+        get from server the merkle tree node of a directory:
+            { "hash": <md5>, "timestamp": <timestamp>,
+              "dirs": { name: <md5> },
+              "files": { name: {"md5": <md5>, "timestamp": <timestamp>, "size": <size>} } }
+        with recursive "files" contains every file of the subtree (by path
+        relative to dir_path); return None if the directory is not on server
+        """
+        server_url = "{}/tree/{}".format(self.server_url, dir_path)
+        request = {"url": server_url}
+        if recursive:
+            request["params"] = {"recursive": "true"}
+        r = self._try_request(
+            requests.get, "getTree success " + dir_path, "getTree fail " + dir_path, **request)
+        if r.status_code == 200:
+            return r.json()
+        return None
 
     def get_url_relpath(self, abs_path):
         """ form get_abspath return the relative path for url """
         return get_relpath(abs_path).replace(os.path.sep, '/')
 
-    def download_file(self, dst_path):
-        """ download a file from server"""
+    def download_file(self, dst_path, out_file):
+        """
+        download a file from server into out_file
+            the body is written block by block and checked against the md5
+            sent by the server as ETag (a gzip body is decoded by requests,
+            the md5 is the one of the file)
+            return the md5 of the file or False
+        """
         error_log = "ERROR on download request " + dst_path
         success_log = "file downloaded! " + dst_path
 
@@ -121,52 +971,201 @@ class ServerCommunicator(object):
             self.server_url,
             self.get_url_relpath(dst_path))
 
-        request = {"url": server_url}
+        request = {"url": server_url, "stream": True}
 
         r = self._try_request(requests.get, success_log, error_log, **request)
-        local_path = get_abspath(dst_path)
-
-        if r.status_code == 200:
-            return local_path, r.text
-        else:
-            return False, False
-
-    def upload_file(self, dst_path, put_file=False):
-        """ upload a file to server """
+        if r.status_code != 200:
+            return False
 
-        file_object = ''
+        # a gzipped body has no Content-Length
+        size = r.headers.get(UNCOMPRESSED_SIZE_HEADER, r.headers.get("Content-Length"))
         try:
-            file_object = open(get_abspath(dst_path), 'rb')
-            file_content = open(get_abspath(dst_path), 'rb').read()
-        except IOError:
-            return False  # Atomic create and delete error!
+            priority = transfer_priority(int(size))
+        except (TypeError, ValueError):
+            priority = PRIORITY_BULK
+        file_md5 = hashlib.md5()
+        try:
+            for block in r.iter_content(READ_BLOCK_SIZE):
+                self.download_bucket.consume(len(block), priority)
+                file_md5.update(block)
+                out_file.write(block)
+        except requests.exceptions.RequestException:
+            logger.error("download of {} interrupted".format(dst_path))
+            return False
+        finally:
+            r.close()
+        expected_md5 = r.headers.get("ETag", "").strip('"')
+        if expected_md5 and expected_md5 != file_md5.hexdigest():
+            logger.error("download of {} corrupted, md5 mismatch".format(dst_path))
+            return False
+        return file_md5.hexdigest()
+
+    def get_signatures(self, dst_path):
+        """
+        block signatures of the server version of a file,
+        None if the server doesn't have it or it's too small for a delta
+        """
+        if os.path.getsize(get_abspath(dst_path)) < DELTA_MIN_SIZE:
+            return None
+        server_url = "{}/files/{}".format(
+            self.server_url,
+            self.get_url_relpath(dst_path))
+        request = {"url": server_url, "params": {"signatures": 1}}
+        r = self._try_request(
+            requests.get, "signatures received " + dst_path,
+            "ERROR signatures request " + dst_path, **request)
+        if r.status_code != 200:
+            return None
+        return r.json()
+
+    def upload_chunks(self, dst_path, put_file=False):
+        """
+        send to the server the chunks of a file it lacks, in a single
+        request, and return the md5
+        and the chunks of the file; None to upload the file in another way,
+        if the server didn't take the chunks or if it lacks most of them
+        and the file is an update it can receive as rsync delta
+        """
+        abs_path = get_abspath(dst_path)
+        with open(abs_path, 'rb') as file_object:
+            file_md5, chunks = chunk_file(file_object)
+            size = os.fstat(file_object.fileno()).st_size
+        server_url = "{}/chunks/".format(self.server_url)
+        request = {"url": server_url, "data": {"chunks": [chunk[0] for chunk in chunks]}}
+        r = self._try_request(
+            requests.post, "chunks checked " + dst_path,
+            "ERROR chunks request " + dst_path, **request)
+        if r.status_code != 200:
+            return None
+        missing = set(r.json()["missing"])
+        lengths = dict((chunk_md5, length) for chunk_md5, _, length in chunks)
+        missing_size = sum(lengths.get(chunk_md5, 0) for chunk_md5 in missing)
+        if put_file and self.delta_uploads and missing_size > DELTA_MAX_LITERAL * size:
+            return None
+
+        to_send = []
+        for chunk in chunks:
+            if chunk[0] in missing:
+                missing.discard(chunk[0])
+                to_send.append(chunk)
+        if not to_send:
+            return file_md5, chunks
+
+        encoding = None
+        if self.upload_encoding and compressible(abs_path, size):
+            encoding = self.upload_encoding
+
+        def send_chunks(url, auth):
+            # the missing chunks in a single body, streamed from the file
+            throttle = lambda size: self.upload_bucket.consume(size, PRIORITY_BULK)
+            body = MultipartFileStream(
+                abs_path, throttle=throttle, encoding=encoding, chunk_data=to_send)
+            try:
+                return requests.put(
+                    url, auth=auth, data=body,
+                    headers={"Content-Type": body.content_type})
+            finally:
+                body.close()
+
+        r = self._try_request(
+            send_chunks, "chunks uploaded " + dst_path,
+            "ERROR chunks upload " + dst_path, url=server_url)
+        if r.status_code != 201:
+            # e.g. the file changed after it was chunked
+            return None
+        return file_md5, chunks
 
+    def upload_file(self, dst_path, put_file=False):
+        """
+        upload a file to server
+            the body is streamed from disk and hashed while it's sent,
+            unless the md5 of the file is already cached;
+            a big file is sent by the chunks the server lacks or,
+            if modified, as a delta of the server version;
+            it's sent again in full if the server can't rebuild it (412)
+            and as a new file if an update finds it missing (404);
+            return the response of the server, False if the file can't be read
+        """
+        abs_path = get_abspath(dst_path)
         server_url = "{}/files/{}".format(
             self.server_url,
             self.get_url_relpath(dst_path))
 
         error_log = "ERROR upload request " + dst_path
         success_log = "file uploaded! " + dst_path
-        request = {
-            "url": server_url,
-            "files": {'file_content': file_object},
-            "data": {'file_md5': hashlib.md5(file_content).hexdigest()}
-        }
+        method = requests.put if put_file else requests.post
+        uploaded = {}
+        transfer = {"signatures": None, "chunks": None, "stat": None}
+        try:
+            if self.chunked_uploads and os.path.getsize(abs_path) >= CHUNKED_MIN_SIZE:
+                # the stat before reading the file, as for the md5 cache
+                transfer["stat"] = os.stat(abs_path)
+                transfer["chunks"] = self.upload_chunks(dst_path, put_file)
+            if put_file and self.delta_uploads and not transfer["chunks"]:
+                transfer["signatures"] = self.get_signatures(dst_path)
+        except (IOError, OSError):
+            return False
 
-        if put_file:
-            r = self._try_request(
-                requests.put, success_log, error_log, **request)
-        else:
-            r = self._try_request(
-                requests.post, success_log, error_log, **request)
+        def send_file(url, auth):
+            # a new stream for every retry of _try_request
+            stat = os.stat(abs_path)
+            priority = transfer_priority(stat.st_size)
+            throttle = lambda size: self.upload_bucket.consume(size, priority)
+            if transfer["chunks"]:
+                file_md5, chunks = transfer["chunks"]
+                stat = transfer["stat"]
+                body = MultipartFileStream(abs_path, file_md5, throttle, chunks=chunks)
+            else:
+                encoding = None
+                if self.upload_encoding and compressible(abs_path, stat.st_size):
+                    encoding = self.upload_encoding
+                body = MultipartFileStream(
+                    abs_path, self.snapshot_manager.cached_md5(abs_path),
+                    throttle, encoding, signatures=transfer["signatures"])
+            try:
+                response = method(
+                    url, auth=auth, data=body,
+                    headers={"Content-Type": body.content_type})
+            finally:
+                body.close()
+            uploaded["md5"] = body.hexdigest()
+            uploaded["stat"] = stat
+            return response
+
+        try:
+            r = self._try_request(send_file, success_log, error_log, url=server_url)
+        except (IOError, OSError):
+            return False  # Atomic create and delete error!
+        if r.status_code == 412 and (transfer["signatures"] or transfer["chunks"]):
+            logger.info("server can't rebuild {}, full upload".format(dst_path))
+            transfer.update(signatures=None, chunks=None)
+            try:
+                r = self._try_request(send_file, success_log, error_log, url=server_url)
+            except (IOError, OSError):
+                return False
+        if r.status_code == 404 and put_file:
+            # e.g. an update merged in the outbox with the upload that creates the file
+            logger.info("{} not on server, upload as a new file".format(dst_path))
+            put_file = False
+            method = requests.post
+            transfer.update(signatures=None)
+            try:
+                r = self._try_request(send_file, success_log, error_log, url=server_url)
+            except (IOError, OSError):
+                return False
         if r.status_code == 409:
             logger.error("file {} already exists on server".format(dst_path))
         elif r.status_code == 201:
-            if put_file:
-                self.snapshot_manager.update_snapshot_update({"src_path": dst_path})
-            else:
-                self.snapshot_manager.update_snapshot_upload({"src_path": dst_path})
-            self.snapshot_manager.save_snapshot(r.text)
+            if uploaded:
+                # the snapshot update below doesn't read the file again
+                self.snapshot_manager.cache_md5(abs_path, uploaded["md5"], uploaded["stat"])
+            with self.snapshot_lock:
+                if put_file:
+                    self.snapshot_manager.update_snapshot_update({"src_path": dst_path})
+                else:
+                    self.snapshot_manager.update_snapshot_upload({"src_path": dst_path})
+                self.snapshot_manager.save_snapshot(r.text)
+        return r
 
     def delete_file(self, dst_path):
         """ send to server a message of file delete """
@@ -183,8 +1182,10 @@ class ServerCommunicator(object):
         if r.status_code == 404:
             logger.error("DELETE REQUEST file {} not found on server".format(dst_path))
         elif r.status_code == 200:
-            self.snapshot_manager.update_snapshot_delete({"src_path": dst_path})
-            self.snapshot_manager.save_snapshot(r.text)
+            with self.snapshot_lock:
+                self.snapshot_manager.update_snapshot_delete({"src_path": dst_path})
+                self.snapshot_manager.save_snapshot(r.text)
+        return r
 
     def move_file(self, src_path, dst_path):
         """ send to server a message of file moved """
@@ -205,8 +1206,34 @@ class ServerCommunicator(object):
         if r.status_code == 404:
             logger.error("MOVE REQUEST file {} not found on server".format(src_path))
         elif r.status_code == 201:
-            self.snapshot_manager.update_snapshot_move({"src_path": src_path, "dst_path": dst_path})
-            self.snapshot_manager.save_snapshot(r.text)
+            with self.snapshot_lock:
+                self.snapshot_manager.update_snapshot_move({"src_path": src_path, "dst_path": dst_path})
+                self.snapshot_manager.save_snapshot(r.text)
+        return r
+
+    def move_dir(self, src_path, dst_path):
+        """ send to server a message of directory moved, its files are not sent again """
+
+        error_log = "ERROR move request " + dst_path
+        success_log = "directory moved! " + dst_path
+
+        server_url = "{}/actions/move".format(self.server_url)
+        request = {
+            "url": server_url,
+            "data": {
+                "file_src": self.get_url_relpath(src_path),
+                "file_dest": self.get_url_relpath(dst_path),
+            }
+        }
+
+        r = self._try_request(requests.post, success_log, error_log, **request)
+        if r.status_code == 404:
+            logger.error("MOVE REQUEST directory {} not found on server".format(src_path))
+        elif r.status_code == 201:
+            with self.snapshot_lock:
+                self.snapshot_manager.update_snapshot_move_dir({"src_path": src_path, "dst_path": dst_path})
+                self.snapshot_manager.save_snapshot(r.text)
+        return r
 
     def copy_file(self, src_path, dst_path):
         """ send to server a message of copy file"""
@@ -227,8 +1254,10 @@ class ServerCommunicator(object):
         if r.status_code == 404:
             logger.error("COPY REQUEST file {} not found on server".format(src_path))
         elif r.status_code == 201:
-            self.snapshot_manager.update_snapshot_copy({"src_path": src_path, "dst_path": dst_path})
-            self.snapshot_manager.save_snapshot(r.text)
+            with self.snapshot_lock:
+                self.snapshot_manager.update_snapshot_copy({"src_path": src_path, "dst_path": dst_path})
+                self.snapshot_manager.save_snapshot(r.text)
+        return r
 
     def create_user(self, param):
 
@@ -355,38 +1384,656 @@ class ServerCommunicator(object):
         return self.msg
 
 
+class SendLock(object):
+    """
+    lock of the outbox calls: the sender and the small uploads lane hold it
+    shared, each around the call it sends, so they send at the same time;
+    the synchronization holds it exclusive ("with outbox.lock"), reentrant,
+    and waits for the calls in flight while no new one starts
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.shared_count = 0
+        self.owner = None
+        self.depth = 0
+        self.waiting = 0
+
+    def __enter__(self):
+        me = threading.current_thread()
+        with self.condition:
+            if self.owner is not me:
+                self.waiting += 1
+                try:
+                    while self.owner is not None or self.shared_count:
+                        self.condition.wait()
+                finally:
+                    self.waiting -= 1
+                self.owner = me
+            self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.depth -= 1
+            if not self.depth:
+                self.owner = None
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def shared(self):
+        me = threading.current_thread()
+        with self.condition:
+            # the synchronization waiting goes first, the sends don't starve it
+            while self.owner is not None and self.owner is not me or \
+                    self.owner is None and self.waiting:
+                self.condition.wait()
+            self.shared_count += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.shared_count -= 1
+                self.condition.notify_all()
+
+
+class Outbox(object):
+    """
+    durable queue of the local changes to send to the server
+
+    it has the ServerCommunicator methods used by DirectoryEventHandler, the
+    calls are appended to a JSON lines file and a sender thread replays them
+    with the real communicator in order; while the server is unreachable
+    they wait on disk, also across restarts of the daemon.
+    While the sender is busy with a call, a second thread (the small uploads
+    lane) sends the uploads of small files that don't depend on the calls
+    before them, so they don't wait for a big transfer to end.
+    File records:
+        {"seq": <n>, "method": <ServerCommunicator method>, "args": [...]}
+        {"done": <n>}
+    (an upload merged with a create still pending has "new": true)
+    """
+
+    def __init__(self, file_path, server_com, retry_delay=OUTBOX_RETRY_DELAY):
+        self.file_path = file_path
+        self.server_com = server_com
+        self.retry_delay = retry_delay
+        self.pending = collections.OrderedDict()
+        # seq of the calls in flight, and the one of the sender
+        self.sending = set()
+        self.sender_seq = None
+        # calls that failed on the small uploads lane, left to the sender
+        self.lane_failed = set()
+        self.last_seq = 0
+        # shared by the sender and the lane while they send a call, exclusive
+        # for the synchronization
+        self.lock = SendLock()
+        self.changed = threading.Condition(threading.Lock())
+        self.stopped = threading.Event()
+        self.sender = None
+        self.lane = None
+        self._load()
+
+    def _load(self):
+        """ read the records left by the last run and rewrite only the pending ones """
+        try:
+            with open(self.file_path) as records:
+                for line in records:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # truncated by a crash while writing
+                    if "done" in record:
+                        self.pending.pop(record["done"], None)
+                    else:
+                        self.pending[record["seq"]] = record
+        except IOError:
+            pass
+        if self.pending:
+            self.last_seq = next(reversed(self.pending))
+        self._rewrite()
+
+    def _rewrite(self):
+        with open(self.file_path, 'w') as records:
+            for record in self.pending.itervalues():
+                records.write(json.dumps(record) + "\n")
+            records.flush()
+            os.fsync(records.fileno())
+
+    def _write(self, *records):
+        with open(self.file_path, 'a') as records_file:
+            for record in records:
+                records_file.write(json.dumps(record) + "\n")
+            records_file.flush()
+            os.fsync(records_file.fileno())
+
+    def _last_on_path(self, path):
+        """ the last pending record on path, the one being sent excluded """
+        for seq in reversed(self.pending):
+            record = self.pending[seq]
+            if seq not in self.sending and path in record["args"][:2]:
+                return record
+        return None
+
+    def append(self, method, args):
+        """ queue a call, dropping the pending calls it makes useless """
+        with self.changed:
+            done = []
+            new = False
+            last = self._last_on_path(args[0])
+            if last is not None and last["method"] == "upload_file":
+                new = last.get("new", not last["args"][1])
+                if method == "upload_file":
+                    # the upload reads the file when it's sent, only the last one
+                    # counts; it's an update if one of them was (upload_file falls
+                    # back to a create if the file is not on the server)
+                    done.append(last["seq"])
+                    args = [args[0], last["args"][1] or args[1]]
+                elif method == "delete_file":
+                    done.append(last["seq"])
+                    if new:
+                        # never reached the server
+                        method = None
+            for seq in done:
+                del self.pending[seq]
+            records = [{"done": seq} for seq in done]
+            if method is not None:
+                self.last_seq += 1
+                record = {"seq": self.last_seq, "method": method, "args": args}
+                if new and method == "upload_file":
+                    record["new"] = True
+                self.pending[self.last_seq] = record
+                records.append(record)
+            if not self.pending and not self.sending:
+                self._rewrite()
+            elif records:
+                self._write(*records)
+            self.changed.notify_all()
+
+    def upload_file(self, dst_path, put_file=False):
+        self.append("upload_file", [dst_path, put_file])
+
+    def delete_file(self, dst_path):
+        self.append("delete_file", [dst_path])
+
+    def move_file(self, src_path, dst_path):
+        self.append("move_file", [src_path, dst_path])
+
+    def move_dir(self, src_path, dst_path):
+        self.append("move_dir", [src_path, dst_path])
+
+    def copy_file(self, src_path, dst_path):
+        self.append("copy_file", [src_path, dst_path])
+
+    def __len__(self):
+        with self.changed:
+            return len(self.pending)
+
+    def _send(self, record):
+        """
+        send a call, return False if it must be retried later: the server is
+        unreachable, it failed (5xx) or the call raised; the call is dropped
+        once answered, also with a 4xx (logged by the communicator), or if
+        the local file can't be read
+        """
+        retry = True
+        try:
+            result = getattr(self.server_com, record["method"])(*record["args"])
+        except ServerUnreachable:
+            pass
+        except Exception:
+            logger.exception("outbox: {} failed, retry later".format(record))
+        else:
+            status_code = getattr(result, "status_code", None)
+            if status_code is not None and status_code >= 500:
+                logger.warning("outbox: {} failed ({}), retry later".format(record, status_code))
+            else:
+                retry = False
+        with self.changed:
+            self.sending.discard(record["seq"])
+            if not retry:
+                self.lane_failed.discard(record["seq"])
+                del self.pending[record["seq"]]
+                if self.pending or self.sending:
+                    self._write({"done": record["seq"]})
+                else:
+                    self._rewrite()
+            self.changed.notify_all()
+        return not retry
+
+    def send_next(self):
+        """
+        send the oldest pending call,
+        return False if there is nothing to send or the call must be retried later
+        """
+        with self.lock.shared():
+            with self.changed:
+                if not self.pending:
+                    return False
+                record = next(self.pending.itervalues())
+                on_lane = record["seq"] in self.sending
+                if not on_lane:
+                    self.sending.add(record["seq"])
+                    self.sender_seq = record["seq"]
+                    self.changed.notify_all()
+            if not on_lane:
+                try:
+                    return self._send(record)
+                finally:
+                    with self.changed:
+                        self.sender_seq = None
+        # on the small uploads lane, the next calls may depend on it
+        with self.changed:
+            if record["seq"] in self.sending:
+                self.changed.wait(1.0)
+        return True
+
+    def _small_upload(self):
+        """
+        the oldest pending upload of a small file that no call before it
+        touches (the path, or a directory of it)
+        """
+        earlier = []
+        for seq, record in self.pending.iteritems():
+            if seq not in self.sending and seq not in self.lane_failed and \
+                    record["method"] == "upload_file":
+                path = record["args"][0]
+                if not any(path == other or path.startswith(other + "/") for other in earlier):
+                    try:
+                        size = os.path.getsize(get_abspath(path))
+                    except OSError:
+                        size = None
+                    if transfer_priority(size) == PRIORITY_INTERACTIVE:
+                        return record
+            earlier.extend(
+                arg.rstrip("/") for arg in record["args"][:2] if isinstance(arg, basestring))
+        return None
+
+    def send_small(self):
+        """
+        send a small upload while the sender is busy with another call,
+        return False if there is none to send or it failed
+        """
+        with self.lock.shared():
+            with self.changed:
+                if self.sender_seq is None:
+                    return False
+                record = self._small_upload()
+                if record is None:
+                    return False
+                self.sending.add(record["seq"])
+            if self._send(record):
+                return True
+        with self.changed:
+            self.lane_failed.add(record["seq"])
+        return False
+
+    def _send_loop(self):
+        while not self.stopped.is_set():
+            if self.send_next():
+                continue
+            with self.changed:
+                if self.pending:
+                    logger.warning("{} changes queued, retry in {}s".format(
+                        len(self.pending), self.retry_delay))
+                    wait = self.retry_delay
+                else:
+                    wait = 1.0
+                self.changed.wait(wait)
+
+    def _lane_loop(self):
+        while not self.stopped.is_set():
+            if self.send_small():
+                continue
+            with self.changed:
+                self.changed.wait(1.0)
+
+    def start(self):
+        self.sender = threading.Thread(target=self._send_loop, name="outbox-sender")
+        self.sender.daemon = True
+        self.sender.start()
+        self.lane = threading.Thread(target=self._lane_loop, name="outbox-lane")
+        self.lane.daemon = True
+        self.lane.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.changed:
+            self.changed.notify_all()
+
+    def join(self):
+        for thread in (self.sender, self.lane):
+            if thread is not None:
+                thread.join()
+
+
+class SyncScheduler(object):
+    """
+    decide when the daemon asks the server for its changes:
+    at once after a local activity, every min_interval while something
+    changes, then with an interval doubled at each idle synchronization
+    up to max_interval; the interval suggested by the server is a lower
+    bound, capped by max_interval as well
+    """
+
+    def __init__(self, min_interval=5, max_interval=300):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.next_sync = 0
+
+    def due(self, now=None):
+        now = now or time.time()
+        return now >= self.next_sync
+
+    def local_activity(self, now=None):
+        """ the local changes are sent, look at the remote ones soon """
+        self.interval = self.min_interval
+        self.next_sync = now or time.time()
+
+    def synchronized(self, changed, suggested=None, now=None):
+        now = now or time.time()
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        wait = self.interval
+        if not changed and suggested:
+            wait = max(wait, min(suggested, self.max_interval))
+        self.next_sync = now + wait
+
+    def failed(self, now=None):
+        """ server unreachable, try again as if idle """
+        self.synchronized(False, now=now)
+
+
+class SyncWorker(object):
+    """
+    thread that dispatches the settled local events and synchronizes with
+    the server when the SyncScheduler says so, out of the asyncore loop of
+    the command socket; status() is called from that loop to report progress
+    """
+
+    def __init__(self, event_handler, outbox, server_com, file_system_op, scheduler, tick=1.0):
+        self.event_handler = event_handler
+        self.outbox = outbox
+        self.server_com = server_com
+        self.file_system_op = file_system_op
+        self.scheduler = scheduler
+        self.tick = tick
+        self.last_seq = outbox.last_seq
+        self.state = "idle"
+        self.last_sync = None
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def run_once(self, now=None):
+        self.event_handler.flush(now)
+        if self.outbox.last_seq != self.last_seq:
+            self.last_seq = self.outbox.last_seq
+            self.scheduler.local_activity(now)
+        # the local changes are sent before looking at the remote ones
+        if (not self.scheduler.due(now) or len(self.outbox) or
+                self.event_handler.pending):
+            return
+        self.state = "synchronizing"
+        try:
+            with self.outbox.lock:
+                changed = self.server_com.synchronize(self.file_system_op)
+        except ServerUnreachable:
+            logger.warning("server unreachable, synchronization postponed")
+            changed = None
+        if changed is None:
+            self.state = "server unreachable"
+            self.scheduler.failed(now)
+        else:
+            self.state = "idle"
+            self.last_sync = now or time.time()
+            self.scheduler.synchronized(changed, self.server_com.poll_interval, now)
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("synchronization failed")
+                self.state = "error"
+                self.scheduler.failed()
+            self.stopped.wait(self.tick)
+
+    def start(self):
+        self.worker = threading.Thread(target=self._loop, name="sync-worker")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def join(self):
+        if self.worker is not None:
+            self.worker.join()
+
+    def status(self, param=None):
+        """ answer of the status command """
+        if self.last_sync is None:
+            last_sync = "never"
+        else:
+            last_sync = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_sync))
+        return {
+            "result": self.state,
+            "details": [
+                "local changes queued: {}".format(len(self.outbox)),
+                "local events settling: {}".format(len(self.event_handler.pending)),
+                "last synchronization: {}".format(last_sync),
+                "next synchronization in: {:.0f}s".format(
+                    max(0, self.scheduler.next_sync - time.time())),
+            ]
+        }
+
+
+class BlobCache(object):
+    """
+    contents deleted or overwritten by the sync, by md5, in a directory out
+    of the sync root: the files are moved there instead of being removed and
+    moved back instead of being downloaded again; the least recently used
+    are removed beyond max_size bytes; the files can be moved only if the
+    cache is on the same device of the sync root
+    """
+
+    def __init__(self, cache_dir, max_size, sync_root=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # md5: size, the least recently used first
+        self.blobs = collections.OrderedDict()
+        self.size = 0
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+        entries = []
+        for name in os.listdir(cache_dir):
+            try:
+                st = os.stat(self._path(name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, file_md5, size in sorted(entries):
+            self.blobs[file_md5] = size
+            self.size += size
+        with self.lock:
+            self._evict()
+        if sync_root is not None:
+            self._check_device(sync_root)
+
+    def _check_device(self, sync_root):
+        try:
+            same_device = os.stat(self.cache_dir).st_dev == os.stat(sync_root).st_dev
+        except OSError:
+            return
+        if not same_device:
+            logger.warning(
+                "blob cache {} is not on the device of {}, it won't keep "
+                "any file".format(self.cache_dir, sync_root))
+
+    def _path(self, file_md5):
+        return os.path.join(self.cache_dir, file_md5)
+
+    def _evict(self):
+        while self.size > self.max_size:
+            file_md5, size = self.blobs.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._path(file_md5))
+            except OSError:
+                pass
+
+    def __contains__(self, file_md5):
+        with self.lock:
+            return file_md5 in self.blobs
+
+    def add(self, abs_path, file_md5):
+        """
+        move the file abs_path, whose content is file_md5, in the cache;
+        False if it's left where it is
+        """
+        try:
+            size = os.path.getsize(abs_path)
+        except OSError:
+            return False
+        if size > self.max_size:
+            return False
+        with self.lock:
+            if file_md5 in self.blobs:
+                # the same content is already cached
+                os.remove(abs_path)
+                self.blobs[file_md5] = self.blobs.pop(file_md5)
+                os.utime(self._path(file_md5), None)
+                return True
+            try:
+                os.rename(abs_path, self._path(file_md5))
+            except OSError:
+                # e.g. on another filesystem, a copy would cost as a download
+                return False
+            os.utime(self._path(file_md5), None)
+            self.blobs[file_md5] = size
+            self.size += size
+            self._evict()
+        return True
+
+    def take(self, file_md5, dst_path):
+        """ move the content file_md5 out of the cache to dst_path, False if it's not cached """
+        with self.lock:
+            size = self.blobs.pop(file_md5, None)
+            if size is None:
+                return False
+            self.size -= size
+            try:
+                os.rename(self._path(file_md5), dst_path)
+            except OSError:
+                return False
+        return True
+
+
 class FileSystemOperator(object):
 
-    def __init__(self, event_handler, server_com, snapshot_manager):
+    def __init__(self, event_handler, server_com, snapshot_manager, blob_cache=None):
         self.snapshot_manager = snapshot_manager
         self.event_handler = event_handler
         self.server_com = server_com
+        self.blob_cache = blob_cache
+        # read once, changing the umask isn't thread safe
+        self.file_mode = default_file_mode()
+
+    def add_event_to_ignore(self, path, kinds):
+        """ the next events of these kinds on path are caused by the daemon """
+        self.event_handler.ignored_events.add(path, kinds)
+
+    def _written_events(self, abs_path):
+        """ events expected writing abs_path """
+        if os.path.exists(abs_path):
+            return ["modified"]
+        return ["created", "modified"]
+
+    def _temp_file(self, abs_path):
+        """ temporary file in the directory of abs_path, skipped by the event handler """
+        try:
+            os.makedirs(os.path.split(abs_path)[0], 0755)
+        except OSError:
+            pass
+        return tempfile.NamedTemporaryFile(
+            dir=os.path.split(abs_path)[0],
+            prefix=DOWNLOAD_PREFIX, suffix=DOWNLOAD_SUFFIX, delete=False)
+
+    def _file_mode(self, abs_path):
+        """ mode of the file abs_path, or of a new file if it doesn't exist """
+        try:
+            return os.stat(abs_path).st_mode & 07777
+        except OSError:
+            return self.file_mode
 
-    def add_event_to_ignore(self, path):
-        self.event_handler.paths_ignored.append(path)
+    def _rename_in_place(self, temp_path, abs_path, file_md5, mode):
+        """
+        give the temporary file the mode (it's created 0600) and rename it
+        over abs_path
+        """
+        os.chmod(temp_path, mode)
+        self.add_event_to_ignore(abs_path, ["moved"] + self._written_events(abs_path))
+        os.rename(temp_path, abs_path)
+        if file_md5:
+            with self.server_com.snapshot_lock:
+                self.snapshot_manager.cache_md5(abs_path, file_md5, os.stat(abs_path))
+
+    def _keep(self, abs_path):
+        """
+        move in the blob cache a file the sync deletes or overwrites,
+        if its md5 is known; False if the file is left where it is
+        """
+        if self.blob_cache is None:
+            return False
+        file_md5 = self.snapshot_manager.cached_md5(abs_path)
+        if file_md5 is None:
+            return False
+        return self.blob_cache.add(abs_path, file_md5)
 
-    def write_a_file(self, path):
+    def write_a_file(self, path, file_md5=None):
         """
         write a file (download if exist or not [get and put])
 
-            send a path to ignore to watchdog
-            download the file from server
             create directory chain
-            create file
+            take the content file_md5 from the blob cache or download the
+            file from server in a temporary file of the same directory
+            send a path to ignore to watchdog
+            move the overwritten file in the blob cache
+            rename the temporary file over the path
             when watchdog see the first event on this path ignore it
         """
-        abs_path, content = self.server_com.download_file(path)
-        if abs_path and content:
-            self.add_event_to_ignore(get_abspath(path))
-            try:
-                os.makedirs(os.path.split(abs_path)[0], 0755)
-            except OSError:
-                pass
-            with open(abs_path, 'wb') as f:
-                f.write(content)
-            self.snapshot_manager.update_snapshot_upload({"src_path": get_abspath(abs_path)})
+        abs_path = get_abspath(path)
+        temp_file = self._temp_file(abs_path)
+        if file_md5 and self.blob_cache is not None and \
+                self.blob_cache.take(file_md5, temp_file.name):
+            temp_file.close()
+            logger.debug("{} restored from the blob cache".format(path))
         else:
-            logger.error("DOWNLOAD REQUEST for file {} , not found on server".format(path))
+            file_md5 = False
+            try:
+                with temp_file:
+                    file_md5 = self.server_com.download_file(path, temp_file)
+            finally:
+                if not file_md5:
+                    os.remove(temp_file.name)
+            if not file_md5:
+                logger.error("DOWNLOAD REQUEST for file {} , not found on server".format(path))
+                return
+        # the mode of the overwritten file, before it goes in the blob cache
+        mode = self._file_mode(abs_path)
+        if os.path.isfile(abs_path):
+            self.add_event_to_ignore(abs_path, ["deleted"])
+            if not self._keep(abs_path):
+                self.event_handler.ignored_events.consume(abs_path, "deleted")
+        self._rename_in_place(temp_file.name, abs_path, file_md5, mode)
+        with self.server_com.snapshot_lock:
+            self.snapshot_manager.update_snapshot_upload({"src_path": abs_path})
 
     def move_a_file(self, origin_path, dst_path):
         """
@@ -397,52 +2044,80 @@ class FileSystemOperator(object):
             move the file from origin_path to dst_path
             when watchdog see the first event on this path ignore it
         """
-        self.add_event_to_ignore(get_abspath(origin_path))
-        self.add_event_to_ignore(get_abspath(dst_path))
+        self.add_event_to_ignore(get_abspath(origin_path), ["moved"])
+        self.add_event_to_ignore(get_abspath(dst_path), ["moved"])
         try:
             os.makedirs(os.path.split(dst_path)[0], 0755)
         except OSError:
             pass
         shutil.move(origin_path, dst_path)
-        self.snapshot_manager.update_snapshot_move({"src_path": get_abspath(origin_path), "dst_path": get_abspath(dst_path)})
+        with self.server_com.snapshot_lock:
+            self.snapshot_manager.update_snapshot_move({"src_path": get_abspath(origin_path), "dst_path": get_abspath(dst_path)})
 
     def copy_a_file(self, origin_path, dst_path):
         """
         copy a file
 
-            send a path to ignore to watchdog for dest path (because copy is a creation event)
-            create directory chain for dst_path
-            copy the file from origin_path to dst_path
+            clone (or copy) the file from origin_path in a temporary file
+            of the dst_path directory, sharing the blocks if the filesystem can
+            send a path to ignore to watchdog for dest path
+            rename the temporary file over dst_path
             when watchdog see the first event on this path ignore it
         """
-        self.add_event_to_ignore(get_abspath(dst_path))
         origin_path = get_abspath(origin_path)
         dst_path = get_abspath(dst_path)
+        temp_file = self._temp_file(dst_path)
         try:
-            os.makedirs(os.path.split(dst_path)[0], 0755)
-        except OSError:
-            pass
-        shutil.copyfile(origin_path, dst_path)
-        self.snapshot_manager.update_snapshot_copy({"src_path": get_abspath(origin_path), "dst_path": get_abspath(dst_path)})
+            with temp_file, open(origin_path, 'rb') as origin:
+                if not reflink(origin, temp_file):
+                    shutil.copyfileobj(origin, temp_file, READ_BLOCK_SIZE)
+        except (IOError, OSError):
+            os.remove(temp_file.name)
+            raise
+        self._rename_in_place(
+            temp_file.name, dst_path, self.snapshot_manager.cached_md5(origin_path),
+            self._file_mode(dst_path))
+        with self.server_com.snapshot_lock:
+            self.snapshot_manager.update_snapshot_copy({"src_path": get_abspath(origin_path), "dst_path": get_abspath(dst_path)})
 
     def delete_a_file(self, dst_path):
         """
         delete a file
 
             send a dst_path to ignore to watchdog
-            delete file
+            move the file (or the files of the directory) in the blob cache
+            or delete it
             when watchdog see the first event on this dst_path ignore it
         """
-        self.add_event_to_ignore(get_abspath(dst_path))
+        self.add_event_to_ignore(get_abspath(dst_path), ["deleted"])
         dst_path = get_abspath(dst_path)
         if os.path.isdir(dst_path):
+            if self.blob_cache is not None:
+                for record in TreeWalker(workers=1).walk(dst_path):
+                    self._keep(record.path)
             shutil.rmtree(dst_path)
-        else:
+        elif not self._keep(dst_path):
             try:
                 os.remove(dst_path)
             except OSError:
                 pass
-        self.snapshot_manager.update_snapshot_delete({"src_path": get_abspath(dst_path)})
+        with self.server_com.snapshot_lock:
+            self.snapshot_manager.update_snapshot_delete({"src_path": get_abspath(dst_path)})
+
+
+def _get_option(config_ini, section, option, default):
+    """ read an option that older config.ini files may not have """
+    try:
+        return config_ini.get(section, option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+
+def blob_cache_path(cache_path, snapshot_file_path):
+    """ the blob cache directory, a relative path is next to the snapshot file """
+    return os.path.join(
+        os.path.dirname(os.path.abspath(snapshot_file_path)),
+        os.path.expanduser(cache_path))
 
 
 def load_config():
@@ -468,7 +2143,32 @@ def load_config():
             "stdout_log_level": config_ini.get('daemon_communication', 'stdout_log_level'),
             "file_log_level": config_ini.get('daemon_communication', 'file_log_level'),
             "dir_path": config_ini.get('daemon_communication', 'dir_path'),
-            "snapshot_file_path": config_ini.get('daemon_communication', 'snapshot_file_path')
+            "snapshot_file_path": config_ini.get('daemon_communication', 'snapshot_file_path'),
+            "watcher": _get_option(config_ini, 'daemon_communication', 'watcher', WATCHER),
+            "settle_window": _get_option(
+                config_ini, 'daemon_communication', 'settle_window', SETTLE_WINDOW),
+            "outbox_file_path": _get_option(
+                config_ini, 'daemon_communication', 'outbox_file_path', OUTBOX_FILE_PATH),
+            "retry_base_delay": _get_option(
+                config_ini, 'daemon_communication', 'retry_base_delay', RETRY_BASE_DELAY),
+            "retry_max_delay": _get_option(
+                config_ini, 'daemon_communication', 'retry_max_delay', RETRY_MAX_DELAY),
+            "sync_min_interval": _get_option(
+                config_ini, 'daemon_communication', 'sync_min_interval', SYNC_MIN_INTERVAL),
+            "sync_max_interval": _get_option(
+                config_ini, 'daemon_communication', 'sync_max_interval', SYNC_MAX_INTERVAL),
+            "sync_exclude": _get_option(
+                config_ini, 'daemon_communication', 'sync_exclude', SYNC_EXCLUDE),
+            "sync_include": _get_option(
+                config_ini, 'daemon_communication', 'sync_include', SYNC_INCLUDE),
+            "upload_limit": _get_option(
+                config_ini, 'daemon_communication', 'upload_limit', UPLOAD_LIMIT),
+            "download_limit": _get_option(
+                config_ini, 'daemon_communication', 'download_limit', DOWNLOAD_LIMIT),
+            "blob_cache_path": _get_option(
+                config_ini, 'daemon_communication', 'blob_cache_path', BLOB_CACHE_PATH),
+            "blob_cache_size": _get_option(
+                config_ini, 'daemon_communication', 'blob_cache_size', BLOB_CACHE_SIZE),
         }
     except ConfigParser.NoSectionError:
         dir_path = os.path.join(os.path.expanduser("~"), "RawBox")
@@ -481,6 +2181,19 @@ def load_config():
         config_ini.set('daemon_communication', 'crash_repo_path', crash_log_path)
         config_ini.set('daemon_communication', 'stdout_log_level', "DEBUG")
         config_ini.set('daemon_communication', 'file_log_level', "ERROR")
+        config_ini.set('daemon_communication', 'watcher', WATCHER)
+        config_ini.set('daemon_communication', 'settle_window', SETTLE_WINDOW)
+        config_ini.set('daemon_communication', 'outbox_file_path', OUTBOX_FILE_PATH)
+        config_ini.set('daemon_communication', 'retry_base_delay', RETRY_BASE_DELAY)
+        config_ini.set('daemon_communication', 'retry_max_delay', RETRY_MAX_DELAY)
+        config_ini.set('daemon_communication', 'sync_min_interval', SYNC_MIN_INTERVAL)
+        config_ini.set('daemon_communication', 'sync_max_interval', SYNC_MAX_INTERVAL)
+        config_ini.set('daemon_communication', 'sync_exclude', SYNC_EXCLUDE)
+        config_ini.set('daemon_communication', 'sync_include', SYNC_INCLUDE)
+        config_ini.set('daemon_communication', 'upload_limit', UPLOAD_LIMIT)
+        config_ini.set('daemon_communication', 'download_limit', DOWNLOAD_LIMIT)
+        config_ini.set('daemon_communication', 'blob_cache_path', BLOB_CACHE_PATH)
+        config_ini.set('daemon_communication', 'blob_cache_size', BLOB_CACHE_SIZE)
 
         snapshot_file = config_ini.get('daemon_communication', 'snapshot_file_path')
         config = {
@@ -495,7 +2208,20 @@ def load_config():
             "stdout_log_level": config_ini.get('daemon_communication', 'stdout_log_level'),
             "file_log_level": config_ini.get('daemon_communication', 'file_log_level'),
             "dir_path": config_ini.get('daemon_communication', 'dir_path'),
-            "snapshot_file_path": snapshot_file
+            "snapshot_file_path": snapshot_file,
+            "watcher": config_ini.get('daemon_communication', 'watcher'),
+            "settle_window": config_ini.get('daemon_communication', 'settle_window'),
+            "outbox_file_path": config_ini.get('daemon_communication', 'outbox_file_path'),
+            "retry_base_delay": config_ini.get('daemon_communication', 'retry_base_delay'),
+            "retry_max_delay": config_ini.get('daemon_communication', 'retry_max_delay'),
+            "sync_min_interval": config_ini.get('daemon_communication', 'sync_min_interval'),
+            "sync_max_interval": config_ini.get('daemon_communication', 'sync_max_interval'),
+            "sync_exclude": config_ini.get('daemon_communication', 'sync_exclude'),
+            "sync_include": config_ini.get('daemon_communication', 'sync_include'),
+            "upload_limit": config_ini.get('daemon_communication', 'upload_limit'),
+            "download_limit": config_ini.get('daemon_communication', 'download_limit'),
+            "blob_cache_path": config_ini.get('daemon_communication', 'blob_cache_path'),
+            "blob_cache_size": config_ini.get('daemon_communication', 'blob_cache_size'),
         }
         try:
             os.makedirs(dir_path)
@@ -521,12 +2247,92 @@ def load_config():
     return config, user_exists
 
 
-class DirectoryEventHandler(FileSystemEventHandler):
+class IgnoredEvents(object):
+    """
+    events expected on the paths written by the daemon itself, counted by
+    path and kind; the ones never seen by the observer expire after ttl seconds
+    """
+
+    def __init__(self, ttl=IGNORE_TTL):
+        self.ttl = ttl
+        self.deadlines = {}
+        self.expiry_queue = collections.deque()
+        self.lock = threading.Lock()
+
+    def add(self, path, kinds):
+        deadline = time.time() + self.ttl
+        with self.lock:
+            for kind in kinds:
+                self.deadlines.setdefault((path, kind), collections.deque()).append(deadline)
+                self.expiry_queue.append((deadline, path, kind))
+
+    def _pop(self, key):
+        deadlines = self.deadlines[key]
+        deadlines.popleft()
+        if not deadlines:
+            del self.deadlines[key]
+
+    def _expire(self, now):
+        while self.expiry_queue and self.expiry_queue[0][0] <= now:
+            _, path, kind = self.expiry_queue.popleft()
+            deadlines = self.deadlines.get((path, kind))
+            # the oldest deadline of the key can be already consumed
+            if deadlines and deadlines[0] <= now:
+                self._pop((path, kind))
+
+    def consume(self, path, kind, now=None):
+        """ return True and forget the event if it was expected """
+        with self.lock:
+            self._expire(now or time.time())
+            if (path, kind) not in self.deadlines:
+                return False
+            self._pop((path, kind))
+            return True
+
+    def discard(self, path):
+        """ forget every event expected on path """
+        with self.lock:
+            for kind in EVENT_KINDS:
+                self.deadlines.pop((path, kind), None)
+
+    def __contains__(self, path):
+        with self.lock:
+            return any((path, kind) in self.deadlines for kind in EVENT_KINDS)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(deadlines) for deadlines in self.deadlines.itervalues())
+
+
+# result of two events on the same path, None when nothing is left to do
+COALESCED_ACTIONS = {
+    ("created", "created"): "created",
+    ("created", "modified"): "created",
+    ("created", "deleted"): None,
+    ("modified", "created"): "modified",
+    ("modified", "modified"): "modified",
+    ("modified", "deleted"): "deleted",
+    ("deleted", "created"): "modified",
+    ("deleted", "modified"): "modified",
+    ("deleted", "deleted"): "deleted",
+}
+
 
-    def __init__(self, cmd, snap):
+class DirectoryEventHandler(FileSystemEventHandler):
+    """
+    receive the watchdog events and queue them by path, consecutive events
+    on a path are coalesced and dispatched to the server by flush only when
+    the file size and mtime have been stable for settle_window seconds
+    (with settle_window = 0 the events are dispatched immediately)
+    """
+
+    def __init__(self, cmd, snap, settle_window=0):
         self.cmd = cmd
         self.snap = snap
-        self.paths_ignored = []
+        self.ignored_events = IgnoredEvents()
+        self.settle_window = settle_window
+        self.pending = collections.OrderedDict()
+        self.pending_lock = threading.Lock()
 
     def _is_copy(self, abs_path):
         """
@@ -541,6 +2347,145 @@ class DirectoryEventHandler(FileSystemEventHandler):
             return self.snap.local_full_snapshot[file_md5][0]
         return False
 
+    def _stat(self, abs_path):
+        try:
+            stat = os.stat(abs_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _enqueue(self, action, abs_path, src_path=None):
+        """ coalesce a file event with the one pending on the same path """
+        with self.pending_lock:
+            if action == "moved":
+                entry = self._coalesce_move(src_path, abs_path)
+            else:
+                entry = {"action": action}
+                previous = self.pending.pop(abs_path, None)
+                if previous is not None and previous["action"] == "moved":
+                    if action == "deleted":
+                        # the server still has the file in the source path
+                        abs_path = previous["src_path"]
+                    else:
+                        entry = dict(previous, modified=True)
+                elif previous is not None:
+                    entry["action"] = COALESCED_ACTIONS[(previous["action"], action)]
+            if entry is None or entry["action"] is None:
+                return
+            entry["stat"] = self._stat(abs_path)
+            entry["stable_since"] = time.time()
+            self.pending[abs_path] = entry
+        if not self.settle_window:
+            self.flush()
+
+    def _coalesce_move(self, src_path, dst_path):
+        previous = self.pending.pop(src_path, None)
+        self.pending.pop(dst_path, None)
+        if previous is None:
+            return {"action": "moved", "src_path": src_path, "modified": False}
+        if previous["action"] == "created":
+            # never reached the server, e.g. an editor temporary file
+            # renamed over the document
+            if self.snap.path_in_snapshot(dst_path):
+                return {"action": "modified"}
+            return {"action": "created"}
+        if previous["action"] == "moved":
+            if previous["src_path"] == dst_path:
+                return {"action": "modified"} if previous["modified"] else None
+            return dict(previous)
+        return {"action": "moved", "src_path": src_path, "modified": True}
+
+    def _settled(self, abs_path, entry, now):
+        if now - entry["stable_since"] < self.settle_window:
+            return False
+        if not self.settle_window or entry["action"] == "deleted":
+            return True
+        if entry["action"] == "moved" and not entry["modified"]:
+            return True
+        stat = self._stat(abs_path)
+        if stat != entry["stat"]:
+            entry["stat"] = stat
+            entry["stable_since"] = now
+            return False
+        return True
+
+    def flush(self, now=None):
+        """ dispatch the pending events on settled files """
+        now = now or time.time()
+        ready = []
+        with self.pending_lock:
+            for abs_path, entry in self.pending.items():
+                if self._settled(abs_path, entry, now):
+                    del self.pending[abs_path]
+                    ready.append((abs_path, entry))
+        for abs_path, entry in ready:
+            self._dispatch(abs_path, entry)
+
+    def _dispatch(self, abs_path, entry):
+        action = entry["action"]
+        vanished = self.settle_window and entry["stat"] is None
+        if action == "moved":
+            self.cmd.move_file(entry["src_path"], abs_path)
+            if entry["modified"] and not vanished:
+                self.cmd.upload_file(abs_path, put_file=True)
+        elif action == "deleted":
+            self.cmd.delete_file(abs_path)
+        elif vanished:
+            # its deletion event is on the way
+            logger.debug("{} vanished before upload".format(abs_path))
+        elif action == "created":
+            copy = self._is_copy(abs_path)
+            if copy:
+                self.cmd.copy_file(copy, abs_path)
+            else:
+                self.cmd.upload_file(abs_path)
+        else:
+            self.cmd.upload_file(abs_path, put_file=True)
+
+    def _move_dir(self, src_dir, dst_dir):
+        """
+        a directory renamed in the tree is moved on the server with a single
+        request; the moves of its files, reported by the observer before
+        (polling) or after (inotify) the directory one, are dropped
+        """
+        src_dir = src_dir.rstrip(os.path.sep)
+        dst_dir = dst_dir.rstrip(os.path.sep)
+        if self.snap.is_ignored(src_dir, True) or self.snap.is_ignored(dst_dir, True):
+            # the moves of its files are handled one by one
+            return
+        files = self.snap.files_in_dir(src_dir)
+        if not files:
+            return
+        prefix = src_dir + os.path.sep
+
+        def renamed(path):
+            if path.startswith(prefix):
+                return dst_dir + path[len(src_dir):]
+            return path
+
+        expected = set(files)
+        with self.pending_lock:
+            pending = collections.OrderedDict()
+            for abs_path, entry in self.pending.items():
+                src_path = entry.get("src_path")
+                if entry["action"] == "moved" and renamed(src_path) == abs_path != src_path:
+                    # the move of a file of the directory, already seen
+                    expected.discard(src_path)
+                    if not entry["modified"]:
+                        continue
+                    entry = dict(entry, action="modified")
+                    del entry["src_path"]
+                elif src_path is not None:
+                    entry["src_path"] = renamed(src_path)
+                if abs_path.startswith(prefix):
+                    # its move is still to come
+                    expected.add(abs_path)
+                pending[renamed(abs_path)] = entry
+            self.pending = pending
+        for src_path in expected:
+            self.ignored_events.add(src_path, ["moved"])
+        self.cmd.move_dir(src_dir, dst_dir)
+
     def on_moved(self, event):
         """Called when a file or a directory is moved or renamed.
 
@@ -549,13 +2494,25 @@ class DirectoryEventHandler(FileSystemEventHandler):
         :type event:
             :class:`DirMovedEvent` or :class:`FileMovedEvent`
         """
-        if event.src_path not in self.paths_ignored:
-            if not event.is_directory:
-                self.cmd.move_file(event.src_path, event.dest_path)
+        if is_download_file(event.src_path):
+            # a completed download renamed in place, nothing else to expect
+            self.ignored_events.discard(event.dest_path)
+        elif self.ignored_events.consume(event.src_path, "moved"):
+            self.ignored_events.consume(event.dest_path, "moved")
+            logger.debug("ignored move on {}".format(event.src_path))
+        elif event.is_directory:
+            self._move_dir(event.src_path, event.dest_path)
+        elif self.snap.is_ignored(event.src_path):
+            if not self.snap.is_ignored(event.dest_path):
+                # an editor temporary file saved over the document
+                if self.snap.path_in_snapshot(event.dest_path):
+                    self._enqueue("modified", event.dest_path)
+                else:
+                    self._enqueue("created", event.dest_path)
+        elif self.snap.is_ignored(event.dest_path):
+            self._enqueue("deleted", event.src_path)
         else:
-            logger.debug("".format("ignored move on ", event.src_path))
-            self.paths_ignored.remove(event.src_path)
-            self.paths_ignored.remove(event.dest_path)
+            self._enqueue("moved", event.dest_path, event.src_path)
 
     def on_created(self, event):
         """Called when a file or directory is created.
@@ -565,20 +2522,12 @@ class DirectoryEventHandler(FileSystemEventHandler):
         :type event:
             :class:`DirCreatedEvent` or :class:`FileCreatedEvent`
         """
-        copy = False
-        if event.src_path not in self.paths_ignored:
-            if not event.is_directory:
-                copy = self._is_copy(event.src_path)
-                if copy:
-                    self.cmd.copy_file(copy, event.src_path)
-                else:
-                    self.cmd.upload_file(event.src_path)
-        else:
-            if copy:
-                logger.debug("".format("ignored copy on ", event.src_path))
-            else:
-                logger.debug("".format("ignored creation on ", event.src_path))
-            self.paths_ignored.remove(event.src_path)
+        if is_download_file(event.src_path) or self.snap.is_ignored(event.src_path):
+            return
+        if self.ignored_events.consume(event.src_path, "created"):
+            logger.debug("ignored creation on {}".format(event.src_path))
+        elif not event.is_directory:
+            self._enqueue("created", event.src_path)
 
     def on_deleted(self, event):
         """Called when a file or directory is deleted.
@@ -588,12 +2537,17 @@ class DirectoryEventHandler(FileSystemEventHandler):
         :type event:
             :class:`DirDeletedEvent` or :class:`FileDeletedEvent`
         """
-        if event.src_path not in self.paths_ignored:
-            if not event.is_directory:
-                self.cmd.delete_file(event.src_path)
+        if is_download_file(event.src_path) or self.snap.is_ignored(event.src_path):
+            return
+        if self.ignored_events.consume(event.src_path, "deleted"):
+            logger.debug("ignored deletion on {}".format(event.src_path))
+        elif not event.is_directory:
+            self._enqueue("deleted", event.src_path)
         else:
-            logger.debug("".format("ignored deletion on ", event.src_path))
-            self.paths_ignored.remove(event.src_path)
+            # a directory moved out of the tree arrives without the
+            # deletions of its files
+            for file_path in self.snap.files_in_dir(event.src_path):
+                self._enqueue("deleted", file_path)
 
     def on_modified(self, event):
         """Called when a file or directory is modified.
@@ -604,20 +2558,54 @@ class DirectoryEventHandler(FileSystemEventHandler):
             :class:`DirModifiedEvent` or :class:`FileModifiedEvent`
         """
 
-        if event.src_path not in self.paths_ignored:
-            if not event.is_directory:
-                self.cmd.upload_file(event.src_path, put_file=True)
-        else:
-            logger.debug("".format("ignored modified on ", event.src_path))
-            self.paths_ignored.remove(event.src_path)
+        if isinstance(event, TreeRescanEvent):
+            self.rescan()
+            return
+        if is_download_file(event.src_path) or self.snap.is_ignored(event.src_path):
+            return
+        if self.ignored_events.consume(event.src_path, "modified"):
+            logger.debug("ignored modified on {}".format(event.src_path))
+        elif not event.is_directory:
+            self._enqueue("modified", event.src_path)
+
+    def rescan(self):
+        """ the events of the observer were lost, queue the changes of the files on disk """
+        for action, abs_path in self.snap.changed_files():
+            self._enqueue(action, abs_path)
+
 
 
 class DirSnapshotManager(object):
-    def __init__(self, snapshot_file_path):
+    def __init__(self, snapshot_file_path, ignore_rules=None, selective_sync=None):
         """ load the last global snapshot and create a instant_snapshot of local directory"""
         self.snapshot_file_path = snapshot_file_path
+        self.ignore_rules = ignore_rules or IgnoreRules()
+        self.selective_sync = selective_sync or SelectiveSync()
         self.last_status = self._load_status()
-        self.local_full_snapshot = self.instant_snapshot()
+        # md5 of the files not in merkle_tree yet: { abs_path: (stat, md5) }
+        self.md5_cache = {}
+        self.last_plan = None
+        self.merkle_tree = SnapshotTree()
+        # the stats and md5s of the last run: the startup scan reads only
+        # the files changed since then
+        self.md5_cache_path = os.path.splitext(snapshot_file_path)[0] + "_md5_cache.json"
+        self.md5_cache_saved = 0
+        self._load_md5_cache()
+        self.merkle_tree = self._scan_tree()
+        # the files deleted meanwhile
+        self.md5_cache = {}
+
+    @property
+    def local_full_snapshot(self):
+        """ the { md5: [path] } view of merkle_tree, the one structure of the local files """
+        return self.merkle_tree.index
+
+    @local_full_snapshot.setter
+    def local_full_snapshot(self, snapshot):
+        if isinstance(snapshot, Md5Index):
+            self.merkle_tree = snapshot.tree
+        else:
+            self.merkle_tree = SnapshotTree.from_snapshot(snapshot)
 
     def local_check(self):
         """ check id daemon is synchronized with local directory """
@@ -638,40 +2626,160 @@ class DirSnapshotManager(object):
         with open(self.snapshot_file_path) as f:
             return json.load(f)
 
+    def _load_md5_cache(self):
+        """ load the saved md5 cache as files not in merkle_tree yet """
+        try:
+            with open(self.md5_cache_path) as f:
+                files = json.load(f)["files"]
+        except (IOError, ValueError, KeyError):
+            return
+        for rel_path, file_md5, size, mtime, inode in files:
+            self.md5_cache[get_abspath(rel_path.encode("utf-8"))] = (
+                pack_stat(size, mtime, inode), str(file_md5))
+
+    def save_md5_cache(self, now=None):
+        """
+        save the stat and md5 of every file of merkle_tree, if they changed
+        and the last save is MD5_CACHE_SAVE_INTERVAL seconds old (now=None
+        saves them anyway)
+        """
+        if not self.merkle_tree.dirty:
+            return
+        if now is not None and now - self.md5_cache_saved < MD5_CACHE_SAVE_INTERVAL:
+            return
+        files = [[path, file_md5] + list(unpack_stat(stat))
+                 for path, file_md5, stat in self.merkle_tree.iter_stats()]
+        # a daemon killed while writing leaves the previous cache
+        tmp_path = self.md5_cache_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"files": files}, f)
+        os.rename(tmp_path, self.md5_cache_path)
+        self.merkle_tree.dirty = False
+        self.md5_cache_saved = now or time.time()
+
+    def _stat_key(self, stat):
+        return pack_stat(stat.st_size, stat.st_mtime, stat.st_ino)
+
+    def _cached(self, abs_path):
+        """ the (stat, md5) cached for a file, in merkle_tree or not there yet """
+        cached = self.md5_cache.get(abs_path)
+        if cached is not None:
+            return cached
+        rel_path = get_relpath(abs_path)
+        file_md5 = self.merkle_tree.get_md5(rel_path)
+        if file_md5 is None:
+            return None
+        return self.merkle_tree.get_stat(rel_path), file_md5
+
+    def cached_md5(self, abs_path, stat_key=None):
+        """
+        return the md5 of a file if it's cached and still valid, else None;
+        stat_key (the packed size, mtime, inode) saves the stat if it's
+        already known
+        """
+        cached = self._cached(abs_path)
+        if cached is None or cached[0] is None:
+            return None
+        if stat_key is None:
+            try:
+                stat_key = self._stat_key(os.stat(abs_path))
+            except OSError:
+                return None
+        if cached[0] != stat_key:
+            return None
+        return cached[1]
+
+    def cache_md5(self, abs_path, file_md5, stat):
+        """
+        cache the md5 of a file as it was when stat was taken: in the
+        entry of merkle_tree if it has that md5, else until it's added
+        """
+        try:
+            if self._stat_key(os.stat(abs_path)) != self._stat_key(stat):
+                return  # changed after the hash
+        except OSError:
+            return
+        rel_path = get_relpath(abs_path)
+        if self.merkle_tree.get_md5(rel_path) == file_md5:
+            self.merkle_tree.set_stat(rel_path, self._stat_key(stat))
+            self.md5_cache.pop(abs_path, None)
+        else:
+            self.merkle_tree.set_stat(rel_path, None)
+            self.md5_cache[abs_path] = (self._stat_key(stat), file_md5)
+
+    def _add_file(self, abs_path, rel_path):
+        """ add a file to merkle_tree with its md5, and the stat it was computed at """
+        file_md5 = self.file_snapMd5(abs_path)
+        cached = self.md5_cache.get(abs_path)
+        stat = None
+        if cached is not None and cached[1] == file_md5:
+            stat = self.md5_cache.pop(abs_path)[0]
+        self.merkle_tree.add_file(rel_path, file_md5, stat)
+        return file_md5
+
     def file_snapMd5(self, file_path):
-        """ calculate the md5 of a file """
+        """ calculate the md5 of a file, reading it only when it changed since the last time """
         file_path = get_abspath(file_path)
-        file_md5 = hashlib.md5()
         if os.path.isdir(file_path):
             return False
+        cached = self.cached_md5(file_path)
+        if cached is not None:
+            return cached
+        file_md5 = hashlib.md5()
         with open(file_path, 'rb') as afile:
-            buf = afile.read(2048)
+            stat = os.fstat(afile.fileno())
+            buf = afile.read(READ_BLOCK_SIZE)
             while len(buf) > 0:
                 file_md5.update(buf)
-                buf = afile.read(2048)
+                buf = afile.read(READ_BLOCK_SIZE)
+        self.cache_md5(file_path, file_md5.hexdigest(), stat)
         return file_md5.hexdigest()
 
     def global_md5(self):
-        """ calculate the global md5 of local_full_snapshot """
-        for k, v in self.local_full_snapshot.items():
-            v.sort()
-        snap_list = sorted(list(self.local_full_snapshot.items()))
-        return hashlib.md5(str(snap_list)).hexdigest()
+        """ return the global md5 of local_full_snapshot (the root hash of merkle_tree) """
+        return self.merkle_tree.root_hash()
+
+    def is_ignored(self, path, is_dir=False):
+        """
+        check if a path (absolute or relative) matches the ignore rules or
+        is out of the selective sync; a directory is ignored only if all
+        its content is
+        """
+        rel_path = get_relpath(path).replace(os.path.sep, "/")
+        if is_dir:
+            excluded = self.selective_sync.excludes_subtree(rel_path)
+        else:
+            excluded = self.selective_sync.excludes(rel_path)
+        return excluded or self.ignore_rules.match(rel_path, is_dir)
 
     def instant_snapshot(self):
-        """ create a snapshot of directory """
-
-        dir_snapshot = {}
-        for root, dirs, files in os.walk(CONFIG_DIR_PATH):
-            for f in files:
-                full_path = os.path.join(root, f)
-                file_md5 = self.file_snapMd5(full_path)
-                rel_path = get_relpath(full_path)
-                if file_md5 in dir_snapshot:
-                    dir_snapshot[file_md5].append(rel_path)
-                else:
-                    dir_snapshot[file_md5] = [rel_path]
-        return dir_snapshot
+        """ create a snapshot of directory, the { md5: [path] } view of a new tree """
+        return self._scan_tree().index
+
+    def _walker(self):
+        return TreeWalker(
+            # the ignored directories are not even listed
+            skip_dir=lambda path: self.is_ignored(path, True),
+            skip_file=lambda path: is_download_file(path) or self.is_ignored(path),
+        )
+
+    def _scan_tree(self):
+        """ walk the directory into a SnapshotTree, hashing only the changed files """
+
+        def files():
+            for record in self._walker().walk(CONFIG_DIR_PATH):
+                full_path = record.path
+                # the stat of the walk tells if the cached md5 is still valid
+                stat = pack_stat(record.size, record.mtime, record.inode)
+                file_md5 = self.cached_md5(full_path, stat)
+                if file_md5 is None:
+                    file_md5 = self.file_snapMd5(full_path)
+                    cached = self._cached(full_path)
+                    stat = cached[0] if cached is not None and cached[1] == file_md5 else None
+                # in the tree from now on
+                self.md5_cache.pop(full_path, None)
+                yield get_relpath(full_path), file_md5, stat
+        return SnapshotTree.from_files(files())
 
     def save_snapshot(self, timestamp):
         """ save snapshot to file """
@@ -681,41 +2789,89 @@ class DirSnapshotManager(object):
         with open(self.snapshot_file_path, 'w') as f:
             f.write(
                 json.dumps({"timestamp": timestamp, "snapshot": self.last_status['snapshot']}))
+        self.save_md5_cache(time.time())
 
     def update_snapshot_upload(self, body):
         """ update of local full snapshot by upload request"""
-        self.local_full_snapshot[self.file_snapMd5(body['src_path'])] = [get_relpath(body["src_path"])]
+        self._add_file(get_abspath(body["src_path"]), get_relpath(body["src_path"]))
 
     def update_snapshot_update(self, body):
         """ update of local full snapshot by update request"""
-        #delete the old path from full snapshot
-        self.update_snapshot_delete(body)
-        new_file_md5 = self.file_snapMd5(body['src_path'])
-        if new_file_md5 in self.local_full_snapshot:
-            #is a copy of another file
-            self.local_full_snapshot[new_file_md5].append(get_relpath(body['src_path']))
-        else:
-            #else create a new md5
-            self.local_full_snapshot[new_file_md5] = [get_relpath(body['src_path'])]
+        # the tree moves the path from the old md5 to the new one
+        self._add_file(get_abspath(body["src_path"]), get_relpath(body["src_path"]))
 
     def update_snapshot_copy(self, body):
-        """ update of local full snapshot by copy request"""
-        self.local_full_snapshot[self.file_snapMd5(body['src_path'])].append(get_relpath(body["dst_path"]))
+        """ update of local full snapshot by copy request (also over an existing path)"""
+        file_md5 = self.file_snapMd5(body['src_path'])
+        dst_path = get_relpath(body["dst_path"])
+        cached = self.md5_cache.get(get_abspath(dst_path))
+        stat = None
+        if cached is not None and cached[1] == file_md5:
+            stat = self.md5_cache.pop(get_abspath(dst_path))[0]
+        self.merkle_tree.add_file(dst_path, file_md5, stat)
 
     def update_snapshot_move(self, body):
         """ update of local full snapshot by move request"""
-        paths_of_file = self.local_full_snapshot[self.file_snapMd5(get_abspath(body["dst_path"]))]
-        paths_of_file.remove(get_relpath(body["src_path"]))
-        paths_of_file.append(get_relpath(body["dst_path"]))
+        src_path = get_relpath(body["src_path"])
+        dst_path = get_relpath(body["dst_path"])
+        cached = self.md5_cache.pop(get_abspath(src_path), None)
+        if cached is not None:
+            self.md5_cache[get_abspath(dst_path)] = cached
+        removed = self.merkle_tree.remove_file(src_path)
+        if removed is not None:
+            # a rename keeps size, mtime and inode: the md5 is not computed again
+            self.merkle_tree.add_file(dst_path, removed[0], removed[1])
+        self._add_file(get_abspath(dst_path), dst_path)
+
+    def update_snapshot_move_dir(self, body):
+        """ update of local full snapshot by directory move request, all the paths under it at once"""
+        src_dir = get_relpath(body["src_path"]).rstrip("/")
+        dst_dir = get_relpath(body["dst_path"]).rstrip("/")
+        src_prefix = get_abspath(src_dir) + "/"
+        for abs_path in [p for p in self.md5_cache if p.startswith(src_prefix)]:
+            self.md5_cache[get_abspath(dst_dir) + abs_path[len(src_prefix) - 1:]] = \
+                self.md5_cache.pop(abs_path)
+        # the entries of the files follow their directory nodes
+        self.merkle_tree.move_dir(src_dir, dst_dir)
+
+    def changed_files(self):
+        """
+        walk the directory and return the (action, abs_path) of the files
+        that differ from the snapshot, "created", "modified" or "deleted";
+        only the files whose stat changed are read
+        """
+        changes = []
+        for record in self._walker().walk(CONFIG_DIR_PATH):
+            file_md5 = self.merkle_tree.get_md5(get_relpath(record.path))
+            if file_md5 is None:
+                changes.append(("created", record.path))
+            elif self.cached_md5(
+                    record.path, pack_stat(record.size, record.mtime, record.inode)) is None:
+                try:
+                    if self.file_snapMd5(record.path) != file_md5:
+                        changes.append(("modified", record.path))
+                except (IOError, OSError):
+                    # deleted while it was walked, found below
+                    pass
+        for rel_path, _ in self.merkle_tree.iter_files():
+            abs_path = get_abspath(rel_path)
+            if not os.path.isfile(abs_path):
+                changes.append(("deleted", abs_path))
+        return changes
+
+    def path_in_snapshot(self, abs_path):
+        """ check if a file is in the local snapshot """
+        return self.merkle_tree.get_md5(get_relpath(abs_path)) is not None
+
+    def files_in_dir(self, abs_dir_path):
+        """ return the absolute paths of the files in snapshot under abs_dir_path """
+        dir_path = get_relpath(abs_dir_path).rstrip("/")
+        return [get_abspath(path) for path, _ in self.merkle_tree.iter_files(dir_path)]
 
     def update_snapshot_delete(self, body):
         """ update of local full snapshot by delete request"""
-        md5_file = self.find_file_md5(self.local_full_snapshot, get_relpath(body['src_path']), False)
-        logger.debug("find md5: " + md5_file)
-        if len(self.local_full_snapshot[md5_file]) == 1:
-            del self.local_full_snapshot[md5_file]
-        else:
-            self.local_full_snapshot[md5_file].remove(get_relpath(body['src_path']))
+        self.merkle_tree.remove_file(get_relpath(body['src_path']))
+        self.md5_cache.pop(get_abspath(body['src_path']), None)
         logger.debug("path deleted: " + get_relpath(body['src_path']))
 
     def save_timestamp(self, timestamp):
@@ -727,6 +2883,7 @@ class DirSnapshotManager(object):
             self.last_status['timestamp'] = timestamp
             with open(self.snapshot_file_path, 'w') as f:
                 f.write(json.dumps(self.last_status, f))
+        self.save_md5_cache(time.time())
 
     def diff_snapshot_paths(self, snap_client, snap_server):
         """
@@ -755,19 +2912,209 @@ class DirSnapshotManager(object):
                     if path == new_path:
                         return md5
 
+    def merkle_diff(self, server_root, get_server_node):
+        """
+            from the server root node descend only the directories whose hash
+            differs from the local one and return the 2 snapshots of the files
+            that differ (or exist only on one side) and the directories to
+            compare with the snapshot streamed by the server:
+                server_snapshot = { md5: [{"path": path, "timestamp": timestamp}] }
+                client_snapshot = { md5: [path] }
+                stream_dirs = [dir_path]
+            the directories only on server are streamed, so are all the files
+            ([""]) once more than SYNC_BATCH_SIZE differ
+            get_server_node(dir_path) return the server node of a directory
+            or None
+        """
+        server_snapshot = {}
+        client_snapshot = {}
+        stream_dirs = []
+        # different files found so far
+        differ = [0]
+
+        def join(dir_path, name):
+            return "/".join([dir_path, name]) if dir_path else name
+
+        def add_server_file(path, meta):
+            server_snapshot.setdefault(meta["md5"], []).append(
+                {"path": path, "timestamp": meta["timestamp"], "size": meta.get("size")})
+            differ[0] += 1
+
+        def add_client_file(path, file_md5):
+            client_snapshot.setdefault(file_md5, []).append(path)
+            differ[0] += 1
+
+        to_visit = [("", server_root)]
+        while to_visit:
+            if differ[0] > SYNC_BATCH_SIZE:
+                return {}, {}, [""]
+            dir_path, server_node = to_visit.pop()
+            local_node = self.merkle_tree.dirs.get(dir_path, self.merkle_tree._new_node())
+            server_files = server_node["files"] if server_node else {}
+            server_dirs = server_node["dirs"] if server_node else {}
+
+            for name, meta in server_files.items():
+                if local_node["files"].get(name) != meta["md5"]:
+                    add_server_file(join(dir_path, name), meta)
+            for name, file_md5 in local_node["files"].items():
+                if name not in server_files or server_files[name]["md5"] != file_md5:
+                    add_client_file(join(dir_path, name), file_md5)
+
+            for name, server_hash in server_dirs.items():
+                sub_dir = join(dir_path, name)
+                if self.is_ignored(sub_dir, True):
+                    # not even listed, it can be a huge shared folder
+                    continue
+                local_sub_dir = self.merkle_tree.dirs.get(sub_dir)
+                if local_sub_dir is None:
+                    # only on server, it can be any size
+                    stream_dirs.append(sub_dir)
+                elif local_sub_dir["hash"] != server_hash:
+                    to_visit.append((sub_dir, get_server_node(sub_dir)))
+            for name in local_node["dirs"]:
+                if name not in server_dirs:
+                    for path, file_md5 in self.merkle_tree.iter_files(join(dir_path, name)):
+                        add_client_file(path, file_md5)
+
+        if differ[0] > SYNC_BATCH_SIZE:
+            return {}, {}, [""]
+        return server_snapshot, client_snapshot, stream_dirs
+
+    def merge_snapshots(self, server_files, client_files):
+        """
+            merge the files of the server, {"path": path, "md5": md5,
+            "timestamp": timestamp, "size": size}, and the local ones,
+            (path, md5), both sorted by path, and yield for each path
+            (path, server file or None, local md5 or None)
+        """
+        def unicode_path(path):
+            # the local paths are utf-8 strings, their order is the same
+            if isinstance(path, str):
+                return path.decode("utf-8", "replace")
+            return path
+
+        server_files = iter(server_files)
+        client_files = iter(client_files)
+        server_file = next(server_files, None)
+        client_file = next(client_files, None)
+        while server_file is not None or client_file is not None:
+            if client_file is None:
+                order = -1
+            elif server_file is None:
+                order = 1
+            else:
+                order = cmp(unicode_path(server_file["path"]), unicode_path(client_file[0]))
+            if order < 0:
+                yield server_file["path"], server_file, None
+                server_file = next(server_files, None)
+            elif order > 0:
+                yield client_file[0], None, client_file[1]
+                client_file = next(client_files, None)
+            else:
+                yield server_file["path"], server_file, client_file[1]
+                server_file = next(server_files, None)
+                client_file = next(client_files, None)
+
+    def _dispatch_batch(self, server_timestamp, server_snapshot, client_snapshot,
+                        local_synced, deletes, written):
+        """ commands of a batch of stream_dispatcher, without the deletes """
+        command_list = []
+        for row in self.syncronize_dispatcher(
+                server_timestamp, server_snapshot, client_snapshot, local_synced):
+            command, args = row.items()[0]
+            if command.endswith('_delete'):
+                deletes.append(row)
+                continue
+            if command.startswith('local_'):
+                written.add(args[-1])
+            command_list.append(row)
+        return command_list
+
+    def stream_dispatcher(self, server_timestamp, server_files, dir_path="", local_synced=None):
+        """
+            compare the files of the server, streamed sorted by path, with
+            the local tree in a single pass and yield
+            (command_list, server_snapshot, client_snapshot) for each batch
+            of SYNC_BATCH_SIZE different files: the snapshots have only the
+            files of the batch, as the merkle_diff ones, and the command list
+            is the syncronize_dispatcher one, so a batch can be executed
+            while the rest of the snapshot is still coming.
+            The deletes are yielded last, in a batch of their own: a file
+            moved to a path later in the order is copied before its source
+            is deleted.
+            dir_path is the directory of the streamed files, local_synced
+            the local_check of a sync that already changed the local files
+        """
+        if local_synced is None:
+            local_synced = self.local_check()
+        if local_synced and self.is_syncro(server_timestamp):
+            logger.debug("synchronized")
+            return
+        deletes = []
+        # files written by the commands, the walk of the local tree can
+        # meet them later (a .conflicted copy)
+        written = set()
+        server_snapshot, client_snapshot, batch_size = {}, {}, 0
+        for path, server_file, client_md5 in self.merge_snapshots(
+                server_files, self.merkle_tree.iter_sorted(dir_path)):
+            server_md5 = server_file["md5"] if server_file is not None else None
+            if server_md5 == client_md5 or (server_md5 is None and path in written):
+                continue
+            if server_md5 is not None:
+                server_snapshot.setdefault(server_md5, []).append({
+                    "path": path,
+                    "timestamp": server_file["timestamp"],
+                    "size": server_file.get("size")})
+            if client_md5 is not None:
+                client_snapshot.setdefault(client_md5, []).append(path)
+            batch_size += 1
+            if batch_size >= SYNC_BATCH_SIZE:
+                yield self._dispatch_batch(
+                    server_timestamp, server_snapshot, client_snapshot,
+                    local_synced, deletes, written), server_snapshot, client_snapshot
+                server_snapshot, client_snapshot, batch_size = {}, {}, 0
+        if batch_size:
+            yield self._dispatch_batch(
+                server_timestamp, server_snapshot, client_snapshot,
+                local_synced, deletes, written), server_snapshot, client_snapshot
+        if deletes:
+            yield deletes, {}, {}
+
     def check_files_timestamp(self, snapshot, new_path):
         paths_timestamps = [val for subl in snapshot.values() for val in subl]
         for path_timestamp in paths_timestamps:
             if path_timestamp['path'] == new_path:
                 return path_timestamp['timestamp'] < self.last_status['timestamp']
 
-    def syncronize_dispatcher(self, server_timestamp, server_snapshot):
-        """ return the list of command to do """
+    def _without_ignored(self, server_snapshot):
+        """ copy of a server snapshot without the ignored paths """
+        snapshot = {}
+        for md5, paths in server_snapshot.items():
+            paths = [path for path in paths if not self.is_ignored(path['path'])]
+            if paths:
+                snapshot[md5] = paths
+        return snapshot
+
+    def syncronize_dispatcher(self, server_timestamp, server_snapshot, client_snapshot=None,
+                              local_synced=None):
+        """
+            return the list of command to do
+            client_snapshot restricts the local side of the comparison
+            (default: local_full_snapshot), as the merkle_diff snapshots do
+            local_synced is the local_check of a sync dispatched in more
+            batches, taken before the first one changed the local files
+        """
+        if client_snapshot is None:
+            client_snapshot = self.local_full_snapshot
+        if local_synced is None:
+            local_synced = self.local_check()
+        # the ignored files are neither downloaded nor deleted on server
+        server_snapshot = self._without_ignored(server_snapshot)
         new_client_paths, new_server_paths, equal_paths = self.diff_snapshot_paths(
-            self.local_full_snapshot, server_snapshot)
+            client_snapshot, server_snapshot)
         command_list = []
         #NO internal conflict
-        if self.local_check():  # 1)
+        if local_synced:  # 1)
             if not self.is_syncro(server_timestamp):  # 1) b.
                 for new_server_path in new_server_paths:  # 1) b 1
                     server_md5 = self.find_file_md5(server_snapshot, new_server_path)
@@ -780,7 +3127,7 @@ class DirSnapshotManager(object):
                         command_list.append({'local_copy': [src_local_path, new_server_path]})
 
                 for equal_path in equal_paths:  # 1) b 2
-                    client_md5 = self.find_file_md5(self.local_full_snapshot, equal_path, False)
+                    client_md5 = self.find_file_md5(client_snapshot, equal_path, False)
                     if client_md5 != self.find_file_md5(server_snapshot, equal_path):
                         #in this case i have a simple download because the update is a overwritten
                         logger.debug("update download:\t" + equal_path)
@@ -802,7 +3149,7 @@ class DirSnapshotManager(object):
                     logger.debug("remove:\t" + new_server_path)
                     command_list.append({'remote_delete': [new_server_path]})
                 for equal_path in equal_paths:  # 2) a 2
-                    if self.find_file_md5(self.local_full_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
+                    if self.find_file_md5(client_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
                         logger.debug("update:\t" + equal_path)
                         command_list.append({'remote_update': [equal_path, True]})
                     else:
@@ -827,7 +3174,7 @@ class DirSnapshotManager(object):
                             command_list.append({'local_copy': [src_local_path, new_server_path]})
 
                 for equal_path in equal_paths:  # 2) b 2
-                    if self.find_file_md5(self.local_full_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
+                    if self.find_file_md5(client_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
                         if self.check_files_timestamp(server_snapshot, equal_path):  # 2) b 2 I
                             logger.debug("server push:\t" + equal_path)
                             command_list.append({'remote_upload': [equal_path]})
@@ -847,6 +3194,145 @@ class DirSnapshotManager(object):
 
         return command_list
 
+    def optimize_plan(self, command_list, server_snapshot, client_snapshot=None):
+        """
+            rewrite the command list of syncronize_dispatcher:
+                a content missing locally is downloaded once, the other paths
+                with the same md5 are local copies (from a local file, when
+                one already has it)
+                the upload of a content the server already has is a server
+                side copy
+                the small files are transferred before the large ones
+                the downloads carry the md5 of the content, to find it
+                in the blob cache
+            order: copies of the current local files, downloads, copies of
+            the downloaded files, local deletes, then remote copies, uploads,
+            copies of the uploaded files, remote deletes.
+            self.last_plan has the number of commands and the bytes to transfer
+            (the local files are looked up by path in the merkle tree and by
+            md5 in the snapshot, the work is bounded by the batch)
+        """
+        if client_snapshot is None:
+            client_snapshot = self.local_full_snapshot
+        server_files = {}
+        for file_md5, entries in server_snapshot.items():
+            for entry in entries:
+                server_files[entry['path']] = (file_md5, entry.get('size'))
+        local_md5 = self.merkle_tree.get_md5
+        changed_paths = set(path for paths in client_snapshot.values() for path in paths)
+
+        unknown = []            # commands run first, as they are
+        writes = collections.OrderedDict()  # md5: [(path, original command)]
+        planned = {}            # path: md5 of its content after the local commands
+        local_deletes = []
+        uploads = collections.OrderedDict()  # md5: [(path, original command)]
+        remote_deletes = []
+        for row in command_list:
+            for command, args in row.items():
+                if command == 'local_download':
+                    file_md5 = server_files.get(args[0], (None, None))[0]
+                elif command == 'local_copy':
+                    file_md5 = planned.get(args[0], local_md5(args[0]))
+                elif command == 'local_delete':
+                    local_deletes.append(row)
+                    planned[args[0]] = None
+                    continue
+                elif command == 'remote_delete':
+                    remote_deletes.append(row)
+                    continue
+                elif command in ('remote_upload', 'remote_update'):
+                    file_md5 = planned.get(args[0], local_md5(args[0]))
+                    uploads.setdefault(file_md5, []).append((args[0], row))
+                    continue
+                else:
+                    unknown.append(row)
+                    continue
+                path = args[-1]
+                if file_md5 is None:
+                    unknown.append(row)
+                else:
+                    writes.setdefault(file_md5, []).append((path, row))
+                planned[path] = file_md5
+
+        def file_size(path, size=None):
+            if size is not None:
+                return size
+            try:
+                return os.path.getsize(get_abspath(path))
+            except OSError:
+                return None
+
+        def by_size(item):
+            return item[0] is None, item[0]
+
+        first_copies, downloads, later_copies = [], [], []
+        for file_md5, targets in writes.items():
+            # a local source not overwritten by the plan
+            sources = sorted(
+                path for path in self.local_full_snapshot.get(file_md5, ()) if path not in planned)
+            src_path = sources[0] if sources else None
+            if src_path is None:
+                on_server = [path for path, _ in targets if server_files.get(path, (None,))[0] == file_md5]
+                if not on_server:
+                    unknown.extend(row for _, row in targets)
+                    continue
+                src_path = on_server[0]
+                downloads.append((file_size(src_path, server_files[src_path][1]), src_path))
+                copies = later_copies
+            else:
+                copies = first_copies
+            copies.extend(
+                {'local_copy': [src_path, path]} for path, _ in targets if path != src_path)
+
+        def remote_source(file_md5):
+            """
+            a server file that is also local with file_md5 after the local
+            commands: on the server with it in the batch, or out of the batch
+            (neither side changed it) and local with it
+            """
+            paths = set(entry['path'] for entry in server_snapshot.get(file_md5, ()))
+            paths.update(self.local_full_snapshot.get(file_md5, ()))
+            for path in sorted(paths):
+                if path in server_files:
+                    if server_files[path][0] != file_md5:
+                        continue
+                elif path in changed_paths:
+                    continue
+                if planned.get(path, local_md5(path)) == file_md5:
+                    return path
+            return None
+
+        remote_copies, to_upload, uploaded_copies = [], [], []
+        for file_md5, sources in uploads.items():
+            src_path = remote_source(file_md5) if file_md5 is not None else None
+            if src_path is not None:
+                remote_copies.extend(
+                    {'remote_copy': [src_path, path]} for path, _ in sources if path != src_path)
+                continue
+            if file_md5 is None:
+                to_upload.extend((file_size(path), row) for path, row in sources)
+                continue
+            first_path, first_row = sources[0]
+            to_upload.append((file_size(first_path), first_row))
+            uploaded_copies.extend(
+                {'remote_copy': [first_path, path]} for path, _ in sources[1:])
+
+        downloads.sort(key=by_size)
+        to_upload.sort(key=by_size)
+        plan = (unknown + first_copies +
+                [{'local_download': [path, server_files[path][0]]} for _, path in downloads] +
+                later_copies + local_deletes +
+                remote_copies + [row for _, row in to_upload] + uploaded_copies +
+                remote_deletes)
+        self.last_plan = {
+            "commands": len(plan),
+            "download_bytes": sum(size or 0 for size, _ in downloads),
+            "upload_bytes": sum(size or 0 for size, _ in to_upload),
+        }
+        logger.info("sync plan: {commands} commands, {download_bytes} bytes to download, "
+                    "{upload_bytes} bytes to upload".format(**self.last_plan))
+        return plan
+
 
 class CommandExecuter(object):
 
@@ -872,6 +3358,7 @@ class CommandExecuter(object):
                     {
                         'upload': self.remote.upload_file,
                         'update': self.remote.upload_file,
+                        'copy': self.remote.copy_file,
                         'delete': self.remote.delete_file,
                     }.get(command_type, error)(*(command_row[command]))
                 else:
@@ -882,6 +3369,22 @@ class CommandExecuter(object):
                     }.get(command_type, error)(*(command_row[command]))
 
 
+def create_observer(watcher):
+    """
+    return the file system observer selected in config.ini:
+    "inotify", "polling" or "auto" (inotify when the system supports it)
+    """
+    if watcher not in ("auto", "inotify", "polling"):
+        logger.warning("unknown watcher {}, using auto".format(watcher))
+        watcher = "auto"
+    if watcher != "polling":
+        if inotify_available():
+            return InotifyObserver()
+        if watcher == "inotify":
+            logger.warning("inotify not available, using polling")
+    return PollingObserver()
+
+
 def logger_init(crash_repo_path, stdout_level, file_level, disabled=False):
     log_levels = {
         "DEBUG": logging.DEBUG,
@@ -945,6 +3448,8 @@ def main():
 
     snapshot_manager = DirSnapshotManager(
         snapshot_file_path=config['snapshot_file_path'],
+        ignore_rules=IgnoreRules.from_file(os.path.join(config['dir_path'], IGNORE_FILE)),
+        selective_sync=SelectiveSync.from_config(config['sync_exclude'], config['sync_include']),
     )
 
     server_com = ServerCommunicator(
@@ -971,27 +3476,55 @@ def main():
         server_url=config['server_url'],
         username=config['username'],
         password=config['password'],
-        snapshot_manager=snapshot_manager)
-
-    event_handler = DirectoryEventHandler(server_com, snapshot_manager)
-    file_system_op = FileSystemOperator(event_handler, server_com, snapshot_manager)
+        snapshot_manager=snapshot_manager,
+        max_retries=MAX_RETRIES,
+        retry_base_delay=float(config['retry_base_delay']),
+        retry_max_delay=float(config['retry_max_delay']),
+        upload_limit=float(config['upload_limit']),
+        download_limit=float(config['download_limit']))
+
+    # local changes reach the server through the outbox, so the daemon
+    # doesn't block while the server is unreachable
+    outbox = Outbox(config['outbox_file_path'], server_com)
+    event_handler = DirectoryEventHandler(
+        outbox, snapshot_manager, settle_window=float(config['settle_window']))
+    blob_cache = None
+    if float(config['blob_cache_size']) > 0:
+        blob_cache = BlobCache(
+            blob_cache_path(config['blob_cache_path'], config['snapshot_file_path']),
+            int(float(config['blob_cache_size']) * 1024 * 1024),
+            sync_root=config['dir_path'])
+    file_system_op = FileSystemOperator(
+        event_handler, server_com, snapshot_manager, blob_cache=blob_cache)
     executer = CommandExecuter(file_system_op, server_com)
     server_com.setExecuter(executer)
-    observer = Observer()
+    observer = create_observer(config['watcher'])
     observer.schedule(event_handler, config['dir_path'], recursive=True)
 
+    scheduler = SyncScheduler(
+        min_interval=float(config['sync_min_interval']),
+        max_interval=float(config['sync_max_interval']))
+    sync_worker = SyncWorker(
+        event_handler, outbox, server_com, file_system_op, scheduler)
+    client_command["status"] = sync_worker.status
+    client_command["set_limits"] = server_com.set_limits
+
     observer.start()
+    outbox.start()
+    sync_worker.start()
 
-    last_synk_time = 0
+    # the main thread only serves the command socket
     try:
         while True:
-            asyncore.poll(timeout=5.0)
-            if (time.time() - last_synk_time) >= 5.0:
-                last_synk_time = time.time()
-                server_com.synchronize(file_system_op)
+            asyncore.poll(timeout=1.0)
     except KeyboardInterrupt:
         observer.stop()
+        outbox.stop()
+        sync_worker.stop()
     observer.join()
+    outbox.join()
+    sync_worker.join()
+    snapshot_manager.save_md5_cache()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Event driven observer for linux, built on inotify.
+
+watchdog's inotify observer loses the IN_MOVED_FROM half of a move when
+the destination is outside the watched tree (a file dragged to the trash),
+that's why the daemon used to poll. This emitter pairs IN_MOVED_FROM and
+IN_MOVED_TO by cookie itself: a pair is a move, a lonely IN_MOVED_FROM is a
+deletion and a lonely IN_MOVED_TO is a creation.
+
+When the kernel queue overflows the lost events can't be recovered: the
+tree is watched again and a TreeRescanEvent of the root asks the handlers
+to compare it with the state they know, as a polling emitter compares two
+snapshots.
+
+Subtrees where inotify can't be used (watch limit reached or remote
+filesystems like nfs and cifs, where no event is delivered for changes made
+by other hosts) are handed to a watchdog PollingEmitter, the rest of the
+tree stays event driven.
+"""
+
+from watchdog.observers.api import BaseObserver
+from watchdog.observers.api import EventEmitter
+from watchdog.observers.api import DEFAULT_OBSERVER_TIMEOUT
+from watchdog.observers.api import DEFAULT_EMITTER_TIMEOUT
+from watchdog.observers.api import ObservedWatch
+from watchdog.observers.polling import PollingEmitter
+from watchdog.events import FileCreatedEvent
+from watchdog.events import FileDeletedEvent
+from watchdog.events import FileModifiedEvent
+from watchdog.events import FileMovedEvent
+from watchdog.events import DirCreatedEvent
+from watchdog.events import DirDeletedEvent
+from watchdog.events import DirModifiedEvent
+from watchdog.events import DirMovedEvent
+import ctypes.util
+import ctypes
+import logging
+import select
+import struct
+import errno
+import time
+import sys
+import os
+
+logger = logging.getLogger('RawBox')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# seconds to wait for the IN_MOVED_TO matching an IN_MOVED_FROM
+MOVE_PAIRING_DELAY = 0.5
+
+REMOTE_FILESYSTEMS = set([
+    "nfs", "nfs4", "cifs", "smbfs", "smb3", "9p", "afs", "ncpfs", "coda",
+    "fuse.sshfs", "fuse.gvfsd-fuse", "fuse.s3fs", "davfs", "glusterfs",
+    "ceph", "lustre",
+])
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+libc = _load_libc()
+
+
+def inotify_available():
+    """ return True if the kernel inotify api can be used """
+    return libc is not None
+
+
+def _unescape_mount_path(path):
+    """ /proc/mounts escapes spaces, tabs, newlines and backslashes in octal """
+    for escaped, char in (("\\040", " "), ("\\011", "\t"),
+                          ("\\012", "\n"), ("\\134", "\\")):
+        path = path.replace(escaped, char)
+    return path
+
+
+def remote_mounts(mounts_file="/proc/mounts"):
+    """ return the set of mount points with a remote filesystem """
+    mount_points = set()
+    try:
+        with open(mounts_file) as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] in REMOTE_FILESYSTEMS:
+                    mount_points.add(_unescape_mount_path(fields[1]))
+    except IOError:
+        pass
+    return mount_points
+
+
+def parse_events(buf):
+    """ split a buffer read from the inotify fd in (wd, mask, cookie, name) """
+    events = []
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(buf):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+        offset += EVENT_HEADER.size
+        name = buf[offset:offset + length].rstrip("\0")
+        offset += length
+        events.append((wd, mask, cookie, name))
+    return events
+
+
+class TreeRescanEvent(DirModifiedEvent):
+    """
+    the events under src_path were lost, a handler unaware of it sees the
+    modification of the directory
+    """
+
+
+class _SubtreePollingEmitter(PollingEmitter):
+    """
+    PollingEmitter for a subtree of a watch, it queues the events under
+    the parent watch so they reach the handlers scheduled on it
+    """
+
+    def __init__(self, event_queue, parent_watch, path, timeout):
+        PollingEmitter.__init__(
+            self, event_queue, ObservedWatch(path, True), timeout)
+        self._parent_watch = parent_watch
+
+    def queue_event(self, event):
+        self._event_queue.put((event, self._parent_watch))
+
+
+class InotifyEmitter(EventEmitter):
+    """
+    inotify emitter for a recursive watch, with polling fallback for the
+    subtrees that can't be watched
+    """
+
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT,
+                 polling_interval=1):
+        EventEmitter.__init__(self, event_queue, watch, timeout)
+        self.polling_interval = polling_interval
+        self.remote_mounts = remote_mounts()
+        self.wd_paths = {}
+        self.path_wds = {}
+        self.fallbacks = {}
+        self.moved_from = {}
+        root = watch.path
+        if isinstance(root, unicode):
+            root = root.encode(sys.getfilesystemencoding())
+        self.root = root
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            logger.warning("inotify unavailable ({}), polling {}".format(
+                os.strerror(ctypes.get_errno()), root))
+            self.fd = None
+            self._add_fallback(root)
+        elif any(root.startswith(mount + os.sep)
+                 for mount in self.remote_mounts):
+            logger.info("{} is on a remote filesystem, polling it".format(root))
+            self._add_fallback(root)
+        else:
+            self._watch_tree(root)
+
+    def _add_fallback(self, path):
+        """ poll the subtree rooted in path """
+        emitter = _SubtreePollingEmitter(
+            self._event_queue, self.watch, path, self.polling_interval)
+        self.fallbacks[path] = emitter
+        if self.is_alive():
+            emitter.start()
+
+    def _remove_fallbacks(self, path):
+        """ stop polling subtrees under path, return their paths """
+        removed = []
+        for fallback_path in self.fallbacks.keys():
+            if fallback_path == path or fallback_path.startswith(path + os.sep):
+                self.fallbacks.pop(fallback_path).stop()
+                removed.append(fallback_path)
+        return removed
+
+    def _add_watch(self, path):
+        """
+        add an inotify watch to a single directory
+        return False when the directory must be polled
+        """
+        if path in self.remote_mounts:
+            logger.info("{} is a remote filesystem, polling it".format(path))
+            return False
+        wd = libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.warning(
+                    "inotify watch limit reached (see /proc/sys/fs/inotify/"
+                    "max_user_watches), polling {}".format(path))
+                return False
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return True
+            logger.warning("unable to watch {}: {}, polling it".format(
+                path, os.strerror(err)))
+            return False
+        self.wd_paths[wd] = path
+        self.path_wds[path] = wd
+        return True
+
+    def _watch_tree(self, root, created=False):
+        """
+        watch every directory under root,
+        with created=True queue a creation event for everything found
+        (the content was created before the watch existed)
+        """
+        dirs = [root]
+        while dirs:
+            dir_path = dirs.pop()
+            if dir_path in self.fallbacks:
+                continue
+            if not self._add_watch(dir_path):
+                self._add_fallback(dir_path)
+                if created:
+                    self._queue_tree(dir_path, FileCreatedEvent, DirCreatedEvent)
+                continue
+            try:
+                names = os.listdir(dir_path)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(dir_path, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    dirs.append(path)
+                    if created:
+                        self.queue_event(DirCreatedEvent(path))
+                elif created:
+                    self.queue_event(FileCreatedEvent(path))
+
+    def _queue_tree(self, root, file_event, dir_event):
+        for dir_path, dir_names, file_names in os.walk(root):
+            for name in dir_names:
+                self.queue_event(dir_event(os.path.join(dir_path, name)))
+            for name in file_names:
+                self.queue_event(file_event(os.path.join(dir_path, name)))
+
+    def _forget(self, wd):
+        path = self.wd_paths.pop(wd, None)
+        if path is not None and self.path_wds.get(path) == wd:
+            del self.path_wds[path]
+
+    def _unwatch_tree(self, root):
+        for path in self.path_wds.keys():
+            if path == root or path.startswith(root + os.sep):
+                wd = self.path_wds[path]
+                libc.inotify_rm_watch(self.fd, wd)
+                self._forget(wd)
+        self._remove_fallbacks(root)
+
+    def _rename_tree(self, src_root, dest_root):
+        """ a watched directory was moved, the watches follow the inodes """
+        for wd, path in self.wd_paths.items():
+            if path == src_root or path.startswith(src_root + os.sep):
+                new_path = dest_root + path[len(src_root):]
+                self._forget(wd)
+                self.wd_paths[wd] = new_path
+                self.path_wds[new_path] = wd
+        for path in self._remove_fallbacks(src_root):
+            self._add_fallback(dest_root + path[len(src_root):])
+
+    def _moved_away(self, path, is_dir):
+        """ the source of a move without destination in the watched tree """
+        if is_dir:
+            self._unwatch_tree(path)
+            self.queue_event(DirDeletedEvent(path))
+        else:
+            self.queue_event(FileDeletedEvent(path))
+
+    def _rescan(self):
+        """
+        after an overflow: forget the directories removed, watch the ones
+        created meanwhile and queue a TreeRescanEvent of the root
+        """
+        for wd, path in self.wd_paths.items():
+            if not os.path.isdir(path):
+                libc.inotify_rm_watch(self.fd, wd)
+                self._forget(wd)
+        # the other half of these moves can be lost too, the rescan finds them
+        self.moved_from.clear()
+        self._watch_tree(self.root)
+        self.queue_event(TreeRescanEvent(self.root))
+
+    def _process_event(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify queue overflow, rescanning {}".format(self.root))
+            self._rescan()
+            return
+        dir_path = self.wd_paths.get(wd)
+        if dir_path is None:
+            return
+        if mask & IN_IGNORED:
+            self._forget(wd)
+            return
+        if not name:
+            return
+        path = os.path.join(dir_path, name)
+        is_dir = bool(mask & IN_ISDIR)
+
+        if mask & IN_CREATE:
+            if is_dir:
+                self.queue_event(DirCreatedEvent(path))
+                self._watch_tree(path, created=True)
+            else:
+                self.queue_event(FileCreatedEvent(path))
+        elif mask & IN_CLOSE_WRITE:
+            self.queue_event(FileModifiedEvent(path))
+        elif mask & IN_DELETE:
+            if is_dir:
+                self._unwatch_tree(path)
+                self.queue_event(DirDeletedEvent(path))
+            else:
+                self.queue_event(FileDeletedEvent(path))
+        elif mask & IN_MOVED_FROM:
+            self.moved_from[cookie] = (path, is_dir, time.time())
+        elif mask & IN_MOVED_TO:
+            moved = self.moved_from.pop(cookie, None)
+            if moved is None:
+                if is_dir:
+                    self.queue_event(DirCreatedEvent(path))
+                    self._watch_tree(path, created=True)
+                else:
+                    self.queue_event(FileCreatedEvent(path))
+            elif is_dir:
+                src_root = moved[0]
+                self._rename_tree(src_root, path)
+                self.queue_event(DirMovedEvent(src_root, path))
+                for sub_dir, dir_names, file_names in os.walk(path):
+                    for file_name in file_names:
+                        dest_path = os.path.join(sub_dir, file_name)
+                        self.queue_event(FileMovedEvent(
+                            src_root + dest_path[len(path):], dest_path))
+            else:
+                self.queue_event(FileMovedEvent(moved[0], path))
+
+    def _expire_moves(self, now):
+        for cookie, (path, is_dir, moved_at) in self.moved_from.items():
+            if now - moved_at >= MOVE_PAIRING_DELAY:
+                del self.moved_from[cookie]
+                self._moved_away(path, is_dir)
+
+    def queue_events(self, timeout):
+        if self.fd is None:
+            self.stopped_event.wait(timeout)
+            return
+        wait = MOVE_PAIRING_DELAY if self.moved_from else timeout
+        try:
+            readable, _, _ = select.select([self.fd], [], [], wait)
+        except select.error:
+            return
+        if readable:
+            try:
+                buf = os.read(self.fd, READ_SIZE)
+            except OSError:
+                return
+            for event in parse_events(buf):
+                self._process_event(*event)
+        self._expire_moves(time.time())
+
+    def run(self):
+        for emitter in self.fallbacks.values():
+            emitter.start()
+        try:
+            EventEmitter.run(self)
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def on_thread_stop(self):
+        for emitter in self.fallbacks.values():
+            emitter.stop()
+
+
+class InotifyObserver(BaseObserver):
+    """
+    Observer with the same interface of the watchdog ones,
+    only recursive watches are supported
+    """
+
+    def __init__(self, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        BaseObserver.__init__(self, emitter_class=InotifyEmitter, timeout=timeout)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Rules deciding which paths of the sync root the daemon leaves alone.
+
+IgnoreRules reads gitignore-style patterns from the .rawboxignore file in
+the sync root; the matching files are never hashed, uploaded or downloaded.
+SelectiveSync keeps whole server subtrees (e.g. big shared folders) off a
+client, the rules are in its config.ini.
+"""
+
+import re
+
+IGNORE_FILE = ".rawboxignore"
+
+# editor swap and backup files, office lock files, partial downloads
+DEFAULT_IGNORE = [
+    "*.swp",
+    "*.swo",
+    "*.swx",
+    "*~",
+    ".#*",
+    "\\#*#",
+    "~$*",
+    ".~lock.*#",
+    "*.part",
+    "*.crdownload",
+    ".DS_Store",
+    "Thumbs.db",
+    "desktop.ini",
+]
+
+
+def _translate(pattern):
+    """ regular expression of a glob, * and ? don't cross the / """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[{}]".format(chars.replace("\\", "\\\\")))
+            i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return "".join(regex)
+
+
+class IgnoreRules(object):
+    """
+    gitignore-style patterns compiled in a single regular expression:
+        a pattern without "/" matches the name at any depth
+        a pattern with a "/" is relative to the sync root
+        a trailing "/" matches only directories
+        "!" before a pattern includes again what an earlier one ignored
+    the last matching pattern wins and everything under an ignored
+    directory is ignored, as in git
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = []
+        alternatives = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if "/" in pattern:
+                prefix = ""
+                pattern = pattern.lstrip("/")
+            else:
+                prefix = "(?:.*/)?"
+            regex = prefix + _translate(pattern) + ("/" if dir_only else "/?")
+            # the alternatives are tried from the last pattern
+            alternatives.insert(0, "(?P<p{}>{})".format(len(self.patterns), regex))
+            self.patterns.append((pattern, negated))
+        if alternatives:
+            self.regex = re.compile("(?:{})$".format("|".join(alternatives)), re.DOTALL)
+        else:
+            self.regex = None
+
+    @classmethod
+    def from_file(cls, file_path, defaults=DEFAULT_IGNORE):
+        """ the default patterns followed by the ones of file_path, if it exists """
+        patterns = list(defaults)
+        try:
+            with open(file_path) as rules:
+                patterns.extend(line.rstrip("\r\n") for line in rules)
+        except IOError:
+            pass
+        return cls(patterns)
+
+    def _match(self, path, is_dir):
+        match = self.regex.match(path + "/" if is_dir else path)
+        if match is None:
+            return False
+        return not self.patterns[int(match.lastgroup[1:])][1]
+
+    def match(self, rel_path, is_dir=False):
+        """ True if rel_path (with "/" separators) is ignored """
+        if self.regex is None:
+            return False
+        parts = rel_path.strip("/").split("/")
+        for i in range(1, len(parts)):
+            if self._match("/".join(parts[:i]), True):
+                return True
+        return self._match("/".join(parts), is_dir)
+
+
+def parse_paths(value):
+    """ list of the paths in a config value, one per line """
+    return [path.strip().strip("/") for path in value.splitlines() if path.strip("/ \t")]
+
+
+class SelectiveSync(object):
+    """
+    subtrees of the sync root excluded from this client, the most specific
+    rule wins so a subtree can be included again inside an excluded one:
+        exclude = shares
+        include = shares/my_project
+    """
+
+    def __init__(self, excluded=(), included=()):
+        self.rules = {}
+        for path in excluded:
+            self.rules[path.strip("/")] = True
+        for path in included:
+            self.rules[path.strip("/")] = False
+        self.rules.pop("", None)
+
+    @classmethod
+    def from_config(cls, exclude, include):
+        return cls(parse_paths(exclude), parse_paths(include))
+
+    def excludes(self, rel_path):
+        """ True if the file rel_path (with "/" separators) is out of the sync """
+        if not self.rules:
+            return False
+        parts = rel_path.strip("/").split("/")
+        for i in range(len(parts), 0, -1):
+            rule = self.rules.get("/".join(parts[:i]))
+            if rule is not None:
+                return rule
+        return False
+
+    def excludes_subtree(self, rel_dir):
+        """ True if nothing under the directory rel_dir is synchronized """
+        if not self.excludes(rel_dir):
+            return False
+        prefix = rel_dir.strip("/") + "/"
+        return not any(
+            path.startswith(prefix) for path, excluded in self.rules.items() if not excluded)
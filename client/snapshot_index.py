@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+The one structure of the local files: SnapshotTree is the merkle tree of
+the synchronized directory, the { md5: [path] } index of it
+(local_full_snapshot) and the md5 cache of the files.
+
+Every file is the name in the "files" of its directory node, as in any
+MerkleTree, plus an entry (node, name, stat) in by_md5: node and name are
+the objects of the tree and stat the packed (size, mtime, inode) its md5
+was computed at, so an index of the paths costs a tuple per file. A
+content with a single path keeps the entry itself instead of a list.
+Md5Index is the { md5: [path] } view of the tree: a lookup returns a new
+list of the paths, the changes go to the tree. The memory of the whole
+DirSnapshotManager is measured by benchmark_snapshot.py.
+"""
+
+import collections
+import struct
+import sys
+import os
+
+# the merkle tree is shared with the server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from merkle_tree import MerkleTree
+
+# size, mtime, inode of the file the md5 was computed on
+STAT = struct.Struct("<QdQ")
+
+
+def pack_stat(size, mtime, inode):
+    return STAT.pack(size, mtime, inode)
+
+
+def unpack_stat(stat):
+    return STAT.unpack(stat)
+
+
+class SnapshotTree(MerkleTree):
+    """
+    MerkleTree of the local files indexed by md5; every node knows the
+    "prefix" of its paths ("dir/path/", "" for the root), so a moved
+    directory moves the paths of its entries with it
+    """
+
+    def __init__(self):
+        super(SnapshotTree, self).__init__()
+        self.dirs[""]["prefix"] = ""
+        # md5: (node, name, stat), or a list of them for the copies
+        self.by_md5 = {}
+        # changed since the stats were saved
+        self.dirty = True
+
+    def _loaded(self, node, name, item):
+        """ index the (path, md5) or (path, md5, stat) items of from_files """
+        if name in node["files"]:
+            self._index_remove(node["files"][name], node, name)
+        self._index_add(item[1], (node, name, item[2] if len(item) > 2 else None))
+
+    @property
+    def index(self):
+        """ the { md5: [path] } view of the tree """
+        return Md5Index(self)
+
+    def _make_dirs(self, dir_path, propagate=True):
+        new = dir_path not in self.dirs
+        super(SnapshotTree, self)._make_dirs(dir_path, propagate)
+        if new:
+            self.dirs[dir_path]["prefix"] = dir_path + "/" if dir_path else ""
+
+    def _index_add(self, file_md5, entry):
+        entries = self.by_md5.get(file_md5)
+        if entries is None:
+            self.by_md5[file_md5] = entry
+        elif isinstance(entries, list):
+            entries.append(entry)
+        else:
+            self.by_md5[file_md5] = [entries, entry]
+
+    def _index_remove(self, file_md5, node, name):
+        """ remove the entry of a file from by_md5 and return it """
+        entries = self.by_md5.get(file_md5)
+        if isinstance(entries, tuple):
+            if entries[0] is node and entries[1] == name:
+                del self.by_md5[file_md5]
+                return entries
+        elif entries is not None:
+            for i, entry in enumerate(entries):
+                if entry[0] is node and entry[1] == name:
+                    del entries[i]
+                    if len(entries) == 1:
+                        self.by_md5[file_md5] = entries[0]
+                    return entry
+        return None
+
+    def entries(self, file_md5):
+        """ the entries of a content """
+        entries = self.by_md5.get(file_md5)
+        if entries is None:
+            return []
+        if isinstance(entries, tuple):
+            return [entries]
+        return entries
+
+    def entry_path(self, entry):
+        return entry[0]["prefix"] + entry[1]
+
+    def iter_stats(self):
+        """ yield (path, md5, stat) for every file whose stat is known """
+        for file_md5, entries in self.by_md5.iteritems():
+            if isinstance(entries, tuple):
+                entries = [entries]
+            for entry in entries:
+                if entry[2] is not None:
+                    yield self.entry_path(entry), file_md5, entry[2]
+
+    def add_file(self, path, file_md5, stat=None):
+        """
+        add a file or change its md5; stat None keeps the one of an
+        unchanged file
+        """
+        self.dirty = True
+        dir_path, name = self._split(path)
+        self._make_dirs(dir_path)
+        node = self.dirs[dir_path]
+        old_md5 = node["files"].get(name)
+        if old_md5 is not None:
+            old_entry = self._index_remove(old_md5, node, name)
+            # the name of the tree, not an equal copy of it
+            name = old_entry[1]
+            if old_md5 == file_md5:
+                self._index_add(file_md5, (node, name, stat or old_entry[2]))
+                return
+        self._update_entry(dir_path, "f", name, old_md5, file_md5)
+        node["files"][name] = file_md5
+        self._index_add(file_md5, (node, name, stat))
+        self._propagate(dir_path)
+
+    def remove_file(self, path):
+        """ remove a file and return its (md5, stat), None if it's not in the tree """
+        file_md5 = self.get_md5(path)
+        if file_md5 is None:
+            return None
+        self.dirty = True
+        dir_path, name = self._split(path)
+        entry = self._index_remove(file_md5, self.dirs[dir_path], name)
+        super(SnapshotTree, self).remove_file(path)
+        return file_md5, entry[2]
+
+    def get_stat(self, path):
+        """ return the packed stat of a file in the tree or None """
+        file_md5 = self.get_md5(path)
+        if file_md5 is None:
+            return None
+        dir_path, name = self._split(path)
+        node = self.dirs[dir_path]
+        for entry in self.entries(file_md5):
+            if entry[0] is node and entry[1] == name:
+                return entry[2]
+        return None
+
+    def set_stat(self, path, stat):
+        """ set the packed stat of a file in the tree """
+        file_md5 = self.get_md5(path)
+        if file_md5 is not None:
+            self.dirty = True
+            dir_path, name = self._split(path)
+            entry = self._index_remove(file_md5, self.dirs[dir_path], name)
+            self._index_add(file_md5, entry[:2] + (stat,))
+
+    def move_dir(self, src_dir, dst_dir):
+        """ move a directory, the entries of its files follow their nodes """
+        if src_dir not in self.dirs or src_dir == "" or dst_dir in self.dirs:
+            return
+        prefix = src_dir + "/"
+        self.dirty = True
+        moved = [node for dir_path, node in self.dirs.iteritems()
+                 if dir_path == src_dir or dir_path.startswith(prefix)]
+        super(SnapshotTree, self).move_dir(src_dir, dst_dir)
+        for node in moved:
+            node["prefix"] = dst_dir + node["prefix"][len(src_dir):]
+
+
+class Md5Index(collections.MutableMapping):
+    """ { md5: [path] } view of a SnapshotTree """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __getitem__(self, file_md5):
+        entries = self.tree.by_md5.get(file_md5)
+        if entries is None:
+            raise KeyError(file_md5)
+        if isinstance(entries, tuple):
+            return [entries[0]["prefix"] + entries[1]]
+        return [entry[0]["prefix"] + entry[1] for entry in entries]
+
+    def __setitem__(self, file_md5, paths):
+        paths = list(paths)
+        if file_md5 in self:
+            del self[file_md5]
+        for path in paths:
+            self.tree.add_file(path, file_md5)
+
+    def __delitem__(self, file_md5):
+        for path in self[file_md5]:
+            self.tree.remove_file(path)
+
+    def __contains__(self, file_md5):
+        return file_md5 in self.tree.by_md5
+
+    def __iter__(self):
+        return iter(self.tree.by_md5)
+
+    def __len__(self):
+        return len(self.tree.by_md5)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
@@ -31,7 +31,8 @@ class MockCmdMessageClient(object):
         code and psw are used only respectively in
         activate_user and create_user
         """
-        TestRawBoxExecuter.username = param['user']
+        TestRawBoxExecuter.command_type = _
+        TestRawBoxExecuter.username = param.get('user', "empty")
         TestRawBoxExecuter.psw = param.get('psw', "empty")
         TestRawBoxExecuter.code = param.get('code', "empty")
 
@@ -52,6 +53,12 @@ class MockExecuter(object):
     def _delete_user(self, username):
         RawBoxCmdTest.called = True
 
+    def _status(self):
+        RawBoxCmdTest.called = True
+
+    def _set_limits(self, limits):
+        RawBoxCmdTest.called = limits
+
 
 class RawBoxCmdTest(unittest.TestCase):
 
@@ -72,6 +79,23 @@ class RawBoxCmdTest(unittest.TestCase):
         self.rawbox_cmd.onecmd('delete pippo@pippa.it')
         self.assertTrue(RawBoxCmdTest.called)
 
+    def test_do_status(self):
+        self.rawbox_cmd.onecmd('status')
+        self.assertTrue(RawBoxCmdTest.called)
+
+    def test_do_limit(self):
+        self.rawbox_cmd.onecmd('limit upload=100 download=0')
+        self.assertEqual(RawBoxCmdTest.called, {'upload': '100', 'download': '0'})
+
+        #Case: only show the limits
+        self.rawbox_cmd.onecmd('limit')
+        self.assertEqual(RawBoxCmdTest.called, {})
+
+        #Case: wrong argument
+        RawBoxCmdTest.called = False
+        self.rawbox_cmd.onecmd('limit up=100')
+        self.assertFalse(RawBoxCmdTest.called)
+
 
 class TestRawBoxExecuter(unittest.TestCase):
 
@@ -198,5 +222,15 @@ class TestRawBoxExecuter(unittest.TestCase):
         self.assertNotEquals(TestRawBoxExecuter.username, self.wrong_user3)
         self.assertEquals(TestRawBoxExecuter.username, self.correct_user)
 
+    def test_status(self):
+        self.raw_box_exec._status()
+
+        self.assertEquals(TestRawBoxExecuter.command_type, 'status')
+
+    def test_set_limits(self):
+        self.raw_box_exec._set_limits({'upload': '100'})
+
+        self.assertEquals(TestRawBoxExecuter.command_type, 'set_limits')
+
 if __name__ == '__main__':
     unittest.main()
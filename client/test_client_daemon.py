@@ -1,10 +1,29 @@
 from client_daemon import DirSnapshotManager
+from merkle_tree import MerkleTree
+from snapshot_index import SnapshotTree
 from client_daemon import DirectoryEventHandler
+from client_daemon import IgnoredEvents
+from client_daemon import MultipartFileStream
+from client_daemon import ServerUnreachable
+from client_daemon import Outbox
+from client_daemon import SyncScheduler
+from client_daemon import SyncWorker
+from client_daemon import CircuitBreaker
+from client_daemon import parse_retry_after
+from client_daemon import TokenBucket
+from client_daemon import PRIORITY_INTERACTIVE
 from client_daemon import ServerCommunicator
 from client_daemon import FileSystemOperator
+from client_daemon import BlobCache
 from client_daemon import CommandExecuter
 from client_daemon import get_abspath
 from client_daemon import get_relpath
+from client_daemon import reflink
+from inotify_observer import TreeRescanEvent
+from path_filters import IgnoreRules
+from path_filters import SelectiveSync
+from path_filters import DEFAULT_IGNORE
+from passlib.hash import sha256_crypt
 
 #Watchdog event import for event_handler test
 from watchdog.events import FileDeletedEvent
@@ -15,19 +34,32 @@ from watchdog.events import DirDeletedEvent
 from watchdog.events import DirModifiedEvent
 from watchdog.events import DirCreatedEvent
 from watchdog.events import DirMovedEvent
+from werkzeug.formparser import parse_form_data
 import ConfigParser
 import client_daemon
+import StringIO
 import httpretty
 import requests
 import unittest
 import logging
 import hashlib
 import base64
+import email.utils
+import threading
+import tempfile
 import shutil
+import mock
 import copy
+import time
 import json
+import zlib
+import sys
 import os
 
+# the server of the repository, the synchronization is also tested against it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "server"))
+import server
+
 
 class TestEnvironment(object):
 
@@ -57,7 +89,7 @@ class TestEnvironment(object):
             'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt'],
         }
 
-        self.md5_snapshot = '2b829f9fd20451aa44d144e5ec0f00af'
+        self.md5_snapshot = 'd588da0ff655f6dce68e6cd2beaf088c'
         self.conf_snap_path = os.path.join(self.test_main_path, 'snapshot_file.json')
         self.conf_snap_gen = {
             "timestamp": 123123,
@@ -84,11 +116,32 @@ class ServerCommunicatorTest(unittest.TestCase):
                 self.action = False
                 self.body = False
 
-            def syncronize_dispatcher(self, server_timestamp, server_snapshot):
+            def syncronize_dispatcher(self, server_timestamp, server_snapshot, client_snapshot=None,
+                                      local_synced=None):
                 self.server_timestamp = server_timestamp
                 self.server_snapshot = server_snapshot
+                self.client_snapshot = client_snapshot
                 return ['command']
 
+            def stream_dispatcher(self, server_timestamp, server_files, dir_path="", local_synced=None):
+                self.server_files = list(server_files)
+                self.stream_dir = dir_path
+                return [(['command'], 'server_batch', 'client_batch')]
+
+            def global_md5(self):
+                return 'local_root_hash'
+
+            def local_check(self):
+                return True
+
+            def merkle_diff(self, server_root, get_server_node):
+                return 'server_diff', 'client_diff', self.stream_dirs
+
+            stream_dirs = []
+
+            def optimize_plan(self, command_list, server_snapshot, client_snapshot=None):
+                return command_list
+
             def save_snapshot(self, timestamp):
                 self.timestamp = timestamp
 
@@ -111,9 +164,18 @@ class ServerCommunicatorTest(unittest.TestCase):
             def update_snapshot_move(self, body):
                 self.move = body
 
+            def update_snapshot_move_dir(self, body):
+                self.move_dir = body
+
             def update_snapshot_copy(self, body):
                 self.copy = body
 
+            def cached_md5(self, abs_path):
+                return None
+
+            def cache_md5(self, abs_path, file_md5, stat):
+                self.cached = (abs_path, file_md5)
+
         class _try_request(object):
             status_code = 200
             text = 'timestamp'
@@ -265,6 +327,91 @@ class ServerCommunicatorTest(unittest.TestCase):
             self.server_comm.auth)
         self.assertEqual(result.status_code, 401)
 
+        #Case: server unreachable for more than max_retries
+        def unreachable(*args, **kwargs):
+            raise requests.exceptions.ConnectionError()
+        self.server_comm.max_retries = 1
+        self.assertRaises(
+            ServerUnreachable,
+            self.server_comm._try_request, unreachable, retry_delay=0)
+
+    def test_try_request_backoff(self):
+        class Response(object):
+            def __init__(self, status_code, headers=None):
+                self.status_code = status_code
+                self.headers = headers or {}
+
+        answers = [
+            Response(503, {'Retry-After': '7'}),
+            requests.exceptions.ConnectionError(),
+            requests.exceptions.ConnectionError(),
+            Response(200),
+        ]
+
+        def callback(*args, **kwargs):
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        clock = [1000.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        url = '{}/files/file.txt'.format(self.server_comm.server_url)
+        #the jitter draws its upper bound
+        with mock.patch('client_daemon.time.sleep', sleep), \
+                mock.patch('client_daemon.time.time', lambda: clock[0]), \
+                mock.patch('client_daemon.random.uniform', lambda low, high: high):
+            result = self.server_comm._try_request(callback, url=url, retry_delay=4)
+        self.assertEqual(result.status_code, 200)
+        #Retry-After honored, then the backoff 4 * 2 ** (failures - 1) and the
+        #rest of the open time of the breaker (5 doubled at each failed probe):
+        #7 | 8 + 2 = 10 | 16 + 4 = 20
+        self.assertEqual(sleeps, [7, 8, 2, 16, 4])
+        self.assertEqual(self.server_comm.breakers['files'].state, 'closed')
+
+        #Case: endpoint known down, fail fast without calling the server
+        self.server_comm.max_retries = 0
+        self.server_comm.breakers['files'].failure(time.time(), retry_after=60)
+        self.assertRaises(
+            ServerUnreachable,
+            self.server_comm._try_request, callback, url=url)
+        self.assertEqual(answers, [])
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('not a date'))
+        http_date = email.utils.formatdate(time.time() + 100, usegmt=True)
+        self.assertTrue(95 <= parse_retry_after(http_date) <= 100)
+
+    def test_set_limits(self):
+        response = self.server_comm.set_limits({"upload": "100", "download": 0})
+        self.assertEqual(self.server_comm.upload_bucket.rate, 100 * 1024)
+        self.assertEqual(self.server_comm.download_bucket.rate, 0)
+        self.assertEqual(
+            response, {"result": "ok", "details": ["upload: 100 KB/s", "download: no limit"]})
+
+        #Case: invalid limit, nothing changes
+        response = self.server_comm.set_limits({"upload": "-1"})
+        self.assertEqual(response["result"], "error")
+        self.assertEqual(self.server_comm.upload_bucket.rate, 100 * 1024)
+
+        #Case: a valid upload limit with an invalid download one, nothing changes
+        response = self.server_comm.set_limits({"upload": "50", "download": "fast"})
+        self.assertEqual(response["result"], "error")
+        self.assertEqual(self.server_comm.upload_bucket.rate, 100 * 1024)
+
+        #Case: the upload blocks go through the bucket
+        self.server_comm.upload_bucket = mock.Mock()
+        self.server_comm.upload_file(self.file_path)
+        self.server_comm.upload_bucket.consume.assert_called_with(
+            os.path.getsize(self.file_path), PRIORITY_INTERACTIVE)
+
     def test_setexecuter(self):
         executer = "executer"
         self.server_comm.setExecuter(executer)
@@ -312,7 +459,7 @@ class ServerCommunicatorTest(unittest.TestCase):
         self.assertEqual(host, '127.0.0.1:5000')
         self.assertEqual(method, 'PUT')
         #check if check md5 is equal
-        self.assertEqual(self.request['data']['file_md5'], mocked_file_md5)
+        self.assertIn(mocked_file_md5, httpretty.last_request().body)
 
         put_file = False
         self.server_comm._try_request = fake_try_request
@@ -331,7 +478,18 @@ class ServerCommunicatorTest(unittest.TestCase):
         self.assertEqual(host, '127.0.0.1:5000')
         self.assertEqual(method, 'POST')
         #check if check md5 is equal
-        self.assertEqual(self.request['data']['file_md5'], mocked_file_md5)
+        self.assertIn(mocked_file_md5, httpretty.last_request().body)
+
+        #Case: update of a file the server doesn't have, sent as a create
+        url = 'http://127.0.0.1:5000/API/v1/files/f_for_cdaemon_test.txt'
+        httpretty.register_uri(httpretty.PUT, url, status=404)
+        httpretty.register_uri(httpretty.POST, url, body='123', status=201)
+        response = self.server_comm.upload_file(self.file_path, True)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(httpretty.last_request().method, 'POST')
+        self.assertEqual(
+            self.server_comm.snapshot_manager.upload,
+            {"src_path": self.file_path})
 
         #Case: IOError for file
         filepath = "not/corret/path"
@@ -367,9 +525,121 @@ class ServerCommunicatorTest(unittest.TestCase):
             self.server_comm.snapshot_manager.timestamp,
             'update')
 
+    def test_delta_upload(self):
+        base = os.urandom(100000)
+        content = base[:50000] + 'changed' + base[50007:]
+        open(self.file_path, 'wb').write(content)
+        blocks = [base[i:i + 2048] for i in range(0, len(base), 2048)]
+        signatures = {
+            'md5': hashlib.md5(base).hexdigest(),
+            'block_size': 2048,
+            'blocks': [
+                [client_daemon.weak_checksum(b), hashlib.md5(b).hexdigest()] for b in blocks],
+        }
+        bodies = []
+
+        class Response(object):
+            text = 'update'
+
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+        def put(url, auth, data, headers):
+            bodies.append(data.read())
+            return Response(412 if len(bodies) == 1 else 201)
+
+        self.server_comm.delta_uploads = True
+        with mock.patch.object(self.server_comm, 'get_signatures', return_value=signatures), \
+                mock.patch('client_daemon.requests.put', put):
+            self.server_comm.upload_file(self.file_path, put_file=True)
+        #the delta first, then the whole file when the server version changed
+        self.assertIn('rsync-delta', bodies[0])
+        self.assertIn(signatures['md5'], bodies[0])
+        self.assertLess(len(bodies[0]), 10000)
+        self.assertNotIn('rsync-delta', bodies[1])
+        self.assertIn(content, bodies[1])
+        self.assertEqual(
+            self.server_comm.snapshot_manager.update,
+            {"src_path": self.file_path})
+
+        #Case: small file, no signatures are asked
+        open(self.file_path, 'w').write('test_file')
+        self.server_comm._try_request = mock.Mock()
+        self.assertIsNone(self.server_comm.get_signatures(self.file_path))
+        self.assertFalse(self.server_comm._try_request.called)
+
+    def test_upload_chunks(self):
+        content = os.urandom(client_daemon.CHUNKED_MIN_SIZE)
+        open(self.file_path, 'wb').write(content)
+        with open(self.file_path, 'rb') as file_object:
+            file_md5, chunks = client_daemon.chunk_file(file_object)
+        requests_sent = []
+
+        class Response(object):
+            text = 'upload'
+
+            def __init__(self, status_code, missing=()):
+                self.status_code = status_code
+                self.missing = list(missing)
+
+            def json(self):
+                return {'missing': self.missing}
+
+        def post(url, auth, data, headers=None):
+            if url.endswith('/chunks/'):
+                requests_sent.append(('POST', url, data))
+                return Response(200, [chunks[0][0], chunks[1][0]])
+            requests_sent.append(('POST', url, data.read()))
+            return Response(201)
+
+        def put(url, auth, data, headers=None):
+            requests_sent.append(('PUT', url, data.read()))
+            return Response(201)
+
+        self.server_comm.chunked_uploads = True
+        with mock.patch('client_daemon.requests.post', post), \
+                mock.patch('client_daemon.requests.put', put):
+            self.server_comm.upload_file(self.file_path)
+        #the list of the chunks, the two missing ones in a request and the manifest
+        self.assertEqual(
+            requests_sent[0][2], {'chunks': [chunk[0] for chunk in chunks]})
+        self.assertEqual(len(requests_sent), 3)
+        self.assertEqual(requests_sent[1][1], 'http://127.0.0.1:5000/API/v1/chunks/')
+        body = requests_sent[1][2]
+        self.assertIn(content[:chunks[0][2] + chunks[1][2]], body)
+        self.assertNotIn(content[chunks[1][1] + chunks[1][2]:][:1000], body)
+        for chunk_md5, _, length in chunks[:2]:
+            self.assertIn('{}:{}'.format(chunk_md5, length), body)
+        manifest = requests_sent[2][2]
+        self.assertIn(file_md5, manifest)
+        self.assertIn(chunks[-1][0], manifest)
+        self.assertNotIn(content[:1000], manifest)
+        self.assertEqual(self.server_comm.snapshot_manager.cached, (self.file_path, file_md5))
+
+        #Case: the missing chunks of a compressible file are gzipped
+        content = ''.join('line {}\n'.format(i) for i in xrange(client_daemon.CHUNKED_MIN_SIZE // 8))
+        open(self.file_path, 'wb').write(content)
+        with open(self.file_path, 'rb') as file_object:
+            file_md5, chunks = client_daemon.chunk_file(file_object)
+        del requests_sent[:]
+        self.server_comm.upload_encoding = 'gzip'
+        with mock.patch('client_daemon.requests.post', post), \
+                mock.patch('client_daemon.requests.put', put):
+            self.server_comm.upload_file(self.file_path)
+        body = requests_sent[1][2]
+        self.assertIn('gzip', body)
+        self.assertNotIn(content[:chunks[0][2]], body)
+        self.assertLess(len(body), (chunks[0][2] + chunks[1][2]) // 2)
+
+        #Case: an update missing most of the chunks goes as rsync delta
+        self.server_comm.delta_uploads = True
+        self.server_comm._try_request = lambda *args, **kwargs: Response(200, [c[0] for c in chunks])
+        self.assertIsNone(self.server_comm.upload_chunks(self.file_path, put_file=True))
+
     def test_download(self):
         mock_auth_user = ":".join([self.username, self.password])
-        response = self.server_comm.download_file(self.file_path)
+        out_file = StringIO.StringIO()
+        response = self.server_comm.download_file(self.file_path, out_file)
         encoded = httpretty.last_request().headers['authorization'].split()[1]
         authorization_decoded = base64.decodestring(encoded)
         path = httpretty.last_request().path
@@ -384,7 +654,48 @@ class ServerCommunicatorTest(unittest.TestCase):
         #check if methods are equal
         self.assertEqual(method, 'GET')
         #check response's body
-        self.assertEqual(response[1], u'[{"title": "Test"}]')
+        self.assertEqual(out_file.getvalue(), '[{"title": "Test"}]')
+        self.assertEqual(response, hashlib.md5('[{"title": "Test"}]').hexdigest())
+
+        #Case: gzipped by the server, the md5 is the one of the content
+        content = 'a line of a log file\n' * 1000
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://127.0.0.1:5000/API/v1/files/f_for_cdaemon_test.txt',
+            body=compressor.compress(content) + compressor.flush(),
+            adding_headers={
+                'Content-Encoding': 'gzip',
+                'ETag': '"{}"'.format(hashlib.md5(content).hexdigest())})
+        out_file = StringIO.StringIO()
+        response = self.server_comm.download_file(self.file_path, out_file)
+        self.assertEqual(out_file.getvalue(), content)
+        self.assertEqual(response, hashlib.md5(content).hexdigest())
+
+        #Case: the priority comes from the size of the file, not of the gzip body
+        content = 'a line of a log file\n' * 60000
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://127.0.0.1:5000/API/v1/files/f_for_cdaemon_test.txt',
+            body=compressor.compress(content) + compressor.flush(),
+            adding_headers={
+                'Content-Encoding': 'gzip',
+                'X-Uncompressed-Size': str(len(content)),
+                'ETag': '"{}"'.format(hashlib.md5(content).hexdigest())})
+        self.server_comm.download_bucket = mock.Mock()
+        self.server_comm.download_file(self.file_path, StringIO.StringIO())
+        self.assertEqual(
+            set(call[0][1] for call in self.server_comm.download_bucket.consume.call_args_list),
+            set([client_daemon.PRIORITY_BULK]))
+
+        #Case: body different from the md5 announced by server
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://127.0.0.1:5000/API/v1/files/f_for_cdaemon_test.txt',
+            body='corrupted',
+            adding_headers={'ETag': '"{}"'.format(hashlib.md5('original').hexdigest())})
+        self.assertFalse(self.server_comm.download_file(self.file_path, StringIO.StringIO()))
 
         #Case: server bad request
         def _try_request(self, *args, **kwargs):
@@ -395,8 +706,8 @@ class ServerCommunicatorTest(unittest.TestCase):
             return response
 
         self.server_comm._try_request = _try_request
-        response = self.server_comm.download_file(self.file_path)
-        self.assertEqual(response, (False, False))
+        response = self.server_comm.download_file(self.file_path, StringIO.StringIO())
+        self.assertFalse(response)
 
     def test_delete_file(self):
         mock_auth_user = ":".join([self.username, self.password])
@@ -461,6 +772,23 @@ class ServerCommunicatorTest(unittest.TestCase):
             self.server_comm.snapshot_manager.timestamp,
             'timestamp')
 
+    def test_move_dir(self):
+        src_dir = os.path.join(self.dir, "sub_dir")
+        self.server_comm.move_dir(src_dir, self.another_dir)
+        self.assertEqual(httpretty.last_request().path, '/API/v1/actions/move')
+        self.assertEqual(
+            httpretty.last_request().parsed_body,
+            {"file_src": ["sub_dir"], "file_dest": ["other_folder"]})
+
+        self.server_comm._try_request = self.mock_try_request
+
+        #Case: 201 status, the snapshot is updated once for the whole directory
+        self.server_comm._try_request.status_code = 201
+        self.server_comm.move_dir(src_dir, self.another_dir)
+        self.assertEqual(
+            self.server_comm.snapshot_manager.move_dir,
+            {"src_path": src_dir, "dst_path": self.another_dir})
+
     def test_copy_file(self):
         mock_auth_user = ":".join([self.username, self.password])
         self.server_comm.copy_file(self.file_path, self.another_path)
@@ -540,17 +868,24 @@ class ServerCommunicatorTest(unittest.TestCase):
         self.assertEqual(msg3["details"][0], "Bad request")
     
     def test_syncronize(self):
+        responses = []
+
         def my_try_request(*args, **kwargs):
-            class obj (object):
-                text = {
-                    'timestamp': 123123,
-                    'snapshot': u'1234uh34h5bhj124b',
-                }
-                status_code = 'boh'
+            self.request = kwargs
+            return responses.pop(0)
+
+        class obj (object):
+            def __init__(self, text, status_code=200, headers=None):
+                self.text = text
+                self.status_code = status_code
+                self.headers = headers or {}
+                self.closed = False
+
+            def json(self):
+                return self.text
 
-                def json(self):
-                    return self.text
-            return obj()
+            def close(self):
+                self.closed = True
 
         class Executer(object):
 
@@ -561,11 +896,347 @@ class ServerCommunicatorTest(unittest.TestCase):
                 self.status = True
 
         executer = Executer()
+        snapshot_manager = self.server_comm.snapshot_manager
         self.server_comm.executer = executer
         self.server_comm._try_request = my_try_request
+
+        #Case: root hash different from the local one
+        responses.append(obj(
+            {'timestamp': 123123, 'hash': 'server_root_hash'},
+            headers={'X-Poll-Interval': '60', 'Accept-Encoding': 'gzip, rsync-delta, chunks'}))
+        self.assertTrue(self.server_comm.synchronize("mock"))
+        self.assertEqual(self.request['url'], 'http://127.0.0.1:5000/API/v1/tree/')
+        self.assertEqual(self.server_comm.poll_interval, 60)
+        self.assertEqual(self.server_comm.upload_encoding, 'gzip')
+        self.assertTrue(self.server_comm.delta_uploads)
+        self.assertTrue(self.server_comm.chunked_uploads)
+        self.assertEqual(executer.status, True)
+        self.assertEqual(snapshot_manager.server_snapshot, 'server_diff')
+        self.assertEqual(snapshot_manager.client_snapshot, 'client_diff')
+        self.assertEqual(snapshot_manager.server_timestamp, 123123)
+
+        #Case: a directory only on server, compared with its streamed snapshot
+        class stream(obj):
+            def iter_lines(self, chunk_size=512):
+                return iter(self.text.splitlines())
+
+        snapshot_manager.stream_dirs = ['new_dir']
+        responses.append(obj({'timestamp': 123123, 'hash': 'server_root_hash'}))
+        response = stream(
+            '{"timestamp": 123123}\n{"path": "new_dir/a.txt", "md5": "MD5", "timestamp": 1, "size": 3}\n',
+            headers={'Content-Type': 'application/x-ndjson'})
+        responses.append(response)
+        self.assertTrue(self.server_comm.synchronize("mock"))
+        self.assertTrue(response.closed)
+        self.assertEqual(self.request['url'], 'http://127.0.0.1:5000/API/v1/files/')
+        self.assertEqual(self.request['params'], {'format': 'ndjson', 'prefix': 'new_dir'})
+        self.assertEqual(snapshot_manager.stream_dir, 'new_dir')
+        self.assertEqual(
+            snapshot_manager.server_files,
+            [{'path': 'new_dir/a.txt', 'md5': 'MD5', 'timestamp': 1, 'size': 3}])
+        snapshot_manager.stream_dirs = []
+
+        #Case: root hash equal to the local one
+        executer.status = False
+        responses.append(obj({'timestamp': 123124, 'hash': 'local_root_hash'}))
+        self.assertFalse(self.server_comm.synchronize("mock"))
+        self.assertEqual(executer.status, False)
+        self.assertIsNone(self.server_comm.poll_interval)
+        self.assertIsNone(self.server_comm.upload_encoding)
+        self.assertFalse(self.server_comm.delta_uploads)
+        self.assertFalse(self.server_comm.chunked_uploads)
+        self.assertEqual(snapshot_manager.timestamp, 123124)
+
+        #Case: server without merkle tree
+        responses.append(obj({}, 404))
+        response = obj({'timestamp': 123125, 'snapshot': u'1234uh34h5bhj124b'})
+        responses.append(response)
         self.server_comm.synchronize("mock")
+        self.assertTrue(response.closed)
+        self.assertEqual(self.request['url'], 'http://127.0.0.1:5000/API/v1/files/')
+        self.assertEqual(executer.status, True)
+        self.assertEqual(snapshot_manager.server_snapshot, u'1234uh34h5bhj124b')
+        self.assertEqual(snapshot_manager.client_snapshot, None)
+
+        #Case: server streaming the snapshot sorted by path
+        executer.status = False
+        responses.append(obj({}, 404))
+        response = stream(
+            '{"timestamp": 123126}\n{"path": "a.txt", "md5": "MD5", "timestamp": 1, "size": 3}\n',
+            headers={'Content-Type': 'application/x-ndjson'})
+        responses.append(response)
+        self.assertTrue(self.server_comm.synchronize("mock"))
+        self.assertTrue(response.closed)
+        self.assertEqual(self.request['params'], {'format': 'ndjson'})
+        self.assertTrue(self.request['stream'])
+        self.assertEqual(
+            snapshot_manager.server_files,
+            [{'path': 'a.txt', 'md5': 'MD5', 'timestamp': 1, 'size': 3}])
+        self.assertEqual(snapshot_manager.server_timestamp, 123126)
         self.assertEqual(executer.status, True)
 
+        #Case: user not logged
+        executer.status = False
+        responses.append(obj({}, 401))
+        self.assertIsNone(self.server_comm.synchronize("mock"))
+        self.assertEqual(executer.status, False)
+        responses.append(obj({}, 404))
+        response = obj({}, 401)
+        responses.append(response)
+        self.assertIsNone(self.server_comm.synchronize("mock"))
+        self.assertEqual(executer.status, False)
+        self.assertTrue(response.closed)
+
+    def test_get_tree_node(self):
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://127.0.0.1:5000/API/v1/tree/sub_dir',
+            responses=[
+                httpretty.Response(body='{"hash": "h", "dirs": {}, "files": {}}', status=200),
+                httpretty.Response(body='"Directory unreachable"', status=404),
+            ])
+        node = self.server_comm.get_tree_node('sub_dir', recursive=True)
+        self.assertEqual(node, {"hash": "h", "dirs": {}, "files": {}})
+        self.assertEqual(httpretty.last_request().querystring, {'recursive': ['true']})
+        self.assertEqual(self.server_comm.get_tree_node('sub_dir'), None)
+
+
+class ServerSyncTest(unittest.TestCase):
+    """ synchronize against server.py through the Flask test client """
+
+    SERVER_URL = 'http://127.0.0.1:5000'
+
+    def setUp(self):
+        self.environment = TestEnvironment()
+        self.test_share_dir = self.environment.create()[1]
+        client_daemon.CONFIG_DIR_PATH = self.test_share_dir
+        self.snapshot_manager = DirSnapshotManager(self.environment.conf_snap_path)
+
+        self.server_globals = dict(
+            (name, getattr(server, name))
+            for name in ('SERVER_ROOT', 'USERS_DIRECTORIES', 'USERS_DATA', 'CHUNKS_DIRECTORY'))
+        self.server_users = server.User.users
+        self.server_root = tempfile.mkdtemp()
+        server.SERVER_ROOT = self.server_root
+        server.USERS_DIRECTORIES = os.path.join(self.server_root, 'user_dirs/')
+        server.USERS_DATA = os.path.join(self.server_root, 'user_data.json')
+        server.CHUNKS_DIRECTORY = os.path.join(self.server_root, 'chunks/')
+        os.makedirs(server.USERS_DIRECTORIES)
+        server.User.users = {}
+        server.User('user@me.it', sha256_crypt.encrypt('password'))
+        self.tc = server.app.test_client()
+        self.headers = {'Authorization': 'Basic ' + base64.b64encode('user@me.it:password')}
+
+        self.server_comm = ServerCommunicator(
+            '{}/API/v1'.format(self.SERVER_URL), 'user@me.it', 'password', self.snapshot_manager)
+        self.requests_done = []
+        try_request = self.server_comm._try_request
+        self.server_comm._try_request = lambda callback, *args, **kwargs: try_request(
+            self.client_get, *args, **kwargs)
+
+        class Executer(object):
+            def __init__(self):
+                self.commands = []
+
+            def syncronize_executer(self, command_list):
+                self.commands.extend(command_list)
+
+        self.server_comm.executer = self.executer = Executer()
+
+    def tearDown(self):
+        for name, value in self.server_globals.items():
+            setattr(server, name, value)
+        server.User.users = self.server_users
+        shutil.rmtree(self.server_root)
+        self.environment.remove()
+
+    def client_get(self, url, params=None, auth=None, stream=False):
+        """ requests.get through the test client of the server """
+        self.requests_done.append((url[len(self.SERVER_URL):], params))
+
+        class Response(object):
+            def __init__(self, response):
+                self.status_code = response.status_code
+                self.headers = response.headers
+                self.data = response.data
+
+            def json(self):
+                return json.loads(self.data)
+
+            def iter_lines(self, chunk_size=512):
+                return iter(self.data.splitlines())
+
+            def close(self):
+                pass
+
+        return Response(self.tc.get(
+            url[len(self.SERVER_URL):], query_string=params, headers=self.headers))
+
+    def upload(self, path, content):
+        response = self.tc.post(
+            '/API/v1/files/{}'.format(path),
+            data={'file_content': (StringIO.StringIO(content), 'file'),
+                  'file_md5': hashlib.md5(content).hexdigest()},
+            headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+
+    def test_synchronize(self):
+        #the server has the local files and a new directory, with a copy of a local file
+        for path in ('sub_dir_1/test_file_1.txt', 'sub_dir_2/test_file_2.txt', 'sub_dir_2/test_file_3.txt'):
+            self.upload(path, open(os.path.join(self.test_share_dir, path)).read())
+        self.upload('new_dir/deep/new_file.txt', 'only on server')
+        self.upload('new_dir/copy.txt', 'Integer non tincidunt dolor')
+
+        self.assertTrue(self.server_comm.synchronize(None))
+        #the equal directories are never requested, the new one is streamed
+        self.assertEqual(self.requests_done, [
+            ('/API/v1/tree/', None),
+            ('/API/v1/files/', {'format': 'ndjson', 'prefix': 'new_dir'}),
+        ])
+        self.assertEqual(sorted(self.executer.commands), [
+            {'local_copy': ['sub_dir_2/test_file_2.txt', u'new_dir/copy.txt']},
+            {'local_download': [u'new_dir/deep/new_file.txt', hashlib.md5('only on server').hexdigest()]},
+        ])
+
+        #Case: more different files than a batch, the whole snapshot is streamed
+        del self.requests_done[:]
+        del self.executer.commands[:]
+        original_batch_size = client_daemon.SYNC_BATCH_SIZE
+        client_daemon.SYNC_BATCH_SIZE = 1
+        try:
+            self.upload('sub_dir_1/new_file.txt', 'also only on server')
+            self.upload('sub_dir_1/other_file.txt', 'one more on server')
+            self.assertTrue(self.server_comm.synchronize(None))
+        finally:
+            client_daemon.SYNC_BATCH_SIZE = original_batch_size
+        self.assertEqual(self.requests_done, [
+            ('/API/v1/tree/', None),
+            ('/API/v1/tree/sub_dir_1', None),
+            ('/API/v1/files/', {'format': 'ndjson'}),
+        ])
+        self.assertEqual(sorted(self.executer.commands), [
+            {'local_copy': ['sub_dir_2/test_file_2.txt', u'new_dir/copy.txt']},
+            {'local_download': [u'new_dir/deep/new_file.txt', hashlib.md5('only on server').hexdigest()]},
+            {'local_download': [u'sub_dir_1/new_file.txt', hashlib.md5('also only on server').hexdigest()]},
+            {'local_download': [u'sub_dir_1/other_file.txt', hashlib.md5('one more on server').hexdigest()]},
+        ])
+
+
+class SyncSchedulerTest(unittest.TestCase):
+
+    def test_intervals(self):
+        scheduler = SyncScheduler(min_interval=5, max_interval=30)
+        now = 1000
+        self.assertTrue(scheduler.due(now))
+
+        #Case: idle, the interval doubles up to max_interval
+        scheduler.synchronized(False, now=now)
+        self.assertEqual(scheduler.next_sync, now + 10)
+        self.assertFalse(scheduler.due(now + 9))
+        scheduler.synchronized(False, now=now)
+        scheduler.synchronized(False, now=now)
+        self.assertEqual(scheduler.next_sync, now + 30)
+
+        #Case: longer interval suggested by the server, up to max_interval
+        scheduler.synchronized(False, suggested=60, now=now)
+        self.assertEqual(scheduler.next_sync, now + 30)
+        scheduler.local_activity(now)
+        scheduler.synchronized(False, suggested=20, now=now)
+        self.assertEqual(scheduler.next_sync, now + 20)
+
+        #Case: local activity, synchronize at once
+        scheduler.local_activity(now + 1)
+        self.assertTrue(scheduler.due(now + 1))
+
+        #Case: remote changes, back to min_interval
+        scheduler.synchronized(False, now=now)
+        scheduler.synchronized(True, suggested=60, now=now)
+        self.assertEqual(scheduler.next_sync, now + 5)
+
+        #Case: server unreachable
+        scheduler.failed(now)
+        self.assertEqual(scheduler.next_sync, now + 10)
+
+
+class SyncWorkerTest(unittest.TestCase):
+
+    class EventHandler(object):
+        def __init__(self):
+            self.pending = {}
+
+        def flush(self, now=None):
+            pass
+
+    class Outbox(object):
+        def __init__(self):
+            self.last_seq = 0
+            self.queued = 0
+            self.lock = threading.RLock()
+
+        def __len__(self):
+            return self.queued
+
+    class ServerCommunicator(object):
+        def __init__(self):
+            self.answers = []
+            self.poll_interval = None
+
+        def synchronize(self, operation_handler):
+            answer = self.answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+    def setUp(self):
+        self.outbox = SyncWorkerTest.Outbox()
+        self.server_com = SyncWorkerTest.ServerCommunicator()
+        self.scheduler = SyncScheduler(min_interval=5, max_interval=30)
+        self.worker = SyncWorker(
+            SyncWorkerTest.EventHandler(), self.outbox, self.server_com,
+            "mock", self.scheduler)
+
+    def test_run_once(self):
+        now = 1000
+        self.server_com.answers = [False]
+        self.worker.run_once(now)
+        self.assertEqual(self.worker.last_sync, now)
+        self.assertEqual(self.scheduler.next_sync, now + 10)
+
+        #Case: local changes queued, wait until they are sent
+        self.outbox.last_seq = 1
+        self.outbox.queued = 1
+        self.worker.run_once(now + 1)
+        self.assertEqual(self.worker.last_sync, now)
+        self.outbox.queued = 0
+        self.server_com.answers = [True]
+        self.worker.run_once(now + 2)
+        self.assertEqual(self.worker.last_sync, now + 2)
+        self.assertEqual(self.scheduler.next_sync, now + 7)
+
+        #Case: server unreachable
+        self.server_com.answers = [ServerUnreachable()]
+        self.worker.run_once(now + 7)
+        self.assertEqual(self.worker.state, "server unreachable")
+        self.assertEqual(self.worker.last_sync, now + 2)
+
+    def test_status(self):
+        self.outbox.queued = 3
+        status = self.worker.status()
+        self.assertEqual(status["result"], "idle")
+        self.assertIn("local changes queued: 3", status["details"])
+        self.assertIn("last synchronization: never", status["details"])
+
+    def test_thread(self):
+        self.server_com.answers = [False]
+        self.worker.tick = 0.01
+        self.worker.start()
+        stop = time.time() + 3
+        while self.worker.last_sync is None and time.time() < stop:
+            time.sleep(0.01)
+        self.worker.stop()
+        self.worker.join()
+        self.assertIsNotNone(self.worker.last_sync)
+
 
 class FileSystemOperatorTest(unittest.TestCase):
 
@@ -590,6 +1261,12 @@ class FileSystemOperatorTest(unittest.TestCase):
             def update_snapshot_upload(self, body):
                 self.upload = body
 
+            def cache_md5(self, abs_path, file_md5, stat):
+                self.cached = (abs_path, file_md5)
+
+            def cached_md5(self, abs_path):
+                return None
+
         self.client_path = '/tmp/user_dir'
         client_daemon.CONFIG_DIR_PATH = self.client_path
         self.filename = 'test_file_1.txt'
@@ -612,13 +1289,17 @@ class FileSystemOperatorTest(unittest.TestCase):
 
     def tearDown(self):
         httpretty.disable()
+        shutil.rmtree(self.client_path)
+
+    def ignored_events(self):
+        return sorted(self.event_handler.ignored_events.deadlines.keys())
 
     def test_add_event_to_ignore(self):
         test_path = "/test/path"
-        self.file_system_op.add_event_to_ignore(test_path)
+        self.file_system_op.add_event_to_ignore(test_path, ["created", "modified"])
         self.assertEqual(
-            self.event_handler.paths_ignored,
-            [test_path])
+            self.ignored_events(),
+            [(test_path, "created"), (test_path, "modified")])
 
     def test_write_a_file(self):
         source_path = '{}/{}'.format(self.client_path, self.filename)
@@ -628,20 +1309,77 @@ class FileSystemOperatorTest(unittest.TestCase):
         self.assertEqual(
             self.snapshot_manager.upload,
             {"src_path": source_path})
+        self.assertEqual(
+            self.snapshot_manager.cached,
+            (source_path, hashlib.md5('this is a test').hexdigest()))
         #check if source isadded by write_a_file
-        self.assertEqual([source_path], self.event_handler.paths_ignored)
+        self.assertEqual(
+            [(source_path, "created"), (source_path, "modified"), (source_path, "moved")],
+            self.ignored_events())
+        #check that the temporary file is gone
+        self.assertEqual(os.listdir(self.client_path), [self.filename])
+        #a new file gets the mode of the umask, not the 0600 of the temporary one
+        self.assertEqual(os.stat(source_path).st_mode & 0777, self.file_system_op.file_mode)
 
         #reset variable
         self.snapshot_manager.upload = False
-        self.event_handler.paths_ignored = []
+        self.event_handler.ignored_events = IgnoredEvents()
+
+        #Case: file overwritten, no create event expected, its mode is kept
+        os.chmod(source_path, 0640)
+        self.file_system_op.write_a_file(source_path)
+        self.assertEqual(
+            [(source_path, "modified"), (source_path, "moved")],
+            self.ignored_events())
+        self.assertEqual(os.stat(source_path).st_mode & 0777, 0640)
+        self.snapshot_manager.upload = False
+        self.event_handler.ignored_events = IgnoredEvents()
 
         #Case: file not found on server
-        def download_file(path):
-            return None, None
+        def download_file(path, out_file):
+            out_file.write('partial')
+            return False
         self.server_com.download_file = download_file
         self.file_system_op.write_a_file(source_path)
         self.assertFalse(self.snapshot_manager.upload)
-        self.assertEqual(self.event_handler.paths_ignored, [])
+        self.assertEqual(self.ignored_events(), [])
+        self.assertEqual(os.listdir(self.client_path), [self.filename])
+        self.assertEqual(open(source_path, 'rb').read(), 'this is a test')
+
+    def test_blob_cache(self):
+        cache_dir = os.path.join(self.client_path, '.cache')
+        blob_cache = BlobCache(cache_dir, 1000)
+        self.file_system_op.blob_cache = blob_cache
+        self.snapshot_manager.cached_md5 = lambda abs_path: hashlib.md5(
+            open(abs_path, 'rb').read()).hexdigest()
+        source_path = '{}/{}'.format(self.client_path, self.filename)
+        server_md5 = hashlib.md5('this is a test').hexdigest()
+        open(source_path, 'w').write('old content')
+
+        #Case: the overwritten content is kept
+        self.file_system_op.write_a_file(source_path, server_md5)
+        self.assertEqual(open(source_path, 'rb').read(), 'this is a test')
+        self.assertIn(hashlib.md5('old content').hexdigest(), blob_cache)
+        self.assertIn((source_path, 'deleted'), self.ignored_events())
+
+        #Case: deleted and asked back, no download
+        self.file_system_op.delete_a_file(source_path)
+        self.assertFalse(os.path.exists(source_path))
+        self.assertIn(server_md5, blob_cache)
+        self.server_com.download_file = None
+        self.file_system_op.write_a_file(source_path, server_md5)
+        self.assertEqual(open(source_path, 'rb').read(), 'this is a test')
+        self.assertNotIn(server_md5, blob_cache)
+        self.assertEqual(self.snapshot_manager.cached, (source_path, server_md5))
+        self.assertEqual(sorted(os.listdir(self.client_path)), ['.cache', self.filename])
+
+        #Case: the files of a deleted directory
+        sub_dir = os.path.join(self.client_path, 'sub_dir')
+        os.makedirs(sub_dir)
+        open(os.path.join(sub_dir, 'file.txt'), 'w').write('sub dir content')
+        self.file_system_op.delete_a_file(sub_dir)
+        self.assertFalse(os.path.exists(sub_dir))
+        self.assertIn(hashlib.md5('sub dir content').hexdigest(), blob_cache)
 
     def test_move_a_file(self):
         f_name = 'file_to_move.txt'
@@ -657,7 +1395,9 @@ class FileSystemOperatorTest(unittest.TestCase):
             self.snapshot_manager.move,
             {"src_path": source_path, "dst_path": dest_path})
         #check if source and dest path are added by move_a_file
-        self.assertEqual([source_path, dest_path], self.event_handler.paths_ignored)
+        self.assertEqual(
+            sorted([(source_path, "moved"), (dest_path, "moved")]),
+            self.ignored_events())
 
     def test_copy_a_file(self):
         f_name = 'file_to_copy.txt'
@@ -673,7 +1413,33 @@ class FileSystemOperatorTest(unittest.TestCase):
             self.snapshot_manager.copy,
             {"src_path": source_path, "dst_path": dest_path})
         #check if only dest_path is added by copy_a_file
-        self.assertEqual([dest_path], self.event_handler.paths_ignored)
+        self.assertEqual(
+            [(dest_path, "created"), (dest_path, "modified"), (dest_path, "moved")],
+            self.ignored_events())
+        #check that the temporary file is gone
+        self.assertEqual(sorted(os.listdir(self.client_path)), [f_name, f_name + '.copy'])
+
+        #Case: filesystem without reflinks
+        self.event_handler.ignored_events = IgnoredEvents()
+        with mock.patch('client_daemon.reflink', return_value=False):
+            self.file_system_op.copy_a_file(source_path, dest_path + '2')
+        self.assertEqual('this is a test', open(dest_path + '2', 'rb').read())
+
+        #Case: the copy gets the umask mode, or the one of the file it replaces
+        self.assertEqual(os.stat(dest_path + '2').st_mode & 0777, self.file_system_op.file_mode)
+        os.chmod(dest_path, 0640)
+        self.file_system_op.copy_a_file(source_path, dest_path)
+        self.assertEqual(os.stat(dest_path).st_mode & 0777, 0640)
+        self.assertNotEqual(os.stat(source_path).st_ino, os.stat(dest_path).st_ino)
+
+    def test_reflink(self):
+        src_path = os.path.join(self.client_path, 'src')
+        open(src_path, 'w').write('this is a test')
+        with open(src_path, 'rb') as src, open(src_path + '.clone', 'wb') as dst:
+            cloned = reflink(src, dst)
+        #only on filesystems with shared extents
+        if cloned:
+            self.assertEqual(open(src_path + '.clone', 'rb').read(), 'this is a test')
 
     def test_delete_a_file(self):
         del_dir = 'to_delete'
@@ -698,12 +1464,612 @@ class FileSystemOperatorTest(unittest.TestCase):
             self.snapshot_manager.delete,
             {"src_path": source_path})
         #check if only source_path is added by delete_a_file in the 2 tested case
-        self.assertEqual([file_to_delete.name, source_path], self.event_handler.paths_ignored)
+        self.assertEqual(
+            sorted([(file_to_delete.name, "deleted"), (source_path, "deleted")]),
+            self.ignored_events())
 
         #Case: wrong path
         self.file_system_op.delete_a_file('wrong/path')
 
 
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_states(self):
+        breaker = CircuitBreaker(failure_threshold=2, open_time=10, max_open_time=30)
+        now = 1000
+        self.assertEqual(breaker.wait_time(now), 0)
+
+        #Case: open after failure_threshold failures
+        breaker.failure(now)
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure(now)
+        self.assertEqual(breaker.state, 'open')
+        self.assertTrue(0 <= breaker.retry_at - now <= 10)
+
+        #Case: a single probe after the open time
+        self.assertEqual(breaker.wait_time(now + 10), 0)
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.wait_time(now + 10) > 0)
+
+        #Case: failed probe, open for twice the time up to max_open_time
+        breaker.failure(now + 10)
+        self.assertEqual(breaker.open_time, 20)
+        breaker.wait_time(breaker.retry_at)
+        breaker.failure(now + 40)
+        self.assertEqual(breaker.open_time, 30)
+
+        #Case: probe succeeded
+        breaker.wait_time(breaker.retry_at)
+        breaker.success()
+        self.assertEqual((breaker.state, breaker.open_time), ('closed', 10))
+
+        #Case: Retry-After opens it at once for at least the time asked
+        breaker.failure(now, retry_after=100)
+        self.assertEqual(breaker.state, 'open')
+        self.assertTrue(breaker.retry_at >= now + 100)
+
+        #Case: probe aborted by a local error, the next request probes
+        breaker.wait_time(breaker.retry_at)
+        breaker.abandon(now + 200)
+        self.assertEqual(breaker.wait_time(now + 200), 0)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_rate(self):
+        #Case: no limit
+        bucket = TokenBucket()
+        start = time.time()
+        for _ in range(100):
+            bucket.consume(10 ** 6)
+        self.assertLess(time.time() - start, 0.1)
+
+        #Case: 30000 bytes over the burst at 100000 bytes/s
+        bucket = TokenBucket(rate=100000, burst=10000)
+        start = time.time()
+        for _ in range(40):
+            bucket.consume(1000)
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+        #Case: the limit removed while a transfer waits
+        bucket = TokenBucket(rate=1000, burst=1000)
+        bucket.consume(100000)
+        threading.Timer(0.1, bucket.set_rate, [0]).start()
+        start = time.time()
+        bucket.consume(1000)
+        self.assertLess(time.time() - start, 1)
+
+    def test_priority(self):
+        bucket = TokenBucket(rate=10 ** 6)
+        #an interactive transfer is waiting
+        bucket.waiting[PRIORITY_INTERACTIVE] = 1
+        bulk = threading.Thread(target=bucket.consume, args=(1000,))
+        bulk.start()
+        bulk.join(0.1)
+        self.assertTrue(bulk.is_alive())
+
+        #Case: the bulk transfer goes on after it
+        with bucket.lock:
+            bucket.waiting[PRIORITY_INTERACTIVE] = 0
+            bucket.lock.notify_all()
+        bulk.join(1)
+        self.assertFalse(bulk.is_alive())
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        class ServerCommunicator(object):
+            def __init__(self):
+                self.calls = []
+                self.reachable = True
+                self.status_code = 201
+
+            def _call(self, *call):
+                if not self.reachable:
+                    raise ServerUnreachable()
+                if self.status_code is None:
+                    raise ValueError('broken response')
+                self.calls.append(call)
+                return mock.Mock(status_code=self.status_code)
+
+            def upload_file(self, dst_path, put_file=False):
+                return self._call('upload', dst_path, put_file)
+
+            def delete_file(self, dst_path):
+                return self._call('delete', dst_path)
+
+            def move_file(self, src_path, dst_path):
+                return self._call('move', src_path, dst_path)
+
+            def copy_file(self, src_path, dst_path):
+                return self._call('copy', src_path, dst_path)
+
+        self.test_dir = tempfile.mkdtemp()
+        self.outbox_path = os.path.join(self.test_dir, 'outbox.jsonl')
+        self.server_com = ServerCommunicator()
+        self.outbox = Outbox(self.outbox_path, self.server_com)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def send_all(self):
+        while self.outbox.send_next():
+            pass
+
+    def test_durable(self):
+        self.outbox.upload_file('/a.txt')
+        self.outbox.move_file('/b.txt', '/c.txt')
+        self.outbox.delete_file('/d.txt')
+        self.outbox.send_next()
+
+        #Case: restart of the daemon, only the calls not sent are left
+        reloaded = Outbox(self.outbox_path, self.server_com)
+        self.assertEqual(
+            [record['args'] for record in reloaded.pending.values()],
+            [['/b.txt', '/c.txt'], ['/d.txt']])
+        reloaded.copy_file('/d.txt', '/e.txt')
+        self.assertEqual(reloaded.pending.keys(), [2, 3, 4])
+
+        #Case: record truncated by a crash
+        with open(self.outbox_path, 'a') as records:
+            records.write('{"seq": 5, "meth')
+        self.assertEqual(len(Outbox(self.outbox_path, self.server_com)), 3)
+
+        #Case: queue drained, the file is emptied
+        while reloaded.send_next():
+            pass
+        self.assertEqual(open(self.outbox_path).read(), '')
+
+    def test_superseded(self):
+        #Case: consecutive uploads of a new file, a single update that
+        #upload_file sends as a create if the server doesn't have the file
+        self.outbox.upload_file('/a.txt')
+        self.outbox.upload_file('/a.txt', put_file=True)
+        self.assertEqual(
+            [record['args'] for record in self.outbox.pending.values()],
+            [['/a.txt', True]])
+
+        #Case: created and deleted offline, nothing to send
+        self.outbox.delete_file('/a.txt')
+        self.assertEqual(len(self.outbox), 0)
+
+        #Case: an update followed by a create is still an update
+        self.outbox.upload_file('/e.txt', put_file=True)
+        self.outbox.upload_file('/e.txt')
+        self.assertEqual(
+            [record['args'] for record in self.outbox.pending.values()],
+            [['/e.txt', True]])
+        self.outbox.delete_file('/e.txt')
+
+        #Case: updated and deleted offline, only the delete
+        self.outbox.upload_file('/b.txt', put_file=True)
+        self.outbox.delete_file('/b.txt')
+
+        #Case: a copy needs the upload of its source
+        self.outbox.upload_file('/c.txt')
+        self.outbox.copy_file('/c.txt', '/d.txt')
+        self.outbox.upload_file('/c.txt', put_file=True)
+        self.send_all()
+        self.assertEqual(self.server_com.calls, [
+            ('delete', '/e.txt'),
+            ('delete', '/b.txt'),
+            ('upload', '/c.txt', False),
+            ('copy', '/c.txt', '/d.txt'),
+            ('upload', '/c.txt', True),
+        ])
+
+    def test_unreachable(self):
+        self.server_com.reachable = False
+        self.outbox.upload_file('/a.txt')
+        self.assertFalse(self.outbox.send_next())
+        self.assertEqual(len(self.outbox), 1)
+
+        #Case: the server is back
+        self.server_com.reachable = True
+        self.assertTrue(self.outbox.send_next())
+        self.assertEqual(self.server_com.calls, [('upload', '/a.txt', False)])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_failures(self):
+        #Case: server error, the call is kept for later
+        self.server_com.status_code = 500
+        self.outbox.upload_file('/a.txt')
+        self.assertFalse(self.outbox.send_next())
+        self.assertEqual(len(self.outbox), 1)
+
+        #Case: the call raised, kept as well
+        self.server_com.status_code = None
+        self.assertFalse(self.outbox.send_next())
+        self.assertEqual(len(self.outbox), 1)
+
+        #Case: refused by the server, dropped
+        self.server_com.status_code = 404
+        self.assertTrue(self.outbox.send_next())
+        self.assertEqual(len(self.outbox), 0)
+
+        #Case: the local file can't be read, dropped
+        self.server_com.upload_file = lambda dst_path, put_file=False: False
+        self.outbox.upload_file('/b.txt')
+        self.assertTrue(self.outbox.send_next())
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_small_uploads_lane(self):
+        small_path = os.path.join(self.test_dir, 'small.txt')
+        big_path = os.path.join(self.test_dir, 'big.bin')
+        open(small_path, 'w').write('small')
+        with open(big_path, 'wb') as big:
+            big.truncate(client_daemon.SMALL_TRANSFER_SIZE + 1)
+        self.outbox.upload_file(big_path)
+        self.outbox.move_file(small_path + '.old', small_path)
+        self.outbox.upload_file(small_path + '.copy')
+        open(small_path + '.copy', 'w').write('small')
+
+        #Case: nothing in flight on the sender, the lane waits
+        self.assertFalse(self.outbox.send_small())
+
+        #Case: a big upload in flight, an independent small one goes first;
+        #the one after a move on its path waits its turn
+        lane_calls = []
+
+        def upload_file(dst_path, put_file=False):
+            if dst_path == big_path:
+                self.assertTrue(self.outbox.send_small())
+                self.assertFalse(self.outbox.send_small())
+                lane_calls.extend(self.server_com.calls)
+            return self.server_com._call('upload', dst_path, put_file)
+        self.server_com.upload_file = upload_file
+        self.outbox.upload_file(small_path, put_file=True)
+        with mock.patch('client_daemon.CONFIG_DIR_PATH', self.test_dir):
+            self.send_all()
+        self.assertEqual(lane_calls, [('upload', small_path + '.copy', False)])
+        self.assertEqual(self.server_com.calls, [
+            ('upload', small_path + '.copy', False),
+            ('upload', big_path, False),
+            ('move', small_path + '.old', small_path),
+            ('upload', small_path, True),
+        ])
+        self.assertEqual(open(self.outbox_path).read(), '')
+
+    def test_synchronization_lock(self):
+        #Case: while the synchronization holds the lock no call is sent
+        self.outbox.upload_file('/a.txt')
+        sender = threading.Thread(target=self.outbox.send_next)
+        with self.outbox.lock:
+            sender.start()
+            time.sleep(0.2)
+            self.assertEqual(self.server_com.calls, [])
+        sender.join(3)
+        self.assertEqual(self.server_com.calls, [('upload', '/a.txt', False)])
+
+        #Case: the synchronization waits for the call in flight and the
+        #lane doesn't start another one meanwhile
+        small_path = os.path.join(self.test_dir, 'small.txt')
+        big_path = os.path.join(self.test_dir, 'big.bin')
+        open(small_path, 'w').write('small')
+        sending = threading.Event()
+        release = threading.Event()
+        upload = self.server_com.upload_file
+
+        def upload_file(dst_path, put_file=False):
+            if dst_path == big_path:
+                sending.set()
+                release.wait(3)
+            return upload(dst_path, put_file)
+        self.server_com.upload_file = upload_file
+        self.outbox.upload_file(big_path)
+        self.outbox.upload_file(small_path)
+        synchronized = []
+
+        def synchronize():
+            with self.outbox.lock:
+                synchronized.append(list(self.server_com.calls))
+        threads = [threading.Thread(target=self.outbox.send_next)]
+        threads[0].start()
+        sending.wait(3)
+        threads.append(threading.Thread(target=synchronize))
+        threads[1].start()
+        time.sleep(0.2)
+        with mock.patch('client_daemon.CONFIG_DIR_PATH', self.test_dir):
+            threads.append(threading.Thread(target=self.outbox.send_small))
+            threads[2].start()
+            time.sleep(0.2)
+            release.set()
+            for thread in threads:
+                thread.join(3)
+        self.assertEqual(synchronized, [[
+            ('upload', '/a.txt', False),
+            ('upload', big_path, False),
+        ]])
+        self.assertEqual(len(self.outbox), 1)
+
+    def test_sender(self):
+        self.outbox.retry_delay = 0.1
+        self.outbox.start()
+        try:
+            self.outbox.upload_file('/a.txt')
+            stop = time.time() + 3
+            while len(self.outbox) and time.time() < stop:
+                time.sleep(0.05)
+            self.assertEqual(self.server_com.calls, [('upload', '/a.txt', False)])
+        finally:
+            self.outbox.stop()
+            self.outbox.join()
+
+
+class MultipartFileStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.test_dir, 'file.bin')
+        self.content = ''.join(chr(i % 256) for i in range(200000))
+        open(self.file_path, 'wb').write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def parse(self, stream, block_size):
+        body = []
+        block = stream.read(block_size)
+        while block:
+            body.append(block)
+            block = stream.read(block_size)
+        body = ''.join(body)
+        if stream.len is not None:
+            self.assertEqual(len(body), stream.len)
+        environ = {
+            'wsgi.input': StringIO.StringIO(body),
+            'CONTENT_LENGTH': str(len(body)),
+            'CONTENT_TYPE': stream.content_type,
+            'REQUEST_METHOD': 'POST',
+        }
+        _, form, files = parse_form_data(environ)
+        self.encoding = form.get('file_encoding')
+        self.base_md5 = form.get('base_md5')
+        self.file_size = form.get('file_size')
+        return form['file_md5'], files['file_content'].read()
+
+    def test_stream(self):
+        stream = MultipartFileStream(self.file_path)
+        file_md5, content = self.parse(stream, 1000)
+        self.assertEqual(content, self.content)
+        self.assertEqual(file_md5, hashlib.md5(self.content).hexdigest())
+        self.assertEqual(stream.hexdigest(), file_md5)
+        self.assertIsNone(stream.file_object)
+
+        #Case: md5 already known, the file is not hashed
+        stream = MultipartFileStream(self.file_path, 'known_md5'.ljust(32, '0'))
+        file_md5, content = self.parse(stream, 100000)
+        self.assertEqual(content, self.content)
+        self.assertEqual(file_md5, 'known_md5'.ljust(32, '0'))
+        self.assertIsNone(stream.hasher)
+
+        #Case: file truncated while uploading, the request is aborted
+        stream = MultipartFileStream(self.file_path)
+        open(self.file_path, 'wb').write('short')
+        self.assertRaises(IOError, self.parse, stream, 4096)
+
+    def test_compressed_stream(self):
+        stream = MultipartFileStream(self.file_path, encoding='gzip')
+        #compressed while it's read, the size is unknown
+        self.assertIsNone(stream.len)
+        file_md5, content = self.parse(stream, 1000)
+        self.assertEqual(self.encoding, 'gzip')
+        self.assertEqual(self.file_size, str(len(self.content)))
+        self.assertLess(len(content), len(self.content) / 10)
+        self.assertEqual(zlib.decompress(content, 16 + zlib.MAX_WBITS), self.content)
+        #the md5 is the one of the file
+        self.assertEqual(file_md5, hashlib.md5(self.content).hexdigest())
+
+        #Case: content that doesn't compress, sent as it is
+        random_content = os.urandom(100000)
+        open(self.file_path, 'wb').write(random_content)
+        stream = MultipartFileStream(self.file_path, encoding='gzip')
+        self.assertEqual(stream.len, len(stream.head) + len(random_content) + len(stream._tail('0' * 32)))
+        file_md5, content = self.parse(stream, 1000)
+        self.assertIsNone(self.encoding)
+        self.assertIsNone(self.file_size)
+        self.assertEqual(content, random_content)
+        self.assertEqual(file_md5, hashlib.md5(random_content).hexdigest())
+
+        #Case: already compressed file types are not even tried
+        self.assertFalse(client_daemon.compressible('video.MP4', 10 ** 6))
+        self.assertFalse(client_daemon.compressible('small.txt', 10))
+        self.assertTrue(client_daemon.compressible('data.csv', 10 ** 6))
+
+    def signatures(self, content, block_size):
+        blocks = [content[i:i + block_size] for i in range(0, len(content), block_size)]
+        return {
+            'md5': hashlib.md5(content).hexdigest(),
+            'block_size': block_size,
+            'blocks': [
+                [client_daemon.weak_checksum(block), hashlib.md5(block).hexdigest()]
+                for block in blocks],
+        }
+
+    def apply_delta(self, delta, base):
+        delta = StringIO.StringIO(delta)
+        result = []
+        op = delta.read(1)
+        while op:
+            if op == 'C':
+                offset, length = client_daemon.DELTA_COPY.unpack(
+                    delta.read(client_daemon.DELTA_COPY.size))
+                result.append(base[offset:offset + length])
+            else:
+                length, = client_daemon.DELTA_LITERAL.unpack(
+                    delta.read(client_daemon.DELTA_LITERAL.size))
+                result.append(delta.read(length))
+            op = delta.read(1)
+        return ''.join(result)
+
+    def test_rsync_delta(self):
+        base = os.urandom(100000)
+        signatures = self.signatures(base, 2048)
+        edits = [
+            base,
+            base[:5000] + 'X' + base[5001:],
+            base[:30000] + 'inserted' + base[30000:],
+            base[:40000] + base[41000:],
+            base + 'appended',
+        ]
+        for content in edits:
+            open(self.file_path, 'wb').write(content)
+            delta = StringIO.StringIO()
+            with open(self.file_path, 'rb') as file_object:
+                file_md5 = client_daemon.rsync_delta(file_object, signatures, delta)
+            self.assertEqual(file_md5, hashlib.md5(content).hexdigest())
+            self.assertEqual(self.apply_delta(delta.getvalue(), base), content)
+            self.assertLess(len(delta.getvalue()), 5000)
+
+        #Case: the rolled checksum is the adler32 of the window
+        self.assertEqual(
+            client_daemon.weak_checksum(base[1:2049]),
+            self.roll(base[0:2048], base[0], base[2048]))
+
+        #Case: nothing in common, a full upload is cheaper
+        open(self.file_path, 'wb').write(os.urandom(100000))
+        with open(self.file_path, 'rb') as file_object:
+            self.assertIsNone(
+                client_daemon.rsync_delta(file_object, signatures, StringIO.StringIO()))
+
+    def roll(self, window, out_byte, in_byte):
+        weak = client_daemon.weak_checksum(window)
+        a, b = weak & 0xffff, weak >> 16
+        a = (a - ord(out_byte) + ord(in_byte)) % client_daemon.ADLER_MOD
+        b = (b - len(window) * ord(out_byte) + a - 1) % client_daemon.ADLER_MOD
+        return b << 16 | a
+
+    def test_delta_stream(self):
+        signatures = self.signatures(self.content, 2048)
+        new_content = self.content[:1000] + 'changed' + self.content[1007:]
+        open(self.file_path, 'wb').write(new_content)
+        stream = MultipartFileStream(self.file_path, encoding='gzip', signatures=signatures)
+        file_md5, content = self.parse(stream, 1000)
+        self.assertEqual(self.encoding, 'rsync-delta')
+        self.assertEqual(self.base_md5, signatures['md5'])
+        self.assertEqual(self.file_size, str(len(new_content)))
+        self.assertEqual(file_md5, hashlib.md5(new_content).hexdigest())
+        self.assertEqual(self.apply_delta(content, self.content), new_content)
+        self.assertLess(len(content), 3000)
+
+        #Case: delta not worth it, compressed as usual
+        open(self.file_path, 'wb').write('a' * 200000)
+        stream = MultipartFileStream(self.file_path, encoding='gzip', signatures=signatures)
+        file_md5, content = self.parse(stream, 1000)
+        self.assertEqual(self.encoding, 'gzip')
+        self.assertIsNone(self.base_md5)
+        self.assertEqual(file_md5, hashlib.md5('a' * 200000).hexdigest())
+
+    def test_chunk_file(self):
+        base = os.urandom(2000000)
+        open(self.file_path, 'wb').write(base)
+        with open(self.file_path, 'rb') as file_object:
+            file_md5, chunks = client_daemon.chunk_file(file_object)
+        self.assertEqual(file_md5, hashlib.md5(base).hexdigest())
+        self.assertEqual(''.join(base[o:o + l] for _, o, l in chunks), base)
+        for chunk_md5, offset, length in chunks[:-1]:
+            self.assertTrue(
+                client_daemon.CHUNK_MIN_SIZE <= length <= client_daemon.CHUNK_MAX_SIZE)
+            self.assertEqual(chunk_md5, hashlib.md5(base[offset:offset + length]).hexdigest())
+
+        #Case: an insertion changes only the chunk around it
+        content = base[:1000000] + 'inserted' + base[1000000:]
+        open(self.file_path, 'wb').write(content)
+        with open(self.file_path, 'rb') as file_object:
+            _, new_chunks = client_daemon.chunk_file(file_object)
+        new_md5s = set(chunk[0] for chunk in new_chunks)
+        self.assertEqual(len([c for c in chunks if c[0] not in new_md5s]), 1)
+
+        #Case: the stream sends only the list of the chunks
+        stream = MultipartFileStream(self.file_path, 'file_md5'.ljust(32, '0'), chunks=new_chunks)
+        file_md5, content = self.parse(stream, 1000)
+        self.assertEqual(self.encoding, 'chunks')
+        self.assertEqual(self.file_size, str(len(base) + len('inserted')))
+        self.assertEqual(file_md5, 'file_md5'.ljust(32, '0'))
+        self.assertEqual(content.split(), [chunk[0] for chunk in new_chunks])
+
+
+class BlobCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.test_dir, 'cache')
+        self.blob_cache = BlobCache(self.cache_dir, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.test_dir, name)
+        open(path, 'w').write(content)
+        return path
+
+    def test_add_take(self):
+        path = self.write('a.txt', 'aaaa')
+        self.assertTrue(self.blob_cache.add(path, 'md5_a'))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.blob_cache.size, 4)
+
+        #Case: same content again, the file is removed
+        path = self.write('a_copy.txt', 'aaaa')
+        self.assertTrue(self.blob_cache.add(path, 'md5_a'))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.blob_cache.size, 4)
+
+        dst_path = os.path.join(self.test_dir, 'restored.txt')
+        self.assertTrue(self.blob_cache.take('md5_a', dst_path))
+        self.assertEqual(open(dst_path).read(), 'aaaa')
+        self.assertNotIn('md5_a', self.blob_cache)
+        self.assertEqual(self.blob_cache.size, 0)
+        self.assertFalse(self.blob_cache.take('md5_a', dst_path))
+
+        #Case: bigger than the whole cache, left in place
+        path = self.write('big.txt', 'b' * 11)
+        self.assertFalse(self.blob_cache.add(path, 'md5_big'))
+        self.assertTrue(os.path.exists(path))
+
+    def test_eviction(self):
+        self.blob_cache.add(self.write('a.txt', 'aaaa'), 'md5_a')
+        self.blob_cache.add(self.write('b.txt', 'bbbb'), 'md5_b')
+        #a is used again, b is the least recently used
+        self.blob_cache.add(self.write('a_copy.txt', 'aaaa'), 'md5_a')
+        self.blob_cache.add(self.write('c.txt', 'cccc'), 'md5_c')
+        self.assertNotIn('md5_b', self.blob_cache)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['md5_a', 'md5_c'])
+
+        #Case: the cache is found again at restart, limited to the new size
+        os.utime(os.path.join(self.cache_dir, 'md5_a'), (1, 1))
+        blob_cache = BlobCache(self.cache_dir, 5)
+        self.assertEqual(blob_cache.blobs.keys(), ['md5_c'])
+        self.assertEqual(blob_cache.size, 4)
+
+    def test_location(self):
+        #Case: a relative path is next to the snapshot file, not in the working directory
+        snapshot_file = os.path.join(self.test_dir, 'snapshot_file.json')
+        self.assertEqual(
+            client_daemon.blob_cache_path('blob_cache', snapshot_file),
+            os.path.join(self.test_dir, 'blob_cache'))
+        self.assertEqual(
+            client_daemon.blob_cache_path('/var/cache/rawbox', snapshot_file),
+            '/var/cache/rawbox')
+
+        #Case: on another device than the sync root, a warning
+        with mock.patch('client_daemon.logger') as logger:
+            BlobCache(self.cache_dir, 10, sync_root=self.test_dir)
+            self.assertFalse(logger.warning.called)
+            device = os.stat(self.test_dir).st_dev
+
+            def stat(path):
+                st = os.stat_result(os.lstat(path))
+                if path == self.test_dir:
+                    return os.stat_result(st[:2] + (device + 1,) + st[3:])
+                return st
+            with mock.patch('client_daemon.os.stat', stat):
+                BlobCache(self.cache_dir, 10, sync_root=self.test_dir)
+            self.assertEqual(logger.warning.call_count, 1)
+
+
 class LoadConfigTest(unittest.TestCase):
 
     CONFIG_ONLY_CMD_SECTION = "test_config_only_cmd_section.ini"
@@ -732,8 +2098,20 @@ class LoadConfigTest(unittest.TestCase):
             "stdout_log_level": "DEBUG",
             "file_log_level": "ERROR",
             "dir_path": self.DIR_PATH,
-            "snapshot_file_path": "snapshot_file.json"
-
+            "snapshot_file_path": "snapshot_file.json",
+            "watcher": client_daemon.WATCHER,
+            "settle_window": client_daemon.SETTLE_WINDOW,
+            "outbox_file_path": client_daemon.OUTBOX_FILE_PATH,
+            "retry_base_delay": client_daemon.RETRY_BASE_DELAY,
+            "retry_max_delay": client_daemon.RETRY_MAX_DELAY,
+            "sync_min_interval": client_daemon.SYNC_MIN_INTERVAL,
+            "sync_max_interval": client_daemon.SYNC_MAX_INTERVAL,
+            "sync_exclude": client_daemon.SYNC_EXCLUDE,
+            "sync_include": client_daemon.SYNC_INCLUDE,
+            "upload_limit": client_daemon.UPLOAD_LIMIT,
+            "download_limit": client_daemon.DOWNLOAD_LIMIT,
+            "blob_cache_path": client_daemon.BLOB_CACHE_PATH,
+            "blob_cache_size": client_daemon.BLOB_CACHE_SIZE,
         }
 
         config_with_daemon_conf = ConfigParser.ConfigParser()
@@ -765,7 +2143,20 @@ class LoadConfigTest(unittest.TestCase):
             "file_log_level":
                 config_with_daemon_conf.get("daemon_communication", "file_log_level"),
             "dir_path": config_with_daemon_conf.get("daemon_communication", "dir_path"),
-            "snapshot_file_path": config_with_daemon_conf.get("daemon_communication", "snapshot_file_path")
+            "snapshot_file_path": config_with_daemon_conf.get("daemon_communication", "snapshot_file_path"),
+            "watcher": client_daemon.WATCHER,
+            "settle_window": client_daemon.SETTLE_WINDOW,
+            "outbox_file_path": client_daemon.OUTBOX_FILE_PATH,
+            "retry_base_delay": client_daemon.RETRY_BASE_DELAY,
+            "retry_max_delay": client_daemon.RETRY_MAX_DELAY,
+            "sync_min_interval": client_daemon.SYNC_MIN_INTERVAL,
+            "sync_max_interval": client_daemon.SYNC_MAX_INTERVAL,
+            "sync_exclude": client_daemon.SYNC_EXCLUDE,
+            "sync_include": client_daemon.SYNC_INCLUDE,
+            "upload_limit": client_daemon.UPLOAD_LIMIT,
+            "download_limit": client_daemon.DOWNLOAD_LIMIT,
+            "blob_cache_path": client_daemon.BLOB_CACHE_PATH,
+            "blob_cache_size": client_daemon.BLOB_CACHE_SIZE,
         }
 
         config_with_user_conf = ConfigParser.ConfigParser()
@@ -782,6 +2173,8 @@ class LoadConfigTest(unittest.TestCase):
         config_with_user_conf.set("daemon_communication", "crash_repo_path", self.CRASH_LOG_PATH)
         config_with_user_conf.set("daemon_communication", "stdout_log_level", "DEBUG")
         config_with_user_conf.set("daemon_communication", "file_log_level", "ERROR")
+        config_with_user_conf.set("daemon_communication", "watcher", "polling")
+        config_with_user_conf.set("daemon_communication", "settle_window", "0.5")
         config_with_user_conf.set('daemon_user_data', 'username', "example_username")
         config_with_user_conf.set('daemon_user_data', 'password', "example_password")
         config_with_user_conf.set('daemon_user_data', 'active', True)
@@ -802,6 +2195,19 @@ class LoadConfigTest(unittest.TestCase):
                 config_with_user_conf.get("daemon_communication", "file_log_level"),
             "dir_path": config_with_user_conf.get("daemon_communication", "dir_path"),
             "snapshot_file_path": config_with_user_conf.get("daemon_communication", "snapshot_file_path"),
+            "watcher": "polling",
+            "settle_window": "0.5",
+            "outbox_file_path": client_daemon.OUTBOX_FILE_PATH,
+            "retry_base_delay": client_daemon.RETRY_BASE_DELAY,
+            "retry_max_delay": client_daemon.RETRY_MAX_DELAY,
+            "sync_min_interval": client_daemon.SYNC_MIN_INTERVAL,
+            "sync_max_interval": client_daemon.SYNC_MAX_INTERVAL,
+            "sync_exclude": client_daemon.SYNC_EXCLUDE,
+            "sync_include": client_daemon.SYNC_INCLUDE,
+            "upload_limit": client_daemon.UPLOAD_LIMIT,
+            "download_limit": client_daemon.DOWNLOAD_LIMIT,
+            "blob_cache_path": client_daemon.BLOB_CACHE_PATH,
+            "blob_cache_size": client_daemon.BLOB_CACHE_SIZE,
             "username": config_with_user_conf.get("daemon_user_data", "username"),
             "password": config_with_user_conf.get("daemon_user_data", "password")
         }
@@ -842,11 +2248,15 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.environment.remove()
 
     def snapshotAsserEqual(self, snap1, snap2):
-        for item1, item2 in zip(snap1, snap2):
-            snap1[item1].sort()
-            snap2[item2].sort()
+        snap1 = dict((md5, sorted(paths)) for md5, paths in snap1.items())
+        snap2 = dict((md5, sorted(paths)) for md5, paths in snap2.items())
         self.assertEqual(snap1, snap2)
 
+    def snapshot_copy(self):
+        """ the local snapshot as a dictionary of lists """
+        return dict(
+            (md5, list(paths)) for md5, paths in self.snapshot_manager.local_full_snapshot.items())
+
     def cmdListAsserEqual(self, snap1, snap2):
         snap1.sort()
         snap2.sort()
@@ -884,6 +2294,201 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.assertEqual(['sub_dir_2/test_file_4.txt'], new_server)
         self.assertEqual(['sub_dir_1/test_file_1.txt'], equal)
 
+    def test_merkle_diff(self):
+        #server tree: sub_dir_1 equal, sub_dir_2 with a modified file,
+        #   a new directory and a new file in root
+        server_tree = MerkleTree.from_snapshot({
+            'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt'],
+            '81bcb26fd4acfaa5d0acc7eef1d3013a': ['sub_dir_2/test_file_2.txt'],
+            'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa': ['sub_dir_2/test_file_3.txt'],
+            'bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb': ['new_dir/deep/new_file.txt', 'root_file.txt'],
+        })
+        requests_done = []
+
+        def get_server_node(dir_path, recursive=False):
+            requests_done.append((dir_path, recursive))
+            node = server_tree.dirs.get(dir_path)
+            if node is None:
+                return None
+            if recursive:
+                files = [(path[len(dir_path) + 1:], md5) for path, md5 in server_tree.iter_files(dir_path)]
+                dirs = {}
+            else:
+                files = node['files'].items()
+                dirs = dict((name, server_tree.dirs["/".join(filter(None, [dir_path, name]))]['hash'])
+                            for name in node['dirs'])
+            return {
+                'hash': node['hash'],
+                'timestamp': self.unsinked_timestamp,
+                'dirs': dirs,
+                'files': dict((name, {'md5': md5, 'timestamp': self.unsinked_timestamp, 'size': 10})
+                              for name, md5 in files),
+            }
+
+        #a local only directory
+        local_only = os.path.join(self.test_share_dir, 'local_dir', 'local_file.txt')
+        os.makedirs(os.path.dirname(local_only))
+        open(local_only, 'w').write('only local')
+        self.snapshot_manager.update_snapshot_upload({'src_path': local_only})
+        self.snapshot_manager.save_snapshot(self.sinked_timestamp)
+        local_only_md5 = self.snapshot_manager.file_snapMd5(local_only)
+
+        server_snapshot, client_snapshot, stream_dirs = self.snapshot_manager.merkle_diff(
+            get_server_node(''), get_server_node)
+
+        self.assertEqual(server_snapshot, {
+            'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa': [
+                {'path': 'sub_dir_2/test_file_3.txt', 'timestamp': self.unsinked_timestamp, 'size': 10}],
+            'bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb': [
+                {'path': 'root_file.txt', 'timestamp': self.unsinked_timestamp, 'size': 10}],
+        })
+        self.assertEqual(client_snapshot, {
+            'd1e2ac797b8385e792ac1e31db4a81f9': ['sub_dir_2/test_file_3.txt'],
+            local_only_md5: ['local_dir/local_file.txt'],
+        })
+        #the equal directory is never requested, the new one is streamed
+        self.assertEqual(
+            sorted(requests_done),
+            [('', False), ('sub_dir_2', False)])
+        self.assertEqual(stream_dirs, ['new_dir'])
+
+        #the restricted snapshots give the same commands of the full ones
+        result = self.snapshot_manager.syncronize_dispatcher(
+            self.unsinked_timestamp, server_snapshot, client_snapshot)
+        self.cmdListAsserEqual(result, [
+            {'local_download': ['root_file.txt']},
+            {'local_download': ['sub_dir_2/test_file_3.txt']},
+            {'local_delete': ['local_dir/local_file.txt']},
+        ])
+
+        #Case: more different files than a batch, the whole tree is streamed
+        original_batch_size = client_daemon.SYNC_BATCH_SIZE
+        client_daemon.SYNC_BATCH_SIZE = 2
+        try:
+            self.assertEqual(
+                self.snapshot_manager.merkle_diff(get_server_node(''), get_server_node),
+                ({}, {}, ['']))
+        finally:
+            client_daemon.SYNC_BATCH_SIZE = original_batch_size
+
+        #Case: selective sync, the excluded subtree is never requested
+        self.snapshot_manager.selective_sync = SelectiveSync(['new_dir', 'sub_dir_2'], ['sub_dir_2/test_file_3.txt'])
+        del requests_done[:]
+        server_snapshot, client_snapshot, stream_dirs = self.snapshot_manager.merkle_diff(
+            get_server_node(''), get_server_node)
+        self.assertEqual(
+            sorted(requests_done),
+            [('', False), ('sub_dir_2', False)])
+        self.assertEqual(stream_dirs, [])
+        result = self.snapshot_manager.syncronize_dispatcher(
+            self.unsinked_timestamp, server_snapshot, client_snapshot)
+        self.cmdListAsserEqual(result, [
+            {'local_download': ['root_file.txt']},
+            {'local_download': ['sub_dir_2/test_file_3.txt']},
+            {'local_delete': ['local_dir/local_file.txt']},
+        ])
+
+    def test_stream_dispatcher(self):
+        def server_file(path, md5, timestamp):
+            return {'path': path, 'md5': md5, 'timestamp': timestamp, 'size': 10}
+
+        #sorted by path:
+        #   sub_dir_1/test_file_1.txt modified
+        #   sub_dir_1/test_file_2.txt copied
+        #   sub_dir_2/test_file_3.txt deleted
+        #   sub_dir_2/test_file_4.txt added
+        server_files = [
+            server_file(u'sub_dir_1/test_file_1.txt', 'fea80f2db004d4ebc4536023814aa885', self.unsinked_timestamp),
+            server_file(u'sub_dir_1/test_file_2.txt', '81bcb26fd4acfaa5d0acc7eef1d3013a', self.sinked_timestamp),
+            server_file(u'sub_dir_2/test_file_2.txt', '81bcb26fd4acfaa5d0acc7eef1d3013a', self.sinked_timestamp),
+            server_file(u'sub_dir_2/test_file_4.txt', '456jk3b334bb33463463fbhj4b3534t3', self.unsinked_timestamp),
+        ]
+
+        #Case: synchronized, nothing is compared
+        self.assertEqual(
+            list(self.snapshot_manager.stream_dispatcher(self.sinked_timestamp, iter(server_files))), [])
+
+        #Case: the commands of syncronize_dispatcher, a batch at time, deletes last
+        original_batch_size = client_daemon.SYNC_BATCH_SIZE
+        client_daemon.SYNC_BATCH_SIZE = 2
+        try:
+            batches = list(self.snapshot_manager.stream_dispatcher(
+                self.unsinked_timestamp, iter(server_files)))
+        finally:
+            client_daemon.SYNC_BATCH_SIZE = original_batch_size
+        self.assertEqual([command_list for command_list, _, _ in batches], [
+            [
+                {'local_copy': ['sub_dir_2/test_file_2.txt', u'sub_dir_1/test_file_2.txt']},
+                {'local_download': [u'sub_dir_1/test_file_1.txt']},
+            ],
+            [{'local_download': [u'sub_dir_2/test_file_4.txt']}],
+            [{'local_delete': ['sub_dir_2/test_file_3.txt']}],
+        ])
+        #the snapshots of a batch have only its different files
+        command_list, server_snapshot, client_snapshot = batches[0]
+        self.assertEqual(client_snapshot, {
+            'fea80f2db003d4ebc4536023814aa885': [u'sub_dir_1/test_file_1.txt']})
+        self.assertEqual(sorted(server_snapshot), [
+            '81bcb26fd4acfaa5d0acc7eef1d3013a', 'fea80f2db004d4ebc4536023814aa885'])
+        self.assertEqual(
+            server_snapshot['fea80f2db004d4ebc4536023814aa885'],
+            [{'path': u'sub_dir_1/test_file_1.txt', 'timestamp': self.unsinked_timestamp, 'size': 10}])
+
+    def test_optimize_plan(self):
+        def server_file(path, size):
+            return {'path': path, 'timestamp': self.unsinked_timestamp, 'size': size}
+
+        #Case: local side, each missing content downloaded once, small first
+        server_snapshot = {
+            'x' * 32: [server_file('new/a.txt', 100), server_file('new/b.txt', 100)],
+            'y' * 32: [server_file('small.txt', 5)],
+            'fea80f2db003d4ebc4536023814aa885': [
+                server_file('copy_of_1.txt', 26), server_file('sub_dir_2/test_file_2.txt', 26)],
+        }
+        command_list = [
+            {'local_download': ['new/a.txt']},
+            {'local_download': ['new/b.txt']},
+            {'local_download': ['small.txt']},
+            {'local_copy': ['sub_dir_1/test_file_1.txt', 'copy_of_1.txt']},
+            {'local_download': ['sub_dir_2/test_file_2.txt']},
+            {'local_delete': ['sub_dir_2/test_file_3.txt']},
+        ]
+        self.assertEqual(
+            self.snapshot_manager.optimize_plan(command_list, server_snapshot), [
+                {'local_copy': ['sub_dir_1/test_file_1.txt', 'copy_of_1.txt']},
+                {'local_copy': ['sub_dir_1/test_file_1.txt', 'sub_dir_2/test_file_2.txt']},
+                {'local_download': ['small.txt', 'y' * 32]},
+                {'local_download': ['new/a.txt', 'x' * 32]},
+                {'local_copy': ['new/a.txt', 'new/b.txt']},
+                {'local_delete': ['sub_dir_2/test_file_3.txt']},
+            ])
+        self.assertEqual(
+            self.snapshot_manager.last_plan,
+            {'commands': 6, 'download_bytes': 105, 'upload_bytes': 0})
+
+        #Case: remote side, content already on server copied there
+        conflicted = 'sub_dir_1/test_file_1.txt.conflicted'
+        server_snapshot = {
+            'fea80f2db003d4ebc4536023814aa885': [server_file('sub_dir_1/test_file_1.txt', 26)],
+            'z' * 32: [server_file('old.txt', 3)],
+        }
+        command_list = [
+            {'remote_delete': ['old.txt']},
+            {'remote_upload': ['sub_dir_2/test_file_3.txt']},
+            {'local_copy': ['sub_dir_1/test_file_1.txt', conflicted]},
+            {'remote_upload': [conflicted]},
+            {'remote_update': ['sub_dir_2/test_file_2.txt', True]},
+        ]
+        self.assertEqual(
+            self.snapshot_manager.optimize_plan(command_list, server_snapshot), [
+                {'local_copy': ['sub_dir_1/test_file_1.txt', conflicted]},
+                {'remote_copy': ['sub_dir_1/test_file_1.txt', conflicted]},
+                {'remote_update': ['sub_dir_2/test_file_2.txt', True]},
+                {'remote_upload': ['sub_dir_2/test_file_3.txt']},
+                {'remote_delete': ['old.txt']},
+            ])
+        self.assertEqual(self.snapshot_manager.last_plan['upload_bytes'], 27 + 34)
+
     def test_check_files_timestamp(self):
         #server snapshot unsinket with local path:
         #   sub_dir_1/test_file_1.txt unmodified
@@ -1075,6 +2680,106 @@ class DirSnapshotManagerTest(unittest.TestCase):
     def test_global_md5(self):
         self.assertEqual(self.snapshot_manager.global_md5(), self.md5_snapshot)
 
+        #Case: the update of the snapshot update the global md5
+        new_file = os.path.join(self.test_folder_1, 'new_file.txt')
+        open(new_file, 'w').write('new content')
+        self.snapshot_manager.update_snapshot_upload({"src_path": new_file})
+        self.assertNotEqual(self.snapshot_manager.global_md5(), self.md5_snapshot)
+
+        #Case: back to the original directory, back to the original md5
+        self.snapshot_manager.update_snapshot_delete({"src_path": new_file})
+        self.assertEqual(self.snapshot_manager.global_md5(), self.md5_snapshot)
+
+    def test_cached_md5(self):
+        true_md5 = hashlib.md5(open(self.test_file_1, 'rb').read()).hexdigest()
+        self.assertEqual(self.snapshot_manager.cached_md5(self.test_file_1), true_md5)
+
+        #Case: the md5 of the files in the snapshot are cached in the tree
+        self.assertEqual(self.snapshot_manager.md5_cache, {})
+        self.assertIsNotNone(
+            self.snapshot_manager.merkle_tree.get_stat('sub_dir_1/test_file_1.txt'))
+
+        #Case: a cached md5 is not computed again
+        self.snapshot_manager.cache_md5(self.test_file_1, 'cached_md5', os.stat(self.test_file_1))
+        self.assertEqual(self.snapshot_manager.file_snapMd5(self.test_file_1), 'cached_md5')
+
+        #Case: the file changed, the cache is not valid
+        open(self.test_file_1, 'a').write('new content')
+        self.assertIsNone(self.snapshot_manager.cached_md5(self.test_file_1))
+        self.assertEqual(
+            self.snapshot_manager.file_snapMd5(self.test_file_1),
+            hashlib.md5(open(self.test_file_1, 'rb').read()).hexdigest())
+
+        #Case: moved file, the cache follows it
+        moved_path = os.path.join(self.test_folder_1, 'moved.txt')
+        os.rename(self.test_file_2, moved_path)
+        self.snapshot_manager.update_snapshot_move(
+            {"src_path": self.test_file_2, "dst_path": moved_path})
+        self.assertIsNone(self.snapshot_manager.cached_md5(self.test_file_2))
+        self.assertIsNotNone(self.snapshot_manager.cached_md5(moved_path))
+
+    def test_saved_md5_cache(self):
+        self.snapshot_manager.save_md5_cache()
+        self.assertFalse(self.snapshot_manager.merkle_tree.dirty)
+
+        #Case: the startup scan reads only the files changed since the save
+        open(self.test_file_2, 'w').write('modified')
+        modified_md5 = hashlib.md5('modified').hexdigest()
+        with mock.patch.object(DirSnapshotManager, 'file_snapMd5', return_value=modified_md5) as file_snapMd5:
+            snapshot_manager = DirSnapshotManager(self.conf_snap_path)
+        file_snapMd5.assert_called_once_with(self.test_file_2)
+        self.assertEqual(snapshot_manager.merkle_tree.get_md5('sub_dir_2/test_file_2.txt'), modified_md5)
+        self.assertEqual(
+            snapshot_manager.cached_md5(self.test_file_1), 'fea80f2db003d4ebc4536023814aa885')
+        self.assertEqual(snapshot_manager.md5_cache, {})
+
+        #Case: saved again once the interval has passed
+        now = time.time()
+        snapshot_manager.save_md5_cache(now)
+        self.assertFalse(snapshot_manager.merkle_tree.dirty)
+        snapshot_manager.update_snapshot_delete({'src_path': self.test_file_3})
+        snapshot_manager.save_md5_cache(now + 1)
+        self.assertTrue(snapshot_manager.merkle_tree.dirty)
+        snapshot_manager.save_md5_cache(now + client_daemon.MD5_CACHE_SAVE_INTERVAL)
+        self.assertFalse(snapshot_manager.merkle_tree.dirty)
+        #the mocked hash of test_file_2 has no stat
+        with open(snapshot_manager.md5_cache_path) as f:
+            self.assertEqual(
+                [path for path, _, _, _, _ in json.load(f)['files']], ['sub_dir_1/test_file_1.txt'])
+
+        #Case: a broken cache is ignored
+        open(snapshot_manager.md5_cache_path, 'w').write('{"files": ')
+        snapshot_manager = DirSnapshotManager(self.conf_snap_path)
+        self.assertEqual(
+            snapshot_manager.merkle_tree.get_md5('sub_dir_2/test_file_2.txt'), modified_md5)
+
+    def test_files_in_dir(self):
+        self.assertEqual(
+            sorted(self.snapshot_manager.files_in_dir(self.test_folder_2)),
+            [self.test_file_2, os.path.join(self.test_folder_2, 'test_file_3.txt')])
+
+        #Case: directory unknown to snapshot
+        self.assertEqual(
+            self.snapshot_manager.files_in_dir(os.path.join(self.test_share_dir, 'missing')), [])
+
+    def test_changed_files(self):
+        self.assertEqual(self.snapshot_manager.changed_files(), [])
+
+        new_file = os.path.join(self.test_folder_1, 'new_file.txt')
+        open(new_file, 'w').write('new')
+        open(self.test_file_2, 'w').write('modified')
+        os.remove(self.test_file_3)
+        #only touched, the md5 is the same
+        os.utime(self.test_file_1, (1, 1))
+        self.assertEqual(sorted(self.snapshot_manager.changed_files()), [
+            ('created', new_file),
+            ('deleted', self.test_file_3),
+            ('modified', self.test_file_2),
+        ])
+        #the stat of the touched file is the new one
+        self.assertEqual(
+            self.snapshot_manager.cached_md5(self.test_file_1), 'fea80f2db003d4ebc4536023814aa885')
+
     def test_instant_snapshot(self):
         shutil.copy(self.test_file_1, self.test_folder_2)
         self.true_snapshot['fea80f2db003d4ebc4536023814aa885'] = [
@@ -1084,6 +2789,28 @@ class DirSnapshotManagerTest(unittest.TestCase):
         instant_snapshot = self.snapshot_manager.instant_snapshot()
         self.snapshotAsserEqual(instant_snapshot, self.true_snapshot)
 
+    def test_ignored_paths(self):
+        self.snapshot_manager.ignore_rules = IgnoreRules(DEFAULT_IGNORE + ["sub_dir_2/"])
+        open(os.path.join(self.test_folder_1, '.test_file_1.txt.swp'), 'w').write('swap')
+
+        #Case: ignored files and directories are not in the snapshot
+        self.assertEqual(
+            self.snapshot_manager.instant_snapshot(),
+            {'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt']})
+
+        #Case: ignored server files are neither downloaded nor deleted
+        server_snapshot = {
+            'fea80f2db003d4ebc4536023814aa885': [
+                {"path": 'sub_dir_1/test_file_1.txt', "timestamp": 123123}],
+            '81bcb26fd4acfaa5d0acc7eef1d3013a': [
+                {"path": 'sub_dir_2/test_file_2.txt', "timestamp": 123123}],
+            'a' * 32: [{"path": 'sub_dir_1/~$test_file_1.txt', "timestamp": 123123}],
+        }
+        self.snapshot_manager.local_full_snapshot = self.snapshot_manager.instant_snapshot()
+        self.assertEqual(
+            self.snapshot_manager.syncronize_dispatcher(self.unsinked_timestamp, server_snapshot),
+            [])
+
     def test_save_snapshot(self):
         test_timestamp = '1234'
         self.snapshot_manager.save_snapshot(test_timestamp)
@@ -1097,13 +2824,13 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.assertEqual(expected_conf, new_conf)
 
     def test_update_snapshot_upload(self):
-        original_snapshot = copy.deepcopy(self.snapshot_manager.local_full_snapshot)
+        original_snapshot = self.snapshot_copy()
         del self.snapshot_manager.local_full_snapshot['fea80f2db003d4ebc4536023814aa885']
         self.snapshot_manager.update_snapshot_upload({"src_path": self.test_file_1})
         self.assertEqual(self.snapshot_manager.local_full_snapshot, original_snapshot)
 
     def test_update_snapshot_update(self):
-        original_snapshot = copy.deepcopy(self.snapshot_manager.local_full_snapshot)
+        original_snapshot = self.snapshot_copy()
         mock_snapshot = copy.deepcopy(original_snapshot)
         mock_file_content = "test_content"
 
@@ -1123,8 +2850,8 @@ class DirSnapshotManagerTest(unittest.TestCase):
 
         #------- update a file with copies -------#
         mock_copy_path = client_daemon.get_relpath(self.test_file_1 + "_copy")
-        self.snapshot_manager.local_full_snapshot['fea80f2db003d4ebc4536023814aa885'].append(mock_copy_path)
-        mock_snapshot = copy.deepcopy(self.snapshot_manager.local_full_snapshot)
+        self.snapshot_manager.merkle_tree.add_file(mock_copy_path, 'fea80f2db003d4ebc4536023814aa885')
+        mock_snapshot = self.snapshot_copy()
         mock_snapshot['fea80f2db003d4ebc4536023814aa885'].remove(client_daemon.get_relpath(self.test_file_1))
         mock_snapshot[mock_file_content_md5] = [client_daemon.get_relpath(self.test_file_1)]
 
@@ -1134,7 +2861,7 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.snapshot_manager.local_full_snapshot = copy.deepcopy(original_snapshot)
 
         #------- update a file like another -------#
-        self.snapshot_manager.local_full_snapshot['fea80f2db003d4ebc4536023814aa885'].append(mock_copy_path)
+        self.snapshot_manager.merkle_tree.add_file(mock_copy_path, 'fea80f2db003d4ebc4536023814aa885')
         self.snapshot_manager.local_full_snapshot[mock_file_content_md5] = [mock_copy_path + "_another"]
         self.snapshot_manager.update_snapshot_update({"src_path": self.test_file_1})
         mock_snapshot = {
@@ -1148,7 +2875,7 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.snapshotAsserEqual(self.snapshot_manager.local_full_snapshot, mock_snapshot)
 
     def test_update_snapshot_copy(self):
-        mock_snapshot = copy.deepcopy(self.snapshot_manager.local_full_snapshot)
+        mock_snapshot = self.snapshot_copy()
         original_snapshot = copy.deepcopy(mock_snapshot)
         mock_copy_path = self.test_file_1 + "_copy"
         mock_snapshot['fea80f2db003d4ebc4536023814aa885'].append(client_daemon.get_relpath(mock_copy_path))
@@ -1160,7 +2887,7 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.snapshot_manager.local_full_snapshot = original_snapshot
 
     def test_update_snapshot_move(self):
-        original_snapshot = copy.deepcopy(self.snapshot_manager.local_full_snapshot)
+        original_snapshot = self.snapshot_copy()
         mock_snapshot = copy.deepcopy(original_snapshot)
         mock_new_dest = self.test_file_1 + "_new_dest"
         with open(self.test_file_1, 'rb') as f:
@@ -1174,8 +2901,27 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.snapshot_manager.local_full_snapshot = original_snapshot
         os.remove(mock_new_dest)
 
+    def test_update_snapshot_move_dir(self):
+        new_dir = os.path.join(self.test_share_dir, 'renamed', 'sub_dir_2')
+        os.renames(self.test_folder_2, new_dir)
+        self.snapshot_manager.update_snapshot_move_dir(
+            {'src_path': self.test_folder_2, 'dst_path': new_dir})
+        expected_snapshot = {
+            '81bcb26fd4acfaa5d0acc7eef1d3013a': ['renamed/sub_dir_2/test_file_2.txt'],
+            'd1e2ac797b8385e792ac1e31db4a81f9': ['renamed/sub_dir_2/test_file_3.txt'],
+            'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt'],
+        }
+        self.assertEqual(self.snapshot_manager.local_full_snapshot, expected_snapshot)
+        #the tree is the one of the new snapshot and the cache follows the files
+        self.assertEqual(
+            self.snapshot_manager.merkle_tree.dirs,
+            SnapshotTree.from_snapshot(expected_snapshot).dirs)
+        self.assertIsNone(self.snapshot_manager.cached_md5(self.test_file_2))
+        self.assertIsNotNone(
+            self.snapshot_manager.cached_md5(os.path.join(new_dir, 'test_file_2.txt')))
+
     def test_update_snapshot_delete(self):
-        mock_snapshot = copy.deepcopy(self.snapshot_manager.local_full_snapshot)
+        mock_snapshot = self.snapshot_copy()
         original_snapshot = copy.deepcopy(mock_snapshot)
         del mock_snapshot['fea80f2db003d4ebc4536023814aa885']
         self.snapshot_manager.update_snapshot_delete({'src_path': self.test_file_1})
@@ -1186,7 +2932,8 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.snapshot_manager.local_full_snapshot = copy.deepcopy(original_snapshot)
 
         mock_copy_path = self.test_file_1 + "_copy"
-        self.snapshot_manager.local_full_snapshot['fea80f2db003d4ebc4536023814aa885'].append(client_daemon.get_relpath(mock_copy_path))
+        self.snapshot_manager.merkle_tree.add_file(
+            client_daemon.get_relpath(mock_copy_path), 'fea80f2db003d4ebc4536023814aa885')
         self.snapshot_manager.update_snapshot_delete({"src_path": mock_copy_path})
         #delete a file with copies
         self.assertEqual(self.snapshot_manager.local_full_snapshot, original_snapshot)
@@ -1248,6 +2995,110 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.assertEqual(md5, None)
 
 
+class MerkleTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = {
+            '81bcb26fd4acfaa5d0acc7eef1d3013a': ['sub_dir_2/test_file_2.txt', 'copy.txt'],
+            'd1e2ac797b8385e792ac1e31db4a81f9': ['sub_dir_2/deep/test_file_3.txt'],
+            'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt'],
+        }
+        self.tree = MerkleTree.from_snapshot(self.snapshot)
+
+    def test_from_snapshot(self):
+        #the bulk load is equal to the incremental one, in any order
+        tree = MerkleTree()
+        for md5, paths in sorted(self.snapshot.items(), reverse=True):
+            for path in paths:
+                tree.add_file(path, md5)
+        self.assertEqual(tree.root_hash(), self.tree.root_hash())
+        self.assertEqual(tree.dirs, self.tree.dirs)
+
+        #the empty tree
+        self.assertEqual(MerkleTree().root_hash(), MerkleTree.from_snapshot({}).root_hash())
+
+    def test_add_file(self):
+        root_hash = self.tree.root_hash()
+        sub_dir_1_hash = self.tree.dirs['sub_dir_1']['hash']
+
+        #Case: new file in a new directory chain
+        self.tree.add_file('new/dir/file.txt', 'a' * 32)
+        self.assertNotEqual(self.tree.root_hash(), root_hash)
+        self.assertEqual(self.tree.get_md5('new/dir/file.txt'), 'a' * 32)
+        self.assertIn('new/dir', self.tree.dirs)
+        self.assertIn('dir', self.tree.dirs['new']['dirs'])
+        #untouched directories keep their hash
+        self.assertEqual(self.tree.dirs['sub_dir_1']['hash'], sub_dir_1_hash)
+
+        #Case: same md5 doesn't change anything
+        root_hash = self.tree.root_hash()
+        self.tree.add_file('new/dir/file.txt', 'a' * 32)
+        self.assertEqual(self.tree.root_hash(), root_hash)
+
+        #Case: modified file
+        self.tree.add_file('sub_dir_1/test_file_1.txt', 'b' * 32)
+        self.assertNotEqual(self.tree.dirs['sub_dir_1']['hash'], sub_dir_1_hash)
+
+    def test_remove_file(self):
+        root_hash = self.tree.root_hash()
+        dirs = copy.deepcopy(self.tree.dirs)
+
+        #Case: remove restores the previous hashes and prunes empty directories
+        self.tree.add_file('new/dir/file.txt', 'a' * 32)
+        self.tree.remove_file('new/dir/file.txt')
+        self.assertEqual(self.tree.root_hash(), root_hash)
+        self.assertEqual(self.tree.dirs, dirs)
+
+        #Case: remove the last file of a directory
+        self.tree.remove_file('sub_dir_2/deep/test_file_3.txt')
+        self.assertNotIn('sub_dir_2/deep', self.tree.dirs)
+        self.assertNotIn('deep', self.tree.dirs['sub_dir_2']['dirs'])
+        self.assertEqual(self.tree.get_md5('sub_dir_2/deep/test_file_3.txt'), None)
+
+        #Case: path not in the tree
+        root_hash = self.tree.root_hash()
+        self.tree.remove_file('not/a/file.txt')
+        self.tree.remove_file('copy.txt/not_a_file.txt')
+        self.assertEqual(self.tree.root_hash(), root_hash)
+
+    def test_iter_sorted(self):
+        #the order of a sort of the paths: "sub_dir_1.txt" before "sub_dir_1/..."
+        self.tree.add_file('sub_dir_1.txt', 'a' * 32)
+        self.tree.add_file('sub_dir_10/file.txt', 'b' * 32)
+        self.assertEqual(
+            list(self.tree.iter_sorted()),
+            sorted(self.tree.iter_files()))
+        self.assertEqual(
+            [path for path, _ in self.tree.iter_sorted('sub_dir_2')],
+            ['sub_dir_2/deep/test_file_3.txt', 'sub_dir_2/test_file_2.txt'])
+        self.assertEqual(list(self.tree.iter_sorted('not_a_dir')), [])
+
+    def test_rename_changes_hash(self):
+        root_hash = self.tree.root_hash()
+        self.tree.remove_file('copy.txt')
+        self.tree.add_file('copy_renamed.txt', '81bcb26fd4acfaa5d0acc7eef1d3013a')
+        self.assertNotEqual(self.tree.root_hash(), root_hash)
+
+    def test_move_dir(self):
+        sub_dir_2_hash = self.tree.dirs['sub_dir_2']['hash']
+        self.tree.move_dir('sub_dir_2', 'new/sub_dir')
+        #the moved subtree keeps its hashes
+        self.assertEqual(self.tree.dirs['new/sub_dir']['hash'], sub_dir_2_hash)
+        self.assertEqual(self.tree.get_md5('new/sub_dir/deep/test_file_3.txt'),
+                         'd1e2ac797b8385e792ac1e31db4a81f9')
+        self.assertNotIn('sub_dir_2/deep', self.tree.dirs)
+        self.assertEqual(self.tree.dirs, MerkleTree.from_snapshot({
+            '81bcb26fd4acfaa5d0acc7eef1d3013a': ['new/sub_dir/test_file_2.txt', 'copy.txt'],
+            'd1e2ac797b8385e792ac1e31db4a81f9': ['new/sub_dir/deep/test_file_3.txt'],
+            'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt'],
+        }).dirs)
+
+        #Case: the father left empty is removed
+        self.tree.move_dir('new/sub_dir', 'sub_dir_2')
+        self.assertNotIn('new', self.tree.dirs)
+        self.assertEqual(self.tree.dirs, MerkleTree.from_snapshot(self.snapshot).dirs)
+
+
 class DirectoryEventHandlerTest(unittest.TestCase):
 
     def setUp(self):
@@ -1261,26 +3112,48 @@ class DirectoryEventHandlerTest(unittest.TestCase):
                     'upload': False,
                     'delete': False
                 }
+                self.calls = []
 
             def move_file(self, src_path, dst_path):
                 self.cmd['move'] = True
+                self.calls.append(('move', src_path, dst_path))
+
+            def move_dir(self, src_path, dst_path):
+                self.calls.append(('move_dir', src_path, dst_path))
 
             def copy_file(self, copy, src_path):
                 self.cmd['copy'] = True
+                self.calls.append(('copy', copy, src_path))
 
             def upload_file(self, src_path, put_file=False):
                 self.cmd['upload'] = {'path': True, 'put': put_file}
+                self.calls.append(('upload', src_path, put_file))
 
             def delete_file(self, src_path):
                 self.cmd['delete'] = True
+                self.calls.append(('delete', src_path))
 
         class SnapshotManager(object):
             def __init__(self):
                 self.local_full_snapshot = {'test_MD5': ['path']}
+                self.dir_files = []
+                self.synced_paths = []
 
             def file_snapMd5(self, *args, **kwargs):
                 return 'MD5'
 
+            def files_in_dir(self, abs_dir_path):
+                return self.dir_files
+
+            def changed_files(self):
+                return self.changes
+
+            def path_in_snapshot(self, abs_path):
+                return abs_path in self.synced_paths
+
+            def is_ignored(self, path, is_dir=False):
+                return IgnoreRules(DEFAULT_IGNORE).match(path, is_dir)
+
         #Generate test folder tree
         self.test_src = '/test/subdir1/file'
         self.test_dst = '/test/subdir2/file'
@@ -1322,17 +3195,56 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         self.server_comm.cmd["move"] = False
 
         #Case: move file event in ignored directory
-        self.event_handler.paths_ignored.append(self.test_src)
-        self.event_handler.paths_ignored.append(self.test_dst)
+        self.event_handler.ignored_events.add(self.test_src, ["moved"])
+        self.event_handler.ignored_events.add(self.test_dst, ["moved"])
         self.event_handler.on_moved(move_file_event)
         self.assertFalse(self.server_comm.cmd["move"])
-        self.assertFalse(self.test_src in self.event_handler.paths_ignored)
-        self.assertFalse(self.test_dst in self.event_handler.paths_ignored)
+        self.assertFalse(self.test_src in self.event_handler.ignored_events)
+        self.assertFalse(self.test_dst in self.event_handler.ignored_events)
 
         #Case: directory move event
         self.event_handler.on_moved(move_dir_event)
         self.assertFalse(self.server_comm.cmd["move"])
 
+    def test_rescan(self):
+        self.snapshot_manager.changes = [
+            ('created', self.test_src), ('modified', self.test_dst), ('deleted', '/test/file')]
+        self.event_handler.on_modified(TreeRescanEvent('/test'))
+        self.assertEqual(self.server_comm.calls, [
+            ('upload', self.test_src, False),
+            ('upload', self.test_dst, True),
+            ('delete', '/test/file'),
+        ])
+
+        #Case: a modified directory is not a rescan
+        self.server_comm.calls = []
+        self.event_handler.on_modified(DirModifiedEvent('/test'))
+        self.assertEqual(self.server_comm.calls, [])
+
+    def test_ignored_paths(self):
+        swap_file = '/test/subdir1/.file.swp'
+
+        #Case: events on an ignored file
+        self.event_handler.on_created(FileCreatedEvent(swap_file))
+        self.event_handler.on_modified(FileModifiedEvent(swap_file))
+        self.event_handler.on_deleted(FileDeletedEvent(swap_file))
+        self.assertEqual(self.server_comm.calls, [])
+
+        #Case: ignored file saved over a synchronized one
+        self.snapshot_manager.synced_paths = [self.test_src]
+        self.event_handler.on_moved(FileMovedEvent(swap_file, self.test_src))
+        self.assertEqual(self.server_comm.calls, [('upload', self.test_src, True)])
+
+        #Case: ignored file renamed to a new file
+        self.server_comm.calls = []
+        self.event_handler.on_moved(FileMovedEvent(swap_file, self.test_dst))
+        self.assertEqual(self.server_comm.calls, [('upload', self.test_dst, False)])
+
+        #Case: synchronized file renamed to an ignored name
+        self.server_comm.calls = []
+        self.event_handler.on_moved(FileMovedEvent(self.test_src, swap_file))
+        self.assertEqual(self.server_comm.calls, [('delete', self.test_src)])
+
     def test_on_created(self):
         create_file_event = FileCreatedEvent(self.test_src)
         create_dir_event = DirCreatedEvent(self.test_dir_src)
@@ -1368,21 +3280,21 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         self.server_comm.cmd["copy"] = False
 
         #Case: create file in ignored directory
-        self.event_handler.paths_ignored.append(self.test_src)
+        self.event_handler.ignored_events.add(self.test_src, ["created"])
         self.event_handler.on_created(create_file_event)
         self.assertFalse(self.server_comm.cmd["upload"])
-        self.assertFalse(self.test_src in self.event_handler.paths_ignored)
+        self.assertFalse(self.test_src in self.event_handler.ignored_events)
 
         #reset initial condition
         self.server_comm.cmd["upload"] = False
 
         #Case: copy file and ignore the path
         self.snapshot_manager.local_full_snapshot = {'MD5': ['path']}
-        self.event_handler.paths_ignored.append(self.test_src)
+        self.event_handler.ignored_events.add(self.test_src, ["created"])
         self.event_handler.on_created(copy_file_event)
         self.assertFalse(self.server_comm.cmd["upload"])
-        self.assertFalse(self.test_src in self.event_handler.paths_ignored)
-        self.assertFalse(self.test_dst in self.event_handler.paths_ignored)
+        self.assertFalse(self.test_src in self.event_handler.ignored_events)
+        self.assertFalse(self.test_dst in self.event_handler.ignored_events)
 
     def test_on_deleted(self):
         delete_file_event = FileDeletedEvent(self.test_src)
@@ -1399,11 +3311,17 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         self.event_handler.on_deleted(delete_dir_event)
         self.assertFalse(self.server_comm.cmd["delete"])
 
+        #Case: delete dir event with files still in snapshot
+        self.snapshot_manager.dir_files = [self.test_dir_src + 'file']
+        self.event_handler.on_deleted(delete_dir_event)
+        self.assertTrue(self.server_comm.cmd["delete"])
+        self.server_comm.cmd["delete"] = False
+
         #Case: delete file in ignored directory
-        self.event_handler.paths_ignored.append(self.test_src)
+        self.event_handler.ignored_events.add(self.test_src, ["deleted"])
         self.event_handler.on_deleted(delete_file_event)
         self.assertFalse(self.server_comm.cmd["delete"])
-        self.assertFalse(self.test_src in self.event_handler.paths_ignored)
+        self.assertFalse(self.test_src in self.event_handler.ignored_events)
 
     def test_on_modified(self):
         modify_file_event = FileModifiedEvent(self.test_src)
@@ -1423,10 +3341,157 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         self.assertFalse(self.server_comm.cmd["upload"])
 
         #Case: modify file in ignored directory
-        self.event_handler.paths_ignored.append(self.test_src)
+        self.event_handler.ignored_events.add(self.test_src, ["modified"])
         self.event_handler.on_modified(modify_file_event)
         self.assertFalse(self.server_comm.cmd["upload"])
-        self.assertFalse(self.test_src in self.event_handler.paths_ignored)
+        self.assertFalse(self.test_src in self.event_handler.ignored_events)
+
+    def test_download_events(self):
+        temp_path = '/test/subdir1/.rawbox-tmp1234.part'
+        self.event_handler.ignored_events.add(self.test_src, ["moved", "modified"])
+
+        #Case: the temporary file of a download is not synchronized
+        self.event_handler.on_created(FileCreatedEvent(temp_path))
+        self.event_handler.on_modified(FileModifiedEvent(temp_path))
+        self.assertEqual(self.server_comm.calls, [])
+
+        #Case: renamed in place, nothing else expected on the path
+        self.event_handler.on_moved(FileMovedEvent(temp_path, self.test_src))
+        self.assertEqual(self.server_comm.calls, [])
+        self.assertFalse(self.test_src in self.event_handler.ignored_events)
+
+    def test_ignored_events(self):
+        ignored_events = IgnoredEvents(ttl=5)
+        now = time.time()
+        ignored_events.add(self.test_src, ["created", "modified"])
+        ignored_events.add(self.test_src, ["modified"])
+        self.assertEqual(len(ignored_events), 3)
+
+        #Case: each expected event is consumed once
+        self.assertFalse(ignored_events.consume(self.test_src, "deleted", now))
+        self.assertTrue(ignored_events.consume(self.test_src, "created", now))
+        self.assertFalse(ignored_events.consume(self.test_src, "created", now))
+        self.assertTrue(ignored_events.consume(self.test_src, "modified", now))
+        self.assertTrue(self.test_src in ignored_events)
+
+        #Case: the events never seen expire
+        self.assertFalse(ignored_events.consume(self.test_src, "modified", now + 6))
+        self.assertFalse(self.test_src in ignored_events)
+        self.assertEqual(len(ignored_events.expiry_queue), 0)
+
+        #Case: an already consumed event doesn't expire a later one
+        ignored_events.add(self.test_dst, ["deleted"])
+        self.assertTrue(ignored_events.consume(self.test_dst, "deleted"))
+        ignored_events.add(self.test_dst, ["deleted"])
+        ignored_events.deadlines[(self.test_dst, "deleted")][0] = now + 10
+        self.assertTrue(ignored_events.consume(self.test_dst, "deleted", now + 6))
+
+    def test_coalescing(self):
+        self.event_handler.settle_window = 2
+        now = time.time()
+
+        #Case: created, modified and deleted before settling
+        self.event_handler.on_created(FileCreatedEvent(self.test_src))
+        self.event_handler.on_modified(FileModifiedEvent(self.test_src))
+        self.event_handler.on_deleted(FileDeletedEvent(self.test_src))
+        self.event_handler.flush(now + 3)
+        self.assertEqual(self.server_comm.calls, [])
+
+        #Case: editor save, temporary file renamed over the document
+        temp_path = self.test_src + '.swp'
+        self.snapshot_manager.synced_paths = [self.test_src]
+        self.event_handler.on_created(FileCreatedEvent(temp_path))
+        self.event_handler.on_modified(FileModifiedEvent(temp_path))
+        self.event_handler.on_moved(FileMovedEvent(temp_path, self.test_src))
+        self.assertEqual(self.event_handler.pending.keys(), [self.test_src])
+        self.assertEqual(self.event_handler.pending[self.test_src]['action'], 'modified')
+        self.event_handler.pending.clear()
+
+        #Case: move then modify, the move is kept
+        self.event_handler.on_moved(FileMovedEvent(self.test_src, self.test_dst))
+        self.event_handler.on_modified(FileModifiedEvent(self.test_dst))
+        self.assertEqual(
+            (self.event_handler.pending[self.test_dst]['action'],
+             self.event_handler.pending[self.test_dst]['modified']),
+            ('moved', True))
+
+        #Case: moved file deleted, the server deletes the source
+        self.event_handler.on_deleted(FileDeletedEvent(self.test_dst))
+        self.assertEqual(self.event_handler.pending.keys(), [self.test_src])
+        self.event_handler.flush(now + 3)
+        self.assertEqual(self.server_comm.calls, [('delete', self.test_src)])
+
+    def test_settle_window(self):
+        self.event_handler.settle_window = 2
+        test_dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(test_dir, 'file.txt')
+            open(file_path, 'w').write('first chunk')
+            now = time.time()
+            self.event_handler.on_created(FileCreatedEvent(file_path))
+            for chunk in range(10):
+                open(file_path, 'a').write('chunk {}'.format(chunk))
+                self.event_handler.on_modified(FileModifiedEvent(file_path))
+
+            #Case: window not elapsed
+            self.event_handler.flush(now + 1)
+            self.assertEqual(self.server_comm.calls, [])
+
+            #Case: the file is still growing, the window restarts
+            open(file_path, 'a').write('last chunk')
+            self.event_handler.flush(now + 3)
+            self.assertEqual(self.server_comm.calls, [])
+
+            #Case: stable file, a single upload
+            self.event_handler.flush(now + 6)
+            self.assertEqual(self.server_comm.calls, [('upload', file_path, False)])
+            self.assertEqual(self.event_handler.pending, {})
+        finally:
+            shutil.rmtree(test_dir)
+
+    def test_dir_moves(self):
+        src_dir = '/test/subdir1/dir'
+        dst_dir = '/test/subdir2/dir'
+        self.snapshot_manager.dir_files = [src_dir + '/a.txt', src_dir + '/deep/b.txt']
+
+        #Case: inotify, the directory before its files
+        self.event_handler.on_moved(DirMovedEvent(self.test_dir_src, self.test_dir_dst))
+        self.event_handler.on_moved(FileMovedEvent(src_dir + '/a.txt', dst_dir + '/a.txt'))
+        self.event_handler.on_moved(
+            FileMovedEvent(src_dir + '/deep/b.txt', dst_dir + '/deep/b.txt'))
+        self.assertEqual(self.server_comm.calls, [('move_dir', src_dir, dst_dir)])
+        self.assertEqual(len(self.event_handler.ignored_events), 0)
+
+        #Case: polling, the files before the directory, a modified one is uploaded again
+        self.server_comm.calls = []
+        self.event_handler.settle_window = 2
+        self.snapshot_manager.dir_files = [dst_dir + '/a.txt', dst_dir + '/deep/b.txt']
+        self.event_handler.on_modified(FileModifiedEvent(dst_dir + '/a.txt'))
+        self.event_handler.on_moved(FileMovedEvent(dst_dir + '/a.txt', src_dir + '/a.txt'))
+        self.event_handler.on_moved(
+            FileMovedEvent(dst_dir + '/deep/b.txt', src_dir + '/deep/b.txt'))
+        self.event_handler.on_moved(DirMovedEvent(dst_dir, src_dir))
+        self.assertEqual(self.server_comm.calls, [('move_dir', dst_dir, src_dir)])
+        self.assertEqual(self.event_handler.pending.keys(), [src_dir + '/a.txt'])
+        self.assertEqual(self.event_handler.pending[src_dir + '/a.txt']['action'], 'modified')
+        self.assertEqual(len(self.event_handler.ignored_events), 0)
+        self.event_handler.pending.clear()
+
+        #Case: pending events under the directory follow it
+        self.server_comm.calls = []
+        self.event_handler.on_created(FileCreatedEvent(src_dir + '/new.txt'))
+        self.event_handler.on_moved(DirMovedEvent(src_dir, dst_dir))
+        self.assertEqual(self.event_handler.pending.keys(), [dst_dir + '/new.txt'])
+        self.event_handler.on_moved(FileMovedEvent(src_dir + '/new.txt', dst_dir + '/new.txt'))
+        self.assertEqual(self.event_handler.pending[dst_dir + '/new.txt']['action'], 'created')
+        self.assertEqual(self.server_comm.calls, [('move_dir', src_dir, dst_dir)])
+        self.event_handler.pending.clear()
+
+        #Case: a directory without synchronized files
+        self.server_comm.calls = []
+        self.snapshot_manager.dir_files = []
+        self.event_handler.on_moved(DirMovedEvent(src_dir, dst_dir))
+        self.assertEqual(self.server_comm.calls, [])
 
 
 class CommandExecuterTest(unittest.TestCase):
@@ -1451,10 +3516,14 @@ class CommandExecuterTest(unittest.TestCase):
             def __init__(self):
                 self.upload = False
                 self.delete = False
+                self.copy = False
 
             def upload_file(self, dst_path):
                 self.upload = dst_path
 
+            def copy_file(self, src_path, dst_path):
+                self.copy = [src_path, dst_path]
+
             def delete_file(self, dst_path):
                 self.delete = dst_path
 
@@ -1490,6 +3559,7 @@ class CommandExecuterTest(unittest.TestCase):
             {'local_delete': ['delete/test/path']},
             {'remote_delete': ['delete/test/path']},
             {'remote_upload': ['upload/test/path']},
+            {'remote_copy': ['src/copy/test/path', 'dst/copy/test/path']},
         ]
 
         self.executer.syncronize_executer(command_list)
@@ -1509,6 +3579,9 @@ class CommandExecuterTest(unittest.TestCase):
         self.assertEqual(
             self.server_comm.delete,
             'delete/test/path')
+        self.assertEqual(
+            self.server_comm.copy,
+            ['src/copy/test/path', 'dst/copy/test/path'])
 
 
 class FunctionTest(unittest.TestCase):
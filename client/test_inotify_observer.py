@@ -0,0 +1,189 @@
+from inotify_observer import InotifyObserver
+from inotify_observer import InotifyEmitter
+from inotify_observer import TreeRescanEvent
+from inotify_observer import inotify_available
+from inotify_observer import parse_events
+from inotify_observer import remote_mounts
+from inotify_observer import EVENT_HEADER
+from inotify_observer import IN_MOVED_FROM
+from inotify_observer import IN_ISDIR
+from inotify_observer import IN_Q_OVERFLOW
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileDeletedEvent
+from watchdog.events import FileModifiedEvent
+from watchdog.events import FileCreatedEvent
+from watchdog.events import FileMovedEvent
+from watchdog.observers.api import ObservedWatch
+import unittest
+import Queue
+import tempfile
+import shutil
+import time
+import mock
+import os
+
+
+class RecordingHandler(FileSystemEventHandler):
+
+    def __init__(self):
+        self.events = []
+
+    def on_any_event(self, event):
+        self.events.append(event)
+
+
+class FunctionTest(unittest.TestCase):
+
+    def test_parse_events(self):
+        name = "file.txt\0\0\0\0\0\0\0\0"
+        buf = EVENT_HEADER.pack(1, IN_MOVED_FROM, 42, len(name)) + name
+        buf += EVENT_HEADER.pack(2, IN_ISDIR, 0, 0)
+        self.assertEqual(
+            parse_events(buf),
+            [(1, IN_MOVED_FROM, 42, "file.txt"), (2, IN_ISDIR, 0, "")])
+
+    def test_remote_mounts(self):
+        mounts_file = tempfile.NamedTemporaryFile(delete=False)
+        mounts_file.write(
+            "/dev/sda1 / ext4 rw 0 0\n"
+            "server:/export /home/user/RawBox/nfs nfs4 rw 0 0\n"
+            "//host/share /home/user/RawBox/my\\040share cifs rw 0 0\n")
+        mounts_file.close()
+        try:
+            self.assertEqual(
+                remote_mounts(mounts_file.name),
+                set(["/home/user/RawBox/nfs", "/home/user/RawBox/my share"]))
+        finally:
+            os.remove(mounts_file.name)
+
+        #Case: no mounts file
+        self.assertEqual(remote_mounts("/not/existing/mounts"), set())
+
+
+@unittest.skipIf(not inotify_available(), "inotify not available")
+class InotifyObserverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.watched_dir = os.path.join(self.base_dir, "RawBox")
+        self.trash_dir = os.path.join(self.base_dir, "Trash")
+        self.sub_dir = os.path.join(self.watched_dir, "sub_dir")
+        os.makedirs(self.sub_dir)
+        os.makedirs(self.trash_dir)
+        self.file_path = os.path.join(self.sub_dir, "file.txt")
+        open(self.file_path, "w").write("content")
+
+        self.handler = RecordingHandler()
+        self.observer = InotifyObserver(timeout=0.1)
+
+    def tearDown(self):
+        self.observer.stop()
+        self.observer.join()
+        shutil.rmtree(self.base_dir)
+
+    def start(self):
+        watch = self.observer.schedule(self.handler, self.watched_dir, recursive=True)
+        self.observer.start()
+        return watch
+
+    def wait_for(self, event, timeout=3):
+        """ wait until the handler receive event """
+        stop = time.time() + timeout
+        while time.time() < stop:
+            if event in self.handler.events:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_file_events(self):
+        self.start()
+        new_file = os.path.join(self.sub_dir, "new_file.txt")
+        open(new_file, "w").write("new content")
+        self.assertTrue(self.wait_for(FileCreatedEvent(new_file)))
+        self.assertTrue(self.wait_for(FileModifiedEvent(new_file)))
+
+        os.remove(new_file)
+        self.assertTrue(self.wait_for(FileDeletedEvent(new_file)))
+
+    def test_moves(self):
+        self.start()
+        moved_path = os.path.join(self.watched_dir, "moved.txt")
+        os.rename(self.file_path, moved_path)
+        self.assertTrue(self.wait_for(FileMovedEvent(self.file_path, moved_path)))
+
+        #Case: moved to trash, outside the watched directory
+        trash_path = os.path.join(self.trash_dir, "moved.txt")
+        os.rename(moved_path, trash_path)
+        self.assertTrue(self.wait_for(FileDeletedEvent(moved_path)))
+
+        #Case: restored from trash
+        os.rename(trash_path, moved_path)
+        self.assertTrue(self.wait_for(FileCreatedEvent(moved_path)))
+
+    def test_dir_moves(self):
+        self.start()
+        new_sub_dir = os.path.join(self.watched_dir, "new_sub_dir")
+        new_file_path = os.path.join(new_sub_dir, "file.txt")
+        os.rename(self.sub_dir, new_sub_dir)
+        self.assertTrue(self.wait_for(FileMovedEvent(self.file_path, new_file_path)))
+
+        #Case: the watch follows the directory
+        open(new_file_path, "a").write("more content")
+        self.assertTrue(self.wait_for(FileModifiedEvent(new_file_path)))
+
+        #Case: directory created with content before the watch is added
+        created_dir = os.path.join(self.trash_dir, "created_dir")
+        os.makedirs(created_dir)
+        open(os.path.join(created_dir, "file.txt"), "w").write("content")
+        os.rename(created_dir, os.path.join(self.watched_dir, "created_dir"))
+        self.assertTrue(self.wait_for(FileCreatedEvent(
+            os.path.join(self.watched_dir, "created_dir", "file.txt"))))
+
+    def test_polling_fallback(self):
+        add_watch = InotifyEmitter._add_watch
+
+        def watch_limit(emitter, path):
+            if path == self.sub_dir:
+                return False
+            return add_watch(emitter, path)
+
+        with mock.patch.object(InotifyEmitter, "_add_watch", watch_limit):
+            watch = self.start()
+        emitter = self.observer._get_emitter_for_watch(watch)
+        self.assertEqual(emitter.fallbacks.keys(), [self.sub_dir])
+        self.assertNotIn(self.sub_dir, emitter.path_wds)
+
+        #Case: the polled subtree still reports its changes
+        os.remove(self.file_path)
+        self.assertTrue(self.wait_for(FileDeletedEvent(self.file_path)))
+
+    def test_queue_overflow(self):
+        #an emitter out of the observer, its events are read by the test
+        self.observer.start()
+        event_queue = Queue.Queue()
+        watch = ObservedWatch(self.watched_dir, True)
+        emitter = InotifyEmitter(event_queue, watch)
+        try:
+            #the events of these changes are lost
+            lost_dir = os.path.join(self.watched_dir, "lost_dir")
+            os.makedirs(lost_dir)
+            shutil.rmtree(self.sub_dir)
+            emitter.moved_from[42] = (self.file_path, False, time.time())
+
+            emitter._process_event(-1, IN_Q_OVERFLOW, 0, "")
+            self.assertIn(lost_dir, emitter.path_wds)
+            self.assertNotIn(self.sub_dir, emitter.path_wds)
+            self.assertEqual(emitter.moved_from, {})
+            self.assertEqual(event_queue.get_nowait(), (TreeRescanEvent(self.watched_dir), watch))
+            self.assertTrue(event_queue.empty())
+        finally:
+            os.close(emitter.fd)
+
+        #Case: a handler unaware of the rescan sees a directory modification
+        self.assertEqual(TreeRescanEvent(self.watched_dir).event_type, "modified")
+        self.assertTrue(TreeRescanEvent(self.watched_dir).is_directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+from path_filters import IgnoreRules
+from path_filters import SelectiveSync
+from path_filters import DEFAULT_IGNORE
+import unittest
+import tempfile
+import os
+
+
+class IgnoreRulesTest(unittest.TestCase):
+
+    def test_default_patterns(self):
+        rules = IgnoreRules(DEFAULT_IGNORE)
+        for path in [
+                'sub_dir/.file.txt.swp', 'file.txt~', '~$report.docx',
+                '.~lock.report.odt#', 'downloads/movie.mkv.part', '#file.txt#']:
+            self.assertTrue(rules.match(path), path)
+        for path in ['file.txt', 'sub_dir/report.docx', 'part', 'file#']:
+            self.assertFalse(rules.match(path), path)
+
+    def test_patterns(self):
+        rules = IgnoreRules([
+            '# comment',
+            '',
+            'build/',
+            '/top.txt',
+            '*.log',
+            '!keep.log',
+            'docs/**/*.tmp',
+            'data?.[ch]',
+        ])
+        #Case: pattern without "/" at any depth
+        self.assertTrue(rules.match('a.log'))
+        self.assertTrue(rules.match('sub_dir/a.log'))
+        self.assertFalse(rules.match('a.log.txt'))
+
+        #Case: negated pattern
+        self.assertFalse(rules.match('sub_dir/keep.log'))
+
+        #Case: pattern relative to the root
+        self.assertTrue(rules.match('top.txt'))
+        self.assertFalse(rules.match('sub_dir/top.txt'))
+
+        #Case: directories only, with all their content
+        self.assertTrue(rules.match('build', is_dir=True))
+        self.assertFalse(rules.match('build'))
+        self.assertTrue(rules.match('src/build/main.o'))
+
+        #Case: wildcards
+        self.assertTrue(rules.match('docs/c.tmp'))
+        self.assertTrue(rules.match('docs/a/b/c.tmp'))
+        self.assertTrue(rules.match('data1.c'))
+        self.assertFalse(rules.match('data12.c'))
+        self.assertFalse(rules.match('data1.o'))
+
+        #Case: no patterns
+        self.assertFalse(IgnoreRules().match('a.log'))
+
+    def test_from_file(self):
+        rules_file = tempfile.NamedTemporaryFile(delete=False)
+        rules_file.write("*.o\r\nnode_modules/\n")
+        rules_file.close()
+        try:
+            rules = IgnoreRules.from_file(rules_file.name)
+        finally:
+            os.remove(rules_file.name)
+        self.assertTrue(rules.match('main.o'))
+        self.assertTrue(rules.match('web/node_modules/lib.js'))
+        self.assertTrue(rules.match('.file.swp'))
+
+        #Case: no rules file, only the defaults
+        rules = IgnoreRules.from_file('/not/existing/.rawboxignore')
+        self.assertTrue(rules.match('.file.swp'))
+        self.assertFalse(rules.match('main.o'))
+
+
+class SelectiveSyncTest(unittest.TestCase):
+
+    def test_excludes(self):
+        selective_sync = SelectiveSync.from_config(
+            "shares\n  /shares/big/\n", "shares/project\nshares/project/old")
+        self.assertFalse(selective_sync.excludes('file.txt'))
+        self.assertFalse(selective_sync.excludes('shares.txt'))
+        self.assertTrue(selective_sync.excludes('shares/movie.mkv'))
+        self.assertTrue(selective_sync.excludes('shares/big/movie.mkv'))
+
+        #Case: subtree included inside an excluded one
+        self.assertFalse(selective_sync.excludes('shares/project/main.py'))
+        self.assertFalse(selective_sync.excludes('shares/project/old/main.py'))
+
+        #Case: subtrees
+        self.assertTrue(selective_sync.excludes_subtree('shares/big'))
+        self.assertFalse(selective_sync.excludes_subtree('shares'))
+        self.assertFalse(selective_sync.excludes_subtree('shares/project'))
+
+        #Case: no rules
+        self.assertFalse(SelectiveSync.from_config("", "").excludes('shares/movie.mkv'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+from snapshot_index import SnapshotTree
+from snapshot_index import pack_stat
+from snapshot_index import unpack_stat
+from merkle_tree import MerkleTree
+import unittest
+import copy
+
+
+class SnapshotTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = {
+            'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt'],
+            '81bcb26fd4acfaa5d0acc7eef1d3013a': [
+                'sub_dir_2/test_file_2.txt', 'root_file.txt', u'sub_dir_2/f\xe9.txt'],
+        }
+        self.tree = SnapshotTree.from_snapshot(self.snapshot)
+        self.index = self.tree.index
+
+    def assertIndexEqual(self, snapshot):
+        self.assertEqual(
+            dict((file_md5, sorted(paths)) for file_md5, paths in self.index.items()),
+            dict((file_md5, sorted(paths)) for file_md5, paths in snapshot.items()))
+        #the tree is always the one of the index
+        self.assertEqual(self.tree.root_hash(), MerkleTree.from_snapshot(snapshot).root_hash())
+
+    def test_mapping(self):
+        self.assertIndexEqual(self.snapshot)
+        self.assertEqual(len(self.index), 2)
+        self.assertIn('fea80f2db003d4ebc4536023814aa885', self.index)
+        self.assertNotIn('d1e2ac797b8385e792ac1e31db4a81f9', self.index)
+        self.assertEqual(self.index['fea80f2db003d4ebc4536023814aa885'], ['sub_dir_1/test_file_1.txt'])
+        self.assertEqual(sorted(self.index), sorted(self.snapshot))
+        self.assertRaises(KeyError, lambda: self.index['d1e2ac797b8385e792ac1e31db4a81f9'])
+
+        #Case: deleting a content removes its files from the tree
+        del self.index['fea80f2db003d4ebc4536023814aa885']
+        del self.snapshot['fea80f2db003d4ebc4536023814aa885']
+        self.assertIndexEqual(self.snapshot)
+        self.assertNotIn('sub_dir_1', self.tree.dirs)
+
+        #Case: keys that are not md5, kept as they are
+        self.index['MD5'] = ['path']
+        self.assertEqual(self.index['MD5'], ['path'])
+        self.assertEqual(self.tree.get_md5('path'), 'MD5')
+
+    def test_changes(self):
+        #Case: a lookup is a new list, the changes go through the index or the tree
+        self.index['fea80f2db003d4ebc4536023814aa885'].append('sub_dir_1/copy.txt')
+        self.assertEqual(self.index['fea80f2db003d4ebc4536023814aa885'], ['sub_dir_1/test_file_1.txt'])
+        self.index['fea80f2db003d4ebc4536023814aa885'] = ['moved/copy.txt']
+        self.assertEqual(self.index['fea80f2db003d4ebc4536023814aa885'], ['moved/copy.txt'])
+        self.assertEqual(self.tree.get_md5('moved/copy.txt'), 'fea80f2db003d4ebc4536023814aa885')
+        self.assertIsNone(self.tree.get_md5('sub_dir_1/test_file_1.txt'))
+
+        #Case: a copy doesn't share the tree
+        other = copy.deepcopy(self.index)
+        other.tree.add_file('other.txt', 'fea80f2db003d4ebc4536023814aa885')
+        self.assertEqual(self.index['fea80f2db003d4ebc4536023814aa885'], ['moved/copy.txt'])
+
+    def test_change_md5(self):
+        #Case: a modified file moves to the entries of its new md5
+        self.tree.add_file('root_file.txt', 'fea80f2db003d4ebc4536023814aa885')
+        self.snapshot['81bcb26fd4acfaa5d0acc7eef1d3013a'].remove('root_file.txt')
+        self.snapshot['fea80f2db003d4ebc4536023814aa885'].append('root_file.txt')
+        self.assertIndexEqual(self.snapshot)
+
+        #Case: removed files return their md5, unknown ones None
+        self.assertEqual(
+            self.tree.remove_file('root_file.txt'), ('fea80f2db003d4ebc4536023814aa885', None))
+        self.assertIsNone(self.tree.remove_file('root_file.txt'))
+
+    def test_stat(self):
+        stat = pack_stat(10, 1234.5, 42)
+        self.tree.add_file('sub_dir_1/test_file_1.txt', 'fea80f2db003d4ebc4536023814aa885', stat)
+        self.assertEqual(self.tree.get_stat('sub_dir_1/test_file_1.txt'), stat)
+        self.assertIsNone(self.tree.get_stat('root_file.txt'))
+
+        #Case: the same md5 without a stat keeps the one known
+        self.tree.add_file('sub_dir_1/test_file_1.txt', 'fea80f2db003d4ebc4536023814aa885')
+        self.assertEqual(self.tree.get_stat('sub_dir_1/test_file_1.txt'), stat)
+        self.assertEqual(
+            list(self.tree.iter_stats()),
+            [('sub_dir_1/test_file_1.txt', 'fea80f2db003d4ebc4536023814aa885', stat)])
+        self.assertEqual(unpack_stat(stat), (10, 1234.5, 42))
+
+        #Case: every change makes the tree dirty
+        self.tree.dirty = False
+        self.tree.set_stat('sub_dir_1/test_file_1.txt', None)
+        self.assertIsNone(self.tree.get_stat('sub_dir_1/test_file_1.txt'))
+        self.assertTrue(self.tree.dirty)
+
+        #Case: the stats given to the bulk load
+        tree = SnapshotTree.from_files([
+            ('a/b.txt', 'fea80f2db003d4ebc4536023814aa885', stat), ('c.txt', 'a' * 32)])
+        self.assertEqual(tree.get_stat('a/b.txt'), stat)
+        self.assertIsNone(tree.get_stat('c.txt'))
+
+    def test_move_dir(self):
+        self.tree.move_dir('sub_dir_2', 'new/sub_dir')
+        self.assertIndexEqual({
+            'fea80f2db003d4ebc4536023814aa885': ['sub_dir_1/test_file_1.txt'],
+            '81bcb26fd4acfaa5d0acc7eef1d3013a': [
+                'new/sub_dir/test_file_2.txt', 'root_file.txt', u'new/sub_dir/f\xe9.txt'],
+        })
+        self.assertEqual(self.tree.dirs['new/sub_dir']['prefix'], 'new/sub_dir/')
+
+    def test_compact_layout(self):
+        #the entries share the strings and the nodes of the tree
+        node = self.tree.dirs['sub_dir_1']
+        node_name, node_md5 = node['files'].items()[0]
+        entry = self.tree.by_md5['fea80f2db003d4ebc4536023814aa885']
+        self.assertIsInstance(entry, tuple)
+        self.assertIs(entry[0], node)
+        self.assertIs(entry[1], node_name)
+        md5_key = [key for key in self.tree.by_md5 if key == node_md5][0]
+        self.assertIs(md5_key, node_md5)
+
+
+if __name__ == '__main__':
+    unittest.main()
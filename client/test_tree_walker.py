@@ -0,0 +1,92 @@
+from tree_walker import TreeWalker
+from tree_walker import FileRecord
+from tree_walker import dir_size
+import tree_walker
+import unittest
+import tempfile
+import shutil
+import os
+
+
+class TreeWalkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = {}
+        for rel_path in [
+                'file.txt', 'sub_dir_1/file_1.txt', 'sub_dir_1/deep/file_2.txt',
+                'sub_dir_2/file_3.txt', 'skipped/file_4.txt']:
+            path = os.path.join(self.root, rel_path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').write(rel_path)
+            self.files[path] = len(rel_path)
+        os.makedirs(os.path.join(self.root, 'empty_dir'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def walk(self, **kwargs):
+        return sorted(TreeWalker(**kwargs).walk(self.root))
+
+    def test_walk(self):
+        records = self.walk(workers=1)
+        self.assertEqual(
+            [(record.path, record.size) for record in records],
+            sorted(self.files.items()))
+        st = os.stat(os.path.join(self.root, 'file.txt'))
+        self.assertIn(
+            FileRecord(os.path.join(self.root, 'file.txt'), st.st_size, st.st_mtime, st.st_ino),
+            records)
+
+        #Case: the threads find the same files
+        self.assertEqual(self.walk(workers=4), records)
+
+    def test_skip(self):
+        skipped_dir = os.path.join(self.root, 'skipped')
+        skipped_file = os.path.join(self.root, 'file.txt')
+        for workers in (1, 4):
+            paths = [record.path for record in self.walk(
+                workers=workers,
+                skip_dir=lambda path: path == skipped_dir,
+                skip_file=lambda path: path == skipped_file)]
+            self.assertEqual(
+                paths,
+                sorted(set(self.files) - set([skipped_file, skipped_dir + '/file_4.txt'])))
+
+    def test_links(self):
+        os.symlink(
+            os.path.join(self.root, 'file.txt'), os.path.join(self.root, 'link.txt'))
+        os.symlink(
+            os.path.join(self.root, 'sub_dir_1'), os.path.join(self.root, 'link_dir'))
+        os.symlink(
+            os.path.join(self.root, 'missing'), os.path.join(self.root, 'broken'))
+        paths = [record.path for record in self.walk()]
+        #the links to files are followed, not the ones to directories
+        self.assertEqual(
+            paths, sorted(self.files.keys() + [os.path.join(self.root, 'link.txt')]))
+
+    def test_listdir_fallback(self):
+        scandir = tree_walker.scandir
+        tree_walker.scandir = None
+        try:
+            self.assertEqual(
+                [(record.path, record.size) for record in self.walk()],
+                sorted(self.files.items()))
+        finally:
+            tree_walker.scandir = scandir
+
+    def test_stop(self):
+        walk = TreeWalker(workers=4).walk(self.root)
+        self.assertIn(next(walk).path, self.files)
+        walk.close()
+
+        #Case: missing directory
+        self.assertEqual(list(TreeWalker().walk(os.path.join(self.root, 'missing'))), [])
+
+    def test_dir_size(self):
+        self.assertEqual(dir_size(self.root), sum(self.files.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Walk of the sync root shared by the snapshot and the GUI.
+
+Every entry is stat'ed once and the result is handed to the consumer as a
+FileRecord, so nobody has to stat (or open) the file again to know if it
+changed. The directories are listed by a pool of threads: listdir and stat
+release the GIL, a walk of a big tree waits on the filesystem metadata and
+not on a single python thread.
+With the scandir package (python 3 os.scandir backport) the type of the
+entries comes from the directory listing and the subdirectories are never
+stat'ed.
+"""
+
+import collections
+import threading
+import logging
+import Queue
+import stat
+import os
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# threads listing the directories
+WALK_WORKERS = 4
+
+logger = logging.getLogger("RawBox")
+
+FileRecord = collections.namedtuple("FileRecord", "path size mtime inode")
+
+
+def _record(path, st):
+    return FileRecord(path, st.st_size, st.st_mtime, st.st_ino)
+
+
+def _scan_scandir(dir_path):
+    files, dirs = [], []
+    for entry in scandir(dir_path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif entry.is_file():
+                # follows the links as os.walk did
+                files.append(_record(entry.path, entry.stat()))
+        except OSError:
+            # vanished or broken link
+            continue
+    return files, dirs
+
+
+def _scan_listdir(dir_path):
+    files, dirs = [], []
+    for name in os.listdir(dir_path):
+        path = os.path.join(dir_path, name)
+        try:
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(path)
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files.append(_record(path, st))
+    return files, dirs
+
+
+def scan_dir(dir_path):
+    """ ([FileRecord of the files], [paths of the subdirectories]) of a directory """
+    if scandir is not None:
+        return _scan_scandir(dir_path)
+    return _scan_listdir(dir_path)
+
+
+class TreeWalker(object):
+    """
+    yield a FileRecord for each file under a directory, in no particular
+    order; skip_dir(path) and skip_file(path) leave out whole subtrees and
+    single files (without stat'ing them in the first case)
+    """
+
+    def __init__(self, workers=WALK_WORKERS, skip_dir=None, skip_file=None):
+        self.workers = workers
+        self.skip_dir = skip_dir or (lambda path: False)
+        self.skip_file = skip_file or (lambda path: False)
+
+    def _scan(self, dir_path):
+        try:
+            files, dirs = scan_dir(dir_path)
+        except OSError as e:
+            logger.warning("unable to list {}: {}".format(dir_path, e))
+            return [], []
+        files = [record for record in files if not self.skip_file(record.path)]
+        dirs = [path for path in dirs if not self.skip_dir(path)]
+        return files, dirs
+
+    def walk(self, top):
+        if self.workers <= 1:
+            return self._walk_serial(top)
+        return self._walk_parallel(top)
+
+    def _walk_serial(self, top):
+        to_visit = [top]
+        while to_visit:
+            files, dirs = self._scan(to_visit.pop())
+            to_visit.extend(dirs)
+            for record in files:
+                yield record
+
+    def _walk_parallel(self, top):
+        dirs_queue = Queue.Queue()
+        # the records of a directory are queued together
+        batches = Queue.Queue()
+        outstanding = [1]
+        lock = threading.Lock()
+        stopped = threading.Event()
+        done = object()
+
+        def work():
+            while True:
+                dir_path = dirs_queue.get()
+                if dir_path is None:
+                    return
+                if stopped.is_set():
+                    continue
+                files, dirs = self._scan(dir_path)
+                # queued before the count, done is always the last batch
+                batches.put(files)
+                with lock:
+                    outstanding[0] += len(dirs) - 1
+                    finished = outstanding[0] == 0
+                for sub_dir in dirs:
+                    dirs_queue.put(sub_dir)
+                if finished:
+                    batches.put(done)
+
+        threads = [threading.Thread(target=work, name="tree-walker") for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        dirs_queue.put(top)
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                for record in batch:
+                    yield record
+        finally:
+            stopped.set()
+            for thread in threads:
+                dirs_queue.put(None)
+
+
+def dir_size(top):
+    """ bytes of the files under top """
+    return sum(record.size for record in TreeWalker().walk(top))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+what the client and the server compress before sending it
+"""
+
+import os
+
+# file types already compressed, always sent as they are
+COMPRESSED_EXTENSIONS = frozenset([
+    ".gz", ".tgz", ".bz2", ".xz", ".zip", ".7z", ".rar", ".jar", ".apk",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".ogg", ".flac",
+    ".mp4", ".mkv", ".avi", ".mov", ".webm", ".pdf", ".docx", ".xlsx", ".pptx",
+    ".odt", ".ods", ".odp",
+])
+COMPRESS_MIN_SIZE = 1024
+# size of the file of a gzipped download, that has no Content-Length
+UNCOMPRESSED_SIZE_HEADER = "X-Uncompressed-Size"
+
+
+def compressible(path, size):
+    """ check if a file is worth compressing before sending it """
+    return size >= COMPRESS_MIN_SIZE and \
+        os.path.splitext(path)[1].lower() not in COMPRESSED_EXTENSIONS
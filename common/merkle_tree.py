@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+the merkle tree of the files, built the same way by the client and the
+server to compare their directories by hash
+"""
+
+import hashlib
+
+
+class MerkleTree(object):
+    """
+    Hash tree of the files of a synchronized directory, with a node for each
+    directory:
+        dirs = { dir_rel_path : {"sum": int, "hash": md5, "files": {name: md5}, "dirs": set()} }
+    The hash of a directory is the md5 of the sum (modulo 2 ** 128) of a digest
+    for each child entry, so a change to a file only updates the directories on
+    its path (O(depth)) and the root hash doesn't depend on the order of the
+    changes: the client and the server compute the same hashes.
+    """
+    MODULE = 2 ** 128
+
+    def __init__(self):
+        self.dirs = {"": self._new_node()}
+
+    @classmethod
+    def from_files(cls, files):
+        """
+        build the tree from (path, md5, ...) items hashing every directory
+        once, md5 None for the directories; the items go to _loaded too
+        """
+        tree = cls()
+        dirs = tree.dirs
+        entry = tree._entry
+        for item in files:
+            path, file_md5 = item[0], item[1]
+            if file_md5 is None:
+                continue
+            dir_path, _, name = path.rpartition("/")
+            if dir_path not in dirs:
+                tree._make_dirs(dir_path, propagate=False)
+            node = dirs[dir_path]
+            tree._loaded(node, name, item)
+            node["files"][name] = file_md5
+            node["sum"] += entry("f", name, file_md5)
+        # children before fathers: the deepest directories first
+        for dir_path in sorted(tree.dirs, key=lambda d: d.count("/") + bool(d), reverse=True):
+            node = tree.dirs[dir_path]
+            node["sum"] %= cls.MODULE
+            node["hash"] = tree._node_hash(node["sum"])
+            if dir_path != "":
+                father, name = tree._split(dir_path)
+                tree._update_entry(father, "d", name, None, node["hash"])
+        return tree
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """ build the tree from a { md5: [path, ...] } snapshot (client) """
+        return cls.from_files(
+            (path, file_md5) for file_md5, paths in snapshot.items() for path in paths)
+
+    @classmethod
+    def from_paths(cls, paths):
+        """ build the tree from a { client_path : [server_path, md5, timestamp] } dictionary (server) """
+        return cls.from_files((client_path, meta[1]) for client_path, meta in paths.iteritems())
+
+    def _loaded(self, node, name, item):
+        """ called by from_files for every file, for the subclasses """
+        pass
+
+    def _new_node(self):
+        return {"sum": 0, "hash": self._node_hash(0), "files": {}, "dirs": set()}
+
+    def _split(self, path):
+        """ split a relative path in (father directory, name) """
+        if "/" in path:
+            return tuple(path.rsplit("/", 1))
+        return "", path
+
+    def _entry(self, kind, name, digest):
+        """ digest of a child entry: kind is "f" for files and "d" for directories """
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        return int(hashlib.md5("".join([kind, name, "\0", digest])).hexdigest(), 16)
+
+    def _node_hash(self, total):
+        return hashlib.md5("{:032x}".format(total)).hexdigest()
+
+    def _update_entry(self, dir_path, kind, name, old_digest, new_digest):
+        node = self.dirs[dir_path]
+        total = node["sum"]
+        if old_digest is not None:
+            total -= self._entry(kind, name, old_digest)
+        if new_digest is not None:
+            total += self._entry(kind, name, new_digest)
+        node["sum"] = total % self.MODULE
+
+    def _make_dirs(self, dir_path, propagate=True):
+        """ create the directory chain of dir_path if it doesn't exist """
+        if dir_path in self.dirs:
+            return
+        father, name = self._split(dir_path)
+        self._make_dirs(father, propagate)
+        self.dirs[dir_path] = self._new_node()
+        self.dirs[father]["dirs"].add(name)
+        if propagate:
+            self._update_entry(father, "d", name, None, self.dirs[dir_path]["hash"])
+
+    def _propagate(self, dir_path):
+        """ recompute the hashes from dir_path up to the root """
+        while True:
+            node = self.dirs[dir_path]
+            old_hash = node["hash"]
+            node["hash"] = self._node_hash(node["sum"])
+            if dir_path == "":
+                return
+            father, name = self._split(dir_path)
+            self._update_entry(father, "d", name, old_hash, node["hash"])
+            dir_path = father
+
+    def add_file(self, path, file_md5):
+        """ add a file or change its md5 """
+        dir_path, name = self._split(path)
+        self._make_dirs(dir_path)
+        node = self.dirs[dir_path]
+        old_md5 = node["files"].get(name)
+        if old_md5 == file_md5:
+            return
+        self._update_entry(dir_path, "f", name, old_md5, file_md5)
+        node["files"][name] = file_md5
+        self._propagate(dir_path)
+
+    def remove_file(self, path):
+        """ remove a file, and the directories left empty, if it exists """
+        dir_path, name = self._split(path)
+        node = self.dirs.get(dir_path)
+        if node is None or name not in node["files"]:
+            return
+        self._update_entry(dir_path, "f", name, node["files"].pop(name), None)
+        self._prune(dir_path)
+
+    def _prune(self, dir_path):
+        """ remove the empty directories from dir_path up and update the hashes """
+        node = self.dirs[dir_path]
+        while dir_path != "" and not node["files"] and not node["dirs"]:
+            father, name = self._split(dir_path)
+            self._update_entry(father, "d", name, node["hash"], None)
+            self.dirs[father]["dirs"].discard(name)
+            del self.dirs[dir_path]
+            dir_path, node = father, self.dirs[father]
+        self._propagate(dir_path)
+
+    def move_dir(self, src_dir, dst_dir):
+        """
+        move a directory with its subtree to a path not in the tree: the
+        hashes of the moved nodes don't depend on their path, only the two
+        chains of fathers are updated
+        """
+        node = self.dirs.get(src_dir)
+        if node is None or src_dir == "" or dst_dir in self.dirs:
+            return
+        prefix = src_dir + "/"
+        moved = {}
+        for dir_path in [d for d in self.dirs if d == src_dir or d.startswith(prefix)]:
+            moved[dst_dir + dir_path[len(src_dir):]] = self.dirs.pop(dir_path)
+        father, name = self._split(src_dir)
+        self._update_entry(father, "d", name, node["hash"], None)
+        self.dirs[father]["dirs"].discard(name)
+        self._prune(father)
+        father, name = self._split(dst_dir)
+        self._make_dirs(father)
+        self.dirs.update(moved)
+        self.dirs[father]["dirs"].add(name)
+        self._update_entry(father, "d", name, None, node["hash"])
+        self._propagate(father)
+
+    def get_md5(self, path):
+        """ return the md5 of a file in the tree or None """
+        dir_path, name = self._split(path)
+        node = self.dirs.get(dir_path)
+        if node is None:
+            return None
+        return node["files"].get(name)
+
+    def iter_files(self, dir_path=""):
+        """ yield (path, md5) for every file under dir_path """
+        to_visit = [dir_path] if dir_path in self.dirs else []
+        while to_visit:
+            current = to_visit.pop()
+            node = self.dirs[current]
+            prefix = current + "/" if current else ""
+            for name, file_md5 in node["files"].items():
+                yield prefix + name, file_md5
+            to_visit.extend(prefix + name for name in node["dirs"])
+
+    def _sorted_entries(self, dir_path):
+        node = self.dirs.get(dir_path)
+        if node is None:
+            # removed while it was walked
+            return iter([])
+        prefix = dir_path + "/" if dir_path else ""
+        entries = [(name, prefix + name, file_md5) for name, file_md5 in node["files"].items()]
+        # a directory sorts as its paths do, by its name followed by "/"
+        entries.extend((name + "/", prefix + name, None) for name in list(node["dirs"]))
+        entries.sort()
+        return iter(entries)
+
+    def iter_sorted(self, dir_path=""):
+        """
+        yield (path, md5) for every file under dir_path, sorted by path as
+        the snapshot streamed by the server; only the entries of the
+        directories on the current path are in memory
+        """
+        to_visit = [self._sorted_entries(dir_path)] if dir_path in self.dirs else []
+        while to_visit:
+            for _, path, file_md5 in to_visit[-1]:
+                if file_md5 is None:
+                    to_visit.append(self._sorted_entries(path))
+                    break
+                yield path, file_md5
+            else:
+                to_visit.pop()
+
+    def root_hash(self):
+        return self.dirs[""]["hash"]
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Memory and load time of the paths of an user: the [server_path, md5,
+timestamp] lists of the JSON, as User.paths kept them, against the PathMeta
+loaded by User.user_class_init.
+
+    python benchmark_paths.py --files 1000000
+
+The size is the whole footprint of the paths of the user: the sum of
+sys.getsizeof of every object reachable from the paths, their MerkleTree
+and the directories interned by PathMeta, each object counted once.
+"""
+
+import argparse
+import tempfile
+import hashlib
+import json
+import time
+import sys
+import os
+
+from server import MerkleTree
+import server
+
+
+def synthetic_users_data(files, files_per_dir):
+    """ the users data JSON of an user with files paths """
+    paths = {"": ["user@me.it", None, 0.0]}
+    for i in xrange(files):
+        dir_id = i // files_per_dir
+        client_path = "projects/project_{}/src/module_{}/file_{}.py".format(
+            dir_id // 50, dir_id, i)
+        paths[client_path] = [
+            "user@me.it/" + client_path, hashlib.md5(str(i)).hexdigest(), time.time()]
+    return json.dumps({"users": {"user@me.it": {"psw": "", "timestamp": 0.0, "paths": paths}}})
+
+
+def deep_size(obj):
+    seen = set()
+    to_visit = [obj]
+    size = 0
+    while to_visit:
+        obj = to_visit.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            to_visit.extend(obj.keys())
+            to_visit.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            to_visit.extend(obj)
+        # the dict subclasses too: UserPaths keeps its tree as attribute
+        if hasattr(obj, "__dict__"):
+            to_visit.append(obj.__dict__)
+        elif hasattr(obj, "__slots__"):
+            to_visit.extend(getattr(obj, name) for name in obj.__slots__)
+    return size
+
+
+def load_lists(users_data):
+    """ the paths as User.user_class_init kept them before PathMeta """
+    with open(users_data) as f:
+        saved = json.load(f)
+    paths = saved["users"]["user@me.it"]["paths"]
+    return paths, MerkleTree.from_paths(paths)
+
+
+def load_path_meta(users_data):
+    server.USERS_DATA = users_data
+    server.User.users = {}
+    server.User.user_class_init()
+    return server.User.users["user@me.it"].paths, server.PathMeta.server_dirs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=200000)
+    parser.add_argument("--files-per-dir", type=int, default=100)
+    args = parser.parse_args()
+
+    fd, users_data = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        f.write(synthetic_users_data(args.files, args.files_per_dir))
+    results = {}
+    try:
+        for name, load in (("lists", load_lists), ("PathMeta", load_path_meta)):
+            start = time.time()
+            paths = load(users_data)
+            load_time = time.time() - start
+            results[name] = deep_size(paths)
+            print "{:<10} {:>8.1f} MB {:>6.1f} bytes/file  load {:.2f}s".format(
+                name, results[name] / 2.0 ** 20, float(results[name]) / args.files, load_time)
+            del paths
+    finally:
+        os.remove(users_data)
+    print "PathMeta uses {:.0%} of the memory".format(
+        float(results["PathMeta"]) / results["lists"])
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,28 @@ from flask.ext.restful import reqparse, abort, Api, Resource
 from flask.ext.mail import Mail, Message
 from passlib.hash import sha256_crypt
 from flask.ext.httpauth import HTTPBasicAuth
-from flask import Flask, request
+from flask import Flask, Response, request
+from werkzeug.datastructures import FileStorage
 from server_errors import *
 import ConfigParser
+import tempfile
 import hashlib
 import shutil
+import struct
+import math
+import re
 import time
 import json
+import zlib
+import sys
+import gc
 import os
 
+# modules shared with the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from compression import compressible, UNCOMPRESSED_SIZE_HEADER
+from merkle_tree import MerkleTree
+
 
 HTTP_OK = 200
 HTTP_CREATED = 201
@@ -22,8 +35,33 @@ HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_CONFLICT = 409
 HTTP_GONE = 410
+HTTP_PRECONDITION_FAILED = 412
+HTTP_REQUEST_ENTITY_TOO_LARGE = 413
+
+DOWNLOAD_BLOCK_SIZE = 2 ** 16
+# seconds between the synchronizations suggested to idle clients, the
+# default of app.config["POLL_INTERVAL"]
+POLL_INTERVAL = 60
+# zlib level of the compressed downloads, 1 is the fastest
+COMPRESS_LEVEL = 1
+# bounds of the block size of the rsync signatures, about sqrt(file size)
+DELTA_MIN_BLOCK = 2 ** 11
+DELTA_MAX_BLOCK = 2 ** 17
+# operations of an rsync delta: "C" + offset, length in the current version
+# of the file and "L" + length followed by the literal bytes
+DELTA_COPY = struct.Struct(">QI")
+DELTA_LITERAL = struct.Struct(">I")
+# biggest chunk of the chunked uploads, the client cuts at most this size
+CHUNK_MAX_SIZE = 2 ** 18
+# seconds a chunk no file uses is kept in the store, for the chunked
+# uploads on the way
+CHUNKS_GRACE_TIME = 3600
+MD5_PATTERN = re.compile("^[0-9a-f]{32}$")
+# snapshot streamed a file per line, sorted by path
+NDJSON_MIMETYPE = "application/x-ndjson"
 
 app = Flask(__name__)
+app.config["POLL_INTERVAL"] = POLL_INTERVAL
 api = Api(app)
 auth = HTTPBasicAuth()
 _API_PREFIX = "/API/v1/"
@@ -33,15 +71,80 @@ USERS_DATA = "user_data.json"
 PENDING_USERS = ".pending.tmp"
 CORRUPTED_DATA = "corrupted_data"
 EMAIL_SETTINGS_INI = "email_settings.ini"
+SERVER_SETTINGS_INI = "server_settings.ini"
 
 SERVER_ROOT = os.path.dirname(__file__)
 USERS_DIRECTORIES = os.path.join(SERVER_ROOT, "user_dirs/")
 USERS_DATA = os.path.join(SERVER_ROOT, "user_data.json")
+# chunks of the chunked uploads of each user, by md5
+CHUNKS_DIRECTORY = os.path.join(SERVER_ROOT, "chunks/")
 
 parser = reqparse.RequestParser()
 parser.add_argument("task", type=str)
 
 
+class ChunkedInput(object):
+    """ wsgi.input of a request sent with chunked transfer encoding, decoded """
+
+    def __init__(self, stream):
+        self.stream = stream
+        # bytes left in the current chunk
+        self.left = 0
+        self.done = False
+
+    def _next_chunk(self):
+        line = self.stream.readline()
+        try:
+            self.left = int(line.split(";")[0].strip(), 16)
+        except ValueError:
+            abort(HTTP_BAD_REQUEST)
+        if not self.left:
+            # the trailer ends with an empty line
+            while self.stream.readline().strip():
+                pass
+            self.done = True
+
+    def read(self, size=-1):
+        blocks = []
+        while not self.done and size != 0:
+            if not self.left:
+                self._next_chunk()
+                continue
+            block = self.stream.read(self.left if size < 0 else min(size, self.left))
+            if not block:
+                abort(HTTP_BAD_REQUEST)
+            self.left -= len(block)
+            if not self.left:
+                # the CRLF after the chunk
+                self.stream.readline()
+            blocks.append(block)
+            if size > 0:
+                size -= len(block)
+        return "".join(blocks)
+
+
+class ChunkedRequests(object):
+    """
+    WSGI middleware decoding the bodies sent with chunked transfer encoding
+    (the compressed uploads, whose size is unknown) when the WSGI server
+    doesn't, it sets wsgi.input_terminated when it does
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower() and \
+                not environ.get("wsgi.input_terminated"):
+            environ["wsgi.input"] = ChunkedInput(environ["wsgi.input"])
+            environ["wsgi.input_terminated"] = True
+            # a Content-Length with chunked encoding is not the body length
+            environ.pop("CONTENT_LENGTH", None)
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = ChunkedRequests(app.wsgi_app)
+
+
 def to_md5(full_path=None, block_size=2 ** 20, file_object=False):
     """ if path is a file, return a md5;
     if path is a directory, return False
@@ -61,6 +164,284 @@ def to_md5(full_path=None, block_size=2 ** 20, file_object=False):
     return m.hexdigest()
 
 
+def gzip_blocks(blocks):
+    """ gzip stream of the blocks """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def delta_block_size(size):
+    """ block size of the rsync signatures of a file of size bytes """
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return min(max(block_size, DELTA_MIN_BLOCK), DELTA_MAX_BLOCK)
+
+
+def copy_bytes(src, dst, length):
+    while length > 0:
+        block = src.read(min(DOWNLOAD_BLOCK_SIZE, length))
+        if not block:
+            abort(HTTP_BAD_REQUEST)
+        dst.write(block)
+        length -= len(block)
+
+
+def apply_delta(delta, base_path, size):
+    """
+    rebuild in a temporary file a file from an rsync delta against
+    base_path, 413 if it's bigger than size
+    """
+    rebuilt = tempfile.TemporaryFile()
+    with open(base_path, "rb") as base:
+        op = delta.read(1)
+        while op:
+            if op == "C":
+                offset, length = DELTA_COPY.unpack(delta.read(DELTA_COPY.size))
+                source = base
+                base.seek(offset)
+            elif op == "L":
+                length, = DELTA_LITERAL.unpack(
+                    delta.read(DELTA_LITERAL.size)
+                )
+                source = delta
+            else:
+                abort(HTTP_BAD_REQUEST)
+            size -= length
+            if size < 0:
+                abort(HTTP_REQUEST_ENTITY_TOO_LARGE)
+            copy_bytes(source, rebuilt, length)
+            op = delta.read(1)
+    rebuilt.seek(0)
+    return rebuilt
+
+
+def chunk_path(username, chunk_md5):
+    return os.path.join(CHUNKS_DIRECTORY, username, chunk_md5[:2], chunk_md5)
+
+
+def chunk_ref_path(username, chunk_md5):
+    """
+    where a chunk of a stored file is, instead of its bytes:
+    "<file md5> <offset> <length>"
+    """
+    return chunk_path(username, chunk_md5) + ".ref"
+
+
+def manifest_path(username, file_md5):
+    """ the list of the chunks of a file rebuilt from the store, "<md5> <length>" per line """
+    return os.path.join(CHUNKS_DIRECTORY, username, "manifests", file_md5)
+
+
+def read_manifest(username, file_md5):
+    """ the (md5, length) of the chunks of a file rebuilt from the store """
+    with open(manifest_path(username, file_md5)) as manifest:
+        return [(chunk_md5, int(length)) for chunk_md5, length in
+                (line.split() for line in manifest)]
+
+
+def store_file(full_path, data):
+    """ write data aside and rename it, a file in the store is always whole """
+    try:
+        os.makedirs(os.path.dirname(full_path))
+    except OSError:
+        pass  # already there
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.rename(tmp_path, full_path)
+
+
+def read_chunk(username, chunk_md5, stored_files):
+    """
+    the bytes of a chunk in the store of username, uploaded or in a file
+    the user stored (stored_files() is { md5: server_path }); 412 if it's
+    not there or the file changed
+    """
+    try:
+        with open(chunk_path(username, chunk_md5), "rb") as chunk:
+            return chunk.read()
+    except IOError:
+        pass
+    try:
+        with open(chunk_ref_path(username, chunk_md5)) as ref:
+            file_md5, offset, length = ref.read().split()
+        with open(os.path.join(USERS_DIRECTORIES, stored_files()[file_md5]), "rb") as f:
+            f.seek(int(offset))
+            data = f.read(int(length))
+    except (IOError, KeyError, ValueError):
+        abort(HTTP_PRECONDITION_FAILED)
+    if hashlib.md5(data).hexdigest() != chunk_md5:
+        abort(HTTP_PRECONDITION_FAILED)
+    return data
+
+
+def assemble_chunks(manifest, username, size):
+    """
+    rebuild in a temporary file a file from the list of the md5 of its
+    chunks, one per line; 412 if a chunk is not in the store, 413 if the
+    file is bigger than size. The list is
+    kept in the store by the md5 of the file, the chunks it uses stay there
+    as long as a path of the user has that md5 (see compact_chunks and
+    sweep_chunks)
+    """
+    rebuilt = tempfile.TemporaryFile()
+    file_md5 = hashlib.md5()
+    chunks = []
+    files = {}
+
+    def stored_files():
+        # the paths of the user are scanned only if a chunk is in a file
+        if not files:
+            files.update(
+                (meta.md5, meta[0]) for meta in User.get_user(username).paths.itervalues()
+                if meta.md5
+            )
+        return files
+
+    for line in manifest:
+        chunk_md5 = line.strip()
+        if not chunk_md5:
+            continue
+        if not MD5_PATTERN.match(chunk_md5):
+            abort(HTTP_BAD_REQUEST)
+        data = read_chunk(username, chunk_md5, stored_files)
+        size -= len(data)
+        if size < 0:
+            abort(HTTP_REQUEST_ENTITY_TOO_LARGE)
+        rebuilt.write(data)
+        file_md5.update(data)
+        chunks.append((chunk_md5, len(data)))
+    store_file(
+        manifest_path(username, file_md5.hexdigest()),
+        "".join("{} {}\n".format(chunk_md5, length) for chunk_md5, length in chunks)
+    )
+    rebuilt.seek(0)
+    return rebuilt
+
+
+def compact_chunks(username, file_md5):
+    """
+    once the file rebuilt from the list of chunks of file_md5 is stored,
+    replace the bytes of its chunks in the store with where they are in
+    the file: the store keeps every byte once and the chunks are still
+    there for the next uploads
+    """
+    try:
+        chunks = read_manifest(username, file_md5)
+    except (IOError, ValueError):
+        return
+    offset = 0
+    for chunk_md5, length in chunks:
+        data_path = chunk_path(username, chunk_md5)
+        if os.path.isfile(data_path):
+            store_file(
+                chunk_ref_path(username, chunk_md5),
+                "{} {} {}".format(file_md5, offset, length)
+            )
+            try:
+                os.remove(data_path)
+            except OSError:
+                pass  # removed by another compaction
+        offset += length
+
+
+def sweep_chunks(username, live_md5s):
+    """
+    remove from the chunk store of username the lists of chunks of the
+    files whose md5 is not in live_md5s and the uploaded chunks no other
+    list uses, but for the ones stored in the last CHUNKS_GRACE_TIME
+    seconds; the chunks that point to a removed file move to another
+    file that has them, if any
+    """
+    user_chunks = os.path.join(CHUNKS_DIRECTORY, username)
+    manifests = os.path.dirname(manifest_path(username, ""))
+    # md5 of a chunk: where it is in a live file
+    located = {}
+    try:
+        file_md5s = os.listdir(manifests)
+    except OSError:
+        file_md5s = []
+    for file_md5 in file_md5s:
+        try:
+            if file_md5 in live_md5s:
+                offset = 0
+                for chunk_md5, length in read_manifest(username, file_md5):
+                    located.setdefault(
+                        chunk_md5, "{} {} {}".format(file_md5, offset, length))
+                    offset += length
+            else:
+                os.remove(os.path.join(manifests, file_md5))
+        except (IOError, OSError, ValueError):
+            pass  # removed by another sweep
+    expired = time.time() - CHUNKS_GRACE_TIME
+    for dir_path, _, names in os.walk(user_chunks):
+        if dir_path == manifests:
+            continue
+        for name in names:
+            full_path = os.path.join(dir_path, name)
+            try:
+                if name.endswith(".ref"):
+                    with open(full_path) as ref:
+                        if ref.read().split(" ", 1)[0] in live_md5s:
+                            continue
+                    if name[:-len(".ref")] in located:
+                        store_file(full_path, located[name[:-len(".ref")]])
+                    else:
+                        os.remove(full_path)
+                elif name not in located and os.path.getmtime(full_path) < expired:
+                    os.remove(full_path)
+            except (IOError, OSError):
+                pass  # removed by another sweep
+
+
+def decoded_upload(f, encoding, base_path=None, username=None, size=None):
+    """
+    the uploaded file decoded in a temporary file if the client compressed
+    it, sent an rsync delta against base_path or the list of its chunks
+    in the store of username (file_encoding field); the file is decoded
+    up to the size the client announced (file_size field), 413 if it's
+    bigger
+    """
+    if not encoding:
+        return f
+    try:
+        left = int(size)
+    except (TypeError, ValueError):
+        abort(HTTP_BAD_REQUEST)
+    if encoding == "chunks" and username:
+        return FileStorage(assemble_chunks(f, username, left), f.filename)
+    if encoding == "rsync-delta" and base_path:
+        try:
+            return FileStorage(apply_delta(f, base_path, left), f.filename)
+        except struct.error:
+            abort(HTTP_BAD_REQUEST)
+    if encoding != "gzip":
+        abort(HTTP_BAD_REQUEST)
+    decoded = tempfile.TemporaryFile()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        for chunk in iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), b''):
+            # a block at a time, a small body can expand a lot
+            while chunk:
+                block = decompressor.decompress(chunk, DOWNLOAD_BLOCK_SIZE)
+                chunk = decompressor.unconsumed_tail
+                left -= len(block)
+                if left < 0:
+                    abort(HTTP_REQUEST_ENTITY_TOO_LARGE)
+                decoded.write(block)
+        block = decompressor.flush()
+    except zlib.error:
+        abort(HTTP_BAD_REQUEST)
+    if len(block) > left:
+        abort(HTTP_REQUEST_ENTITY_TOO_LARGE)
+    decoded.write(block)
+    decoded.seek(0)
+    return FileStorage(decoded, f.filename)
+
+
 def can_write(username, server_path):
     """
     This sharing system is in read-only mode.
@@ -70,10 +451,182 @@ def can_write(username, server_path):
     return server_path.split('/')[0] == username
 
 
+
+def compact_text(text):
+    """ an ascii unicode string (as the JSON ones) as str, a quarter of the memory """
+    if isinstance(text, unicode):
+        try:
+            return text.encode("ascii")
+        except UnicodeEncodeError:
+            pass
+    return text
+
+
+class PathMeta(object):
+    """
+    The [server_path, md5, timestamp] of a path in User.paths, in a fraction
+    of the memory of the list: the directory of the server path is shared by
+    the paths in it and the ascii strings are str. It reads as the list
+    (meta[1], server_path, md5, timestamp = meta), it is saved as the list
+    and it never changes, a new PathMeta replaces it; the loops over many
+    paths read the attributes instead.
+    The md5 stays hexadecimal: it is the same string of the MerkleTree.
+    """
+    __slots__ = ("server_dir", "name", "md5", "timestamp")
+    __hash__ = None
+
+    # directories of the server paths, a string each; rebuilt from the paths
+    # of the users by prune_server_dirs once it doubled
+    server_dirs = {}
+    pruned_size = 0
+
+    def __init__(self, server_path, md5, timestamp):
+        # compact_text inlined, millions of them are built at the start
+        if isinstance(server_path, unicode):
+            try:
+                server_path = server_path.encode("ascii")
+            except UnicodeEncodeError:
+                pass
+        if isinstance(md5, unicode):
+            md5 = md5.encode("ascii")
+        cut = server_path.rfind("/") + 1
+        server_dir = server_path[:cut]
+        self.server_dir = PathMeta.server_dirs.setdefault(server_dir, server_dir)
+        self.name = server_path[cut:]
+        self.md5 = md5
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_meta(cls, meta):
+        """ PathMeta of a [server_path, md5, timestamp] list (or the PathMeta itself) """
+        if isinstance(meta, cls):
+            return meta
+        return cls(*meta)
+
+    @classmethod
+    def prune_server_dirs(cls, users):
+        """
+        Drop the directories no path of users ({ username : User }) has
+        anymore, once the table doubled since the last time: the cost of the
+        walk of the paths is spread over the paths that were added.
+        """
+        if len(cls.server_dirs) <= 2 * cls.pruned_size:
+            return
+        server_dirs = {}
+        for user in users.itervalues():
+            for meta in user.paths.itervalues():
+                server_dirs[meta.server_dir] = meta.server_dir
+        cls.server_dirs = server_dirs
+        cls.pruned_size = len(server_dirs)
+
+    @property
+    def server_path(self):
+        return self.server_dir + self.name
+
+    def to_list(self):
+        return [self.server_path, self.md5, self.timestamp]
+
+    def __getitem__(self, i):
+        if i == 0:
+            return self.server_dir + self.name
+        if i == 1:
+            return self.md5
+        if i == 2:
+            return self.timestamp
+        # negative indexes and slices
+        return self.to_list()[i]
+
+    def __iter__(self):
+        return iter((self.server_dir + self.name, self.md5, self.timestamp))
+
+    def __len__(self):
+        return 3
+
+    def __eq__(self, other):
+        if isinstance(other, (PathMeta, list, tuple)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "PathMeta({!r}, {!r}, {!r})".format(*self.to_list())
+
+
+def to_json(obj):
+    """ json default of the users data, the PathMeta are saved as lists """
+    if isinstance(obj, PathMeta):
+        return obj.to_list()
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+class UserPaths(dict):
+    """
+    The paths dictionary of an user, { client_path : PathMeta }, which keeps
+    its MerkleTree updated at every change (all the dict methods that change
+    it go through __setitem__ and __delitem__). The [server_path, md5,
+    timestamp] lists of the JSON are turned into PathMeta and the ascii
+    client paths into str.
+    """
+    def __init__(self, paths=None):
+        dict.__init__(self)
+        set_path = dict.__setitem__
+        for client_path, meta in (paths or {}).iteritems():
+            if isinstance(client_path, unicode):
+                client_path = compact_text(client_path)
+            if not isinstance(meta, PathMeta):
+                meta = PathMeta(*meta)
+            set_path(self, client_path, meta)
+        self.tree = MerkleTree.from_files(
+            (client_path, meta.md5) for client_path, meta in self.iteritems())
+
+    def __setitem__(self, client_path, meta):
+        client_path = compact_text(client_path)
+        meta = PathMeta.from_meta(meta)
+        dict.__setitem__(self, client_path, meta)
+        if meta.md5 is None:
+            self.tree.remove_file(client_path)
+        else:
+            self.tree.add_file(client_path, meta.md5)
+
+    def __delitem__(self, client_path):
+        dict.__delitem__(self, client_path)
+        self.tree.remove_file(client_path)
+
+    def update(self, *args, **kwargs):
+        for client_path, meta in dict(*args, **kwargs).iteritems():
+            self[client_path] = meta
+
+    def setdefault(self, client_path, meta=None):
+        if client_path not in self:
+            self[client_path] = meta
+        return self[client_path]
+
+    def pop(self, client_path, *default):
+        if client_path not in self:
+            return dict.pop(self, client_path, *default)
+        meta = self[client_path]
+        del self[client_path]
+        return meta
+
+    def popitem(self):
+        client_path, meta = dict.popitem(self)
+        self.tree.remove_file(client_path)
+        return client_path, meta
+
+    def clear(self):
+        dict.clear(self)
+        self.tree = MerkleTree()
+
+
 class User(object):
     """
     Maintaining two dictionaries:
-        · paths     = { client_path : [server_path, md5/None, timestamp] }
+        · paths     = { client_path : PathMeta(server_path, md5/None, timestamp) }
         None instead of the md5 means that the path is a directory.
         · shared_resources: { server_path : [owner, ben1, ben2, ...] }
     The full path to access to the file is a join between USERS_DIRECTORIES and
@@ -85,6 +638,10 @@ class User(object):
     # CLASS AND STATIC METHODS
     @staticmethod
     def user_class_init():
+        # millions of objects and no cycles: the collections triggered by
+        # the allocations would only walk them again and again
+        gc_enabled = gc.isenabled()
+        gc.disable()
         try:
             ud = open(USERS_DATA, "r")
             saved = json.load(ud)
@@ -95,8 +652,15 @@ class User(object):
         except ValueError:      # invalid json
             os.remove(USERS_DATA)
         else:
-            for u, v in saved["users"].iteritems():
+            # the JSON of an user is dropped once its paths are PathMeta
+            users = saved.pop("users")
+            while users:
+                u, v = users.popitem()
                 User(u, None, from_dict=v)
+            PathMeta.pruned_size = len(PathMeta.server_dirs)
+        finally:
+            if gc_enabled:
+                gc.enable()
 
     @classmethod
     def save_users(cls, filename=None):
@@ -110,7 +674,7 @@ class User(object):
             to_save["users"][u] = v.to_dict()
 
         with open(filename, "w") as f:
-            json.dump(to_save, f)
+            json.dump(to_save, f, default=to_json)
 
     @classmethod
     def get_user(cls, username):
@@ -125,7 +689,7 @@ class User(object):
         if from_dict:
             self.username = username
             self.psw = from_dict["psw"]
-            self.paths = from_dict["paths"]
+            self.paths = UserPaths(from_dict["paths"])
             self.timestamp = from_dict["timestamp"]
             User.users[username] = self
             return
@@ -142,8 +706,8 @@ class User(object):
         #self.psw = psw_hash
 
         # path of each file and each directory of the user:
-        #     { client_path : [server_path, md5, timestamp] }
-        self.paths = {}
+        #     { client_path : PathMeta(server_path, md5, timestamp) }
+        self.paths = UserPaths()
 
         # timestamp of the last change in the user's files
         self.timestamp = time.time()
@@ -235,8 +799,14 @@ class User(object):
                   only_modify=False):
         md5 = to_md5(os.path.join(USERS_DIRECTORIES, server_path))
         now = time.time()
-        file_meta = [server_path, md5, now]
+        # the same PathMeta for the user and the beneficiaries
+        file_meta = PathMeta(server_path, md5, now)
+        old_meta = self.paths.get(client_path)
         self.paths[client_path] = file_meta
+        if md5 and os.path.isfile(manifest_path(self.username, md5)):
+            compact_chunks(self.username, md5)
+        if old_meta is not None:
+            self.release_chunks(old_meta.md5)
 
         is_shared = self._get_ben_path(server_path)
         if is_shared:
@@ -253,6 +823,46 @@ class User(object):
             self.timestamp = now
             User.save_users()
 
+    def _update_beneficiaries(self, server_path, file_meta, now):
+        """
+        Set (or remove, if file_meta is None) a path in the paths of the
+        beneficiaries of the share which contains server_path.
+        """
+        is_shared = self._get_ben_path(server_path)
+        if is_shared:
+            share, ben_path = is_shared
+            for ben_name in User.shared_resources[share][1:]:
+                ben_user = User.get_user(ben_name)
+                if file_meta is None:
+                    if ben_path in ben_user.paths:
+                        del ben_user.paths[ben_path]
+                else:
+                    ben_user.paths[ben_path] = file_meta
+                ben_user.timestamp = now
+
+    def move_tree(self, client_src, client_dest, server_dest):
+        """
+        Rename the paths of the directory client_src, already moved on disk
+        to server_dest, and of everything under it. The files keep their md5
+        (nothing is read again).
+        """
+        server_src = self.paths[client_src].server_path
+        now = time.time()
+        self.push_path(client_dest, server_dest, update_user_data=False)
+        prefix = client_src + "/"
+        for client_path in [p for p in self.paths if p.startswith(prefix)]:
+            old_meta = self.paths[client_path]
+            old_server_path = old_meta.server_path
+            new_meta = PathMeta(
+                server_dest + old_server_path[len(server_src):], old_meta.md5, now
+            )
+            self._update_beneficiaries(old_server_path, None, now)
+            del self.paths[client_path]
+            self.paths[client_dest + client_path[len(client_src):]] = new_meta
+            self._update_beneficiaries(new_meta.server_path, new_meta, now)
+        # removes the source directory and its fathers left empty
+        self.rm_path(client_src)
+
     def rm_path(self, client_path):
         """
         Remove the path from the paths dictionary. If there are empty
@@ -302,13 +912,32 @@ class User(object):
                 del User.shared_resources[shared_server_path]
 
         # remove the argument client_path and save
+        old_md5 = self.paths[client_path][1]
         del self.paths[client_path]
+        self.release_chunks(old_md5)
+        PathMeta.prune_server_dirs(User.users)
         User.save_users()
 
+    def release_chunks(self, file_md5):
+        """
+        Sweep the chunk store of the user once no path has file_md5, if the
+        file was rebuilt from the store.
+        """
+        if not file_md5 or \
+                not os.path.isfile(manifest_path(self.username, file_md5)):
+            return
+        live_md5s = set(meta.md5 for meta in self.paths.itervalues())
+        if file_md5 not in live_md5s:
+            sweep_chunks(self.username, live_md5s)
+
     def delete_user(self, username):
         user_root = self.paths[""][0]
         del User.users[username]
         shutil.rmtree(user_root)
+        shutil.rmtree(
+            os.path.join(CHUNKS_DIRECTORY, username), ignore_errors=True
+        )
+        PathMeta.prune_server_dirs(User.users)
         User.save_users()
 
     def add_share(self, client_path, beneficiary):
@@ -343,6 +972,14 @@ class User(object):
         return True
 
 
+@app.after_request
+def accept_encoding(response):
+    # the file bodies of the uploads can be gzipped, rsync deltas of the
+    # current version of the file or lists of chunks (file_encoding field)
+    response.headers["Accept-Encoding"] = "gzip, rsync-delta, chunks"
+    return response
+
+
 class Resource_with_auth(Resource):
     method_decorators = [auth.login_required]
 
@@ -448,19 +1085,19 @@ class Files(Resource_with_auth):
         u = User.get_user(auth.username())
         tree = {}
         for p, v in u.paths.iteritems():
-            if v[1] is None:
+            if v.md5 is None:
                 # the path p is a directory
                 continue
 
-            if not v[1] in tree:
-                tree[v[1]] = [{
+            if not v.md5 in tree:
+                tree[v.md5] = [{
                     "path": p,
-                    "timestamp": v[2]
+                    "timestamp": v.timestamp
                 }]
             else:
-                tree[v[1]].append({
+                tree[v.md5].append({
                     "path": p,
-                    "timestamp": v[2]
+                    "timestamp": v.timestamp
                 })
 
         snapshot = {
@@ -471,54 +1108,158 @@ class Files(Resource_with_auth):
         return snapshot, HTTP_OK
         # return json.dumps(snapshot), HTTP_OK
 
+    def _diffs_stream(self):
+        """ Stream the snapshot sorted by path, a JSON per line: first
+        {"timestamp": <timestamp>} and then a line for each file
+        {"path": <path>, "md5": <md5>, "timestamp": <timestamp>, "size": <size>}
+        Expected GET method without path and "format=ndjson" in the query
+        string, "prefix" restricts the files to the ones of a directory """
+        u = User.get_user(auth.username())
+        timestamp = u.timestamp
+        prefix = request.args.get("prefix", "").strip("/")
+        if prefix not in u.paths.tree.dirs:
+            return "Directory unreachable", HTTP_NOT_FOUND
+
+        def lines():
+            yield json.dumps({"timestamp": timestamp}) + "\n"
+            for path, md5 in u.paths.tree.iter_sorted(prefix):
+                try:
+                    meta = u.paths[path]
+                except KeyError:
+                    # deleted while it was streamed
+                    continue
+                try:
+                    size = os.path.getsize(
+                        os.path.join(USERS_DIRECTORIES, meta.server_path))
+                except OSError:
+                    size = None
+                yield json.dumps({
+                    "path": path,
+                    "md5": meta.md5,
+                    "timestamp": meta.timestamp,
+                    "size": size
+                }) + "\n"
+
+        return Response(lines(), mimetype=NDJSON_MIMETYPE)
+
     def _download(self, client_path):
         """Download
-        Returns file content as a byte string
+        Streams the file content, gzipped if the client accepts it and the
+        file is compressible; the ETag is the file md5
         Expected GET method with path"""
         u = User.get_user(auth.username())
         try:
             full_path = os.path.join(
                 USERS_DIRECTORIES, u.paths[client_path][0]
             )
+            file_md5 = u.paths[client_path][1]
         except KeyError:
             return "File unreachable", HTTP_NOT_FOUND
 
         try:
             f = open(full_path, "rb")
-            content = f.read()
-            f.close()
-            return content
         except IOError:
             abort(HTTP_GONE)
 
+        def read_blocks():
+            with f:
+                block = f.read(DOWNLOAD_BLOCK_SIZE)
+                while block:
+                    yield block
+                    block = f.read(DOWNLOAD_BLOCK_SIZE)
+
+        size = os.fstat(f.fileno()).st_size
+        if "gzip" in request.accept_encodings and \
+                compressible(client_path, size):
+            response = Response(
+                gzip_blocks(read_blocks()),
+                mimetype="application/octet-stream"
+            )
+            response.headers["Content-Encoding"] = "gzip"
+            response.headers[UNCOMPRESSED_SIZE_HEADER] = size
+        else:
+            response = Response(
+                read_blocks(), mimetype="application/octet-stream"
+            )
+            response.headers["Content-Length"] = size
+        response.headers["Vary"] = "Accept-Encoding"
+        if file_md5:
+            response.set_etag(file_md5)
+        return response
+
+    def _signatures(self, client_path):
+        """Signatures
+        Weak (adler32) and strong (md5) checksums of the blocks of a file,
+        to upload only an rsync delta of its new version:
+        { "md5": <md5>, "block_size": <bytes>, "blocks": [[<adler32>, <md5>]] }
+        Expected GET method with path and "signatures" in the query string"""
+        u = User.get_user(auth.username())
+        try:
+            full_path = os.path.join(
+                USERS_DIRECTORIES, u.paths[client_path][0]
+            )
+            file_md5 = u.paths[client_path][1]
+        except KeyError:
+            return "File unreachable", HTTP_NOT_FOUND
+
+        try:
+            f = open(full_path, "rb")
+        except IOError:
+            abort(HTTP_GONE)
+        with f:
+            block_size = delta_block_size(os.fstat(f.fileno()).st_size)
+            blocks = [
+                [zlib.adler32(block) & 0xffffffff, hashlib.md5(block).hexdigest()]
+                for block in iter(lambda: f.read(block_size), b"")
+            ]
+        return {
+            "md5": file_md5,
+            "block_size": block_size,
+            "blocks": blocks
+        }, HTTP_OK
+
     def get(self, client_path=None):
         if not client_path:
+            if request.args.get("format") == "ndjson":
+                return self._diffs_stream()
             return self._diffs()
+        elif request.args.get("signatures"):
+            return self._signatures(client_path)
         else:
             return self._download(client_path)
 
     def put(self, client_path):
         """ Update
-        Updates an existing file
+        Updates an existing file, the content can be an rsync delta of the
+        current version (see _signatures) whose md5 is base_md5
         Expected as POST data:
         { "file_content" : <file>} """
         u = User.get_user(auth.username())
 
         try:
-            server_path = u.paths[client_path][0]
+            server_path, server_md5 = u.paths[client_path][:2]
         except KeyError:
             abort(HTTP_NOT_FOUND)
 
         if not can_write(u.username, server_path):
             abort(HTTP_FORBIDDEN)
 
-        f = request.files["file_content"]
+        full_path = os.path.join(USERS_DIRECTORIES, server_path)
+        encoding = request.form.get("file_encoding")
+        if encoding == "rsync-delta" and \
+                request.form.get("base_md5") != server_md5:
+            # the delta is against another version of the file
+            abort(HTTP_PRECONDITION_FAILED)
+        f = decoded_upload(
+            request.files["file_content"], encoding, full_path, u.username,
+            request.form.get("file_size")
+        )
 
         if request.form["file_md5"] != to_md5(file_object=f):
             abort(HTTP_BAD_REQUEST)
 
         f.seek(0)
-        f.save(os.path.join(USERS_DIRECTORIES, server_path))
+        f.save(full_path)
         u.push_path(client_path, server_path, only_modify=True)
         return u.timestamp, HTTP_CREATED
 
@@ -538,7 +1279,10 @@ class Files(Resource_with_auth):
             # the server_path belongs to another user
             abort(HTTP_FORBIDDEN)
 
-        f = request.files["file_content"]
+        f = decoded_upload(
+            request.files["file_content"], request.form.get("file_encoding"),
+            username=u.username, size=request.form.get("file_size")
+        )
 
         if request.form["file_md5"] != to_md5(file_object=f):
             abort(HTTP_BAD_REQUEST)
@@ -549,6 +1293,122 @@ class Files(Resource_with_auth):
         return u.timestamp, HTTP_CREATED
 
 
+class Chunks(Resource_with_auth):
+    def post(self):
+        """ Missing chunks
+        Send the chunks of a list the user has not uploaded yet, in order:
+        { "missing": [<md5>] }
+        Expected as POST data:
+        { "chunks" : <md5> } repeated for each chunk """
+        username = auth.username()
+        missing = []
+        for chunk_md5 in request.form.getlist("chunks"):
+            if not MD5_PATTERN.match(chunk_md5):
+                abort(HTTP_BAD_REQUEST)
+            if chunk_md5 in missing:
+                continue
+            try:
+                # a new grace time, the upload of the file is coming
+                os.utime(chunk_path(username, chunk_md5), None)
+            except OSError:
+                # or in a stored file
+                if not os.path.isfile(chunk_ref_path(username, chunk_md5)):
+                    missing.append(chunk_md5)
+        return {"missing": missing}
+
+    def _put_many(self):
+        """ Chunks upload
+        Store many chunks sent one after the other in a single body
+        Expected as POST data:
+        { "file_content" : <the chunks>,
+          "chunks" : <md5>:<length> repeated for each chunk, in order,
+          "file_encoding" : "gzip" if the chunks are compressed, with
+          "file_size" : <size of the chunks> } """
+        username = auth.username()
+        body = decoded_upload(
+            request.files["file_content"], request.form.get("file_encoding"),
+            size=request.form.get("file_size")
+        )
+        for chunk in request.form.getlist("chunks"):
+            chunk_md5, _, length = chunk.partition(":")
+            if not MD5_PATTERN.match(chunk_md5) or not length.isdigit() or \
+                    int(length) > CHUNK_MAX_SIZE:
+                abort(HTTP_BAD_REQUEST)
+            data = body.read(int(length))
+            if hashlib.md5(data).hexdigest() != chunk_md5:
+                abort(HTTP_BAD_REQUEST)
+            store_file(chunk_path(username, chunk_md5), data)
+        return "chunks stored", HTTP_CREATED
+
+    def put(self, chunk_md5=None):
+        """ Chunk upload
+        Store a chunk of a file, sent as the body of the request, to upload
+        then the file as the list of its chunks (file_encoding "chunks");
+        without the md5 many chunks at once (see _put_many) """
+        if chunk_md5 is None:
+            return self._put_many()
+        if not MD5_PATTERN.match(chunk_md5) or \
+                (request.content_length or 0) > CHUNK_MAX_SIZE:
+            abort(HTTP_BAD_REQUEST)
+        data = request.get_data()
+        if hashlib.md5(data).hexdigest() != chunk_md5:
+            abort(HTTP_BAD_REQUEST)
+        store_file(chunk_path(auth.username(), chunk_md5), data)
+        return "chunk stored", HTTP_CREATED
+
+
+class Tree(Resource_with_auth):
+    def get(self, client_path=""):
+        """ Send the merkle tree node of a directory:
+        { "hash": <md5>, "timestamp": <timestamp of the last change>,
+          "dirs": { name: <md5> },
+          "files": { name: {"md5": <md5>, "timestamp": <timestamp>, "size": <size>} } }
+        Expected GET method, with "recursive" in the query string "files"
+        contains every file of the subtree, by path relative to the directory;
+        the X-Poll-Interval header suggests when an idle client should ask again """
+        u = User.get_user(auth.username())
+        client_path = client_path.strip("/")
+        try:
+            node = u.paths.tree.dirs[client_path]
+        except KeyError:
+            return "Directory unreachable", HTTP_NOT_FOUND
+
+        if request.args.get("recursive"):
+            prefix = client_path + "/" if client_path else ""
+            files = (
+                (path[len(prefix):], md5)
+                for path, md5 in u.paths.tree.iter_files(client_path)
+            )
+            dirs = {}
+        else:
+            files = node["files"].iteritems()
+            dirs = dict(
+                (name, u.paths.tree.dirs["/".join(filter(None, [client_path, name]))]["hash"])
+                for name in node["dirs"])
+
+        files_meta = {}
+        for rel_path, md5 in files:
+            path = "/".join(filter(None, [client_path, rel_path]))
+            meta = u.paths[path]
+            try:
+                size = os.path.getsize(
+                    os.path.join(USERS_DIRECTORIES, meta.server_path))
+            except OSError:
+                size = None
+            files_meta[rel_path] = {
+                "md5": meta.md5,
+                "timestamp": meta.timestamp,
+                "size": size
+            }
+
+        return {
+            "hash": node["hash"],
+            "timestamp": u.timestamp,
+            "dirs": dirs,
+            "files": files_meta
+        }, HTTP_OK, {"X-Poll-Interval": str(app.config["POLL_INTERVAL"])}
+
+
 class Actions(Resource_with_auth):
     def _delete(self):
         """ Expected as POST data:
@@ -578,7 +1438,8 @@ class Actions(Resource_with_auth):
 
     def _transfer(self, keep_the_original=True):
         """ Moves or copy a file from src to dest
-        depending on keep_the_original value
+        depending on keep_the_original value, a directory can only be
+        moved and its content is renamed without transferring it
         Expected as POST data:
         { "file_src": <path>, "file_dest": <path> }"""
         u = User.get_user(auth.username())
@@ -586,10 +1447,24 @@ class Actions(Resource_with_auth):
         client_dest = request.form["file_dest"]
 
         try:
-            server_src = u.paths[client_src][0]
+            server_src, src_md5 = u.paths[client_src][:2]
         except KeyError:
             abort(HTTP_NOT_FOUND)
 
+        # None instead of the md5: a directory, moved with its whole subtree
+        is_dir = src_md5 is None
+        if is_dir:
+            if keep_the_original or client_src == "":
+                abort(HTTP_BAD_REQUEST)
+            if client_dest in u.paths or \
+                    client_dest.startswith(client_src + "/"):
+                abort(HTTP_CONFLICT)
+            for shared_server_path in User.shared_resources:
+                if shared_server_path.startswith(server_src + "/") or \
+                        shared_server_path == server_src:
+                    # the beneficiaries reach the shares by their server path
+                    abort(HTTP_CONFLICT)
+
         server_dest = u.create_server_path(client_dest)
         if not server_dest:
             # the server_path belongs to another user
@@ -609,6 +1484,8 @@ class Actions(Resource_with_auth):
             # update the structure
             if keep_the_original:
                 u.push_path(client_dest, server_dest)
+            elif is_dir:
+                u.move_tree(client_src, client_dest, server_dest)
             else:
                 u.push_path(client_dest, server_dest, update_user_data=False)
                 u.rm_path(client_src)
@@ -706,6 +1583,14 @@ def mail_config_init():
         raise MissingConfigIni
 
 
+def server_config_init():
+    """ Read the optional settings of SERVER_SETTINGS_INI in app.config """
+    config = ConfigParser.ConfigParser()
+    if config.read(SERVER_SETTINGS_INI) and \
+            config.has_option("sync", "poll_interval"):
+        app.config["POLL_INTERVAL"] = config.getint("sync", "poll_interval")
+
+
 def send_mail(receiver, obj, content):
     """ Send an email to the 'receiver', with the
     specified object ('obj') and the specified 'content' """
@@ -732,6 +1617,7 @@ def verify_password(username, password):
 def main():
     if not os.path.isdir(USERS_DIRECTORIES):
         os.makedirs(USERS_DIRECTORIES)
+    server_config_init()
     User.user_class_init()
     app.run(host="0.0.0.0", debug=True)         # TODO: remove debug=True
 
@@ -741,6 +1627,14 @@ api.add_resource(
     Files,
     "{}files/<path:client_path>".format(_API_PREFIX),
     "{}files/".format(_API_PREFIX))
+api.add_resource(
+    Chunks,
+    "{}chunks/<string:chunk_md5>".format(_API_PREFIX),
+    "{}chunks/".format(_API_PREFIX))
+api.add_resource(
+    Tree,
+    "{}tree/<path:client_path>".format(_API_PREFIX),
+    "{}tree/".format(_API_PREFIX))
 api.add_resource(
     Shares,
     "{}shares/<path:client_path>".format(_API_PREFIX),
@@ -3,9 +3,11 @@
 
 from passlib.hash import sha256_crypt
 from base64 import b64encode
+import StringIO
 import tempfile
 import unittest
 import hashlib
+import zlib
 import server
 import shutil
 import json
@@ -13,6 +15,8 @@ import time
 import os
 
 from server import _API_PREFIX
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
 
 
 TEST_DIRECTORY = "test_users_dirs/"
@@ -24,6 +28,7 @@ def server_setup(root):
     server.SERVER_ROOT = root
     server.USERS_DIRECTORIES = os.path.join(root, "user_dirs/")
     server.USERS_DATA = os.path.join(root, "user_data.json")
+    server.CHUNKS_DIRECTORY = os.path.join(root, "chunks/")
     if not os.path.isdir(server.USERS_DIRECTORIES):
         os.makedirs(server.USERS_DIRECTORIES)
     server.User.user_class_init()
@@ -207,8 +212,11 @@ class TestFilesAPI(unittest.TestCase):
             headers=self.headers
         )
         self.assertEqual(received.status_code, 200)
-        with open(server_path, "r") as f:
-            self.assertEqual(json.loads(received.data), f.read())
+        with open(server_path, "rb") as f:
+            content = f.read()
+        self.assertEqual(received.data, content)
+        self.assertEqual(received.headers["ETag"], '"{}"'.format(hashlib.md5(content).hexdigest()))
+        self.assertEqual(int(received.headers["Content-Length"]), len(content))
 
         # try to download file not present
         url = "{}{}".format(TestFilesAPI.url_radix, "NO_SERVER_PATH")
@@ -218,6 +226,144 @@ class TestFilesAPI(unittest.TestCase):
         )
         self.assertEqual(rv.status_code, 404)
 
+    def test_compressed_transfers(self):
+        url = "{}{}{}".format(
+            _API_PREFIX, TestFilesAPI.url_radix, "compressed_file.txt"
+        )
+        content = "a line of a log file\n" * 1000
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress(content) + compressor.flush()
+        uploaded_file = os.path.join(
+            TestFilesAPI.root, "user_dirs", TestFilesAPI.user_test,
+            "compressed_file.txt"
+        )
+
+        # gzipped upload, the md5 is the one of the content
+        rv = self.tc.post(
+            url,
+            data={
+                "file_content": (StringIO.StringIO(gzipped), "file.txt"),
+                "file_encoding": "gzip",
+                "file_size": len(content),
+                "file_md5": hashlib.md5(content).hexdigest()
+            },
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 201)
+        try:
+            self.assertIn("gzip", rv.headers["Accept-Encoding"])
+            with open(uploaded_file, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+            # gzipped download for a client accepting it
+            headers = dict(self.headers, **{"Accept-Encoding": "gzip"})
+            received = self.tc.get(url, headers=headers)
+            self.assertEqual(received.headers["Content-Encoding"], "gzip")
+            self.assertEqual(
+                received.headers["X-Uncompressed-Size"], str(len(content))
+            )
+            self.assertLess(len(received.data), len(content))
+            self.assertEqual(
+                zlib.decompress(received.data, 16 + zlib.MAX_WBITS), content
+            )
+            self.assertEqual(
+                received.headers["ETag"],
+                '"{}"'.format(hashlib.md5(content).hexdigest())
+            )
+
+            # raw download for the others
+            received = self.tc.get(url, headers=self.headers)
+            self.assertNotIn("Content-Encoding", received.headers)
+            self.assertEqual(received.data, content)
+        finally:
+            os.remove(uploaded_file)
+
+        # invalid compressed body
+        rv = self.tc.post(
+            url.replace("compressed_file", "invalid_file"),
+            data={
+                "file_content": (StringIO.StringIO("not gzip"), "file.txt"),
+                "file_encoding": "gzip",
+                "file_size": len(content),
+                "file_md5": hashlib.md5(content).hexdigest()
+            },
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 400)
+
+        # compressed body bigger than announced, decoded no further
+        rv = self.tc.post(
+            url.replace("compressed_file", "too_big_file"),
+            data={
+                "file_content": (StringIO.StringIO(gzipped), "file.txt"),
+                "file_encoding": "gzip",
+                "file_size": len(content) - 1,
+                "file_md5": hashlib.md5(content).hexdigest()
+            },
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 413)
+
+        # compressed body without its size
+        rv = self.tc.post(
+            url.replace("compressed_file", "no_size_file"),
+            data={
+                "file_content": (StringIO.StringIO(gzipped), "file.txt"),
+                "file_encoding": "gzip",
+                "file_md5": hashlib.md5(content).hexdigest()
+            },
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 400)
+
+    def test_chunked_body(self):
+        # the compressed uploads have no Content-Length
+        url = "{}{}{}".format(
+            _API_PREFIX, TestFilesAPI.url_radix, "chunked_file.txt"
+        )
+        content = "a line of a log file\n" * 1000
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress(content) + compressor.flush()
+        boundary, form = encode_multipart({
+            "file_content": FileStorage(StringIO.StringIO(gzipped), "file.txt"),
+            "file_encoding": "gzip",
+            "file_size": str(len(content)),
+            "file_md5": hashlib.md5(content).hexdigest()
+        })
+
+        def chunked(body, size):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            return "".join(
+                "{:x};ext=1\r\n{}\r\n".format(len(chunk), chunk) for chunk in chunks
+            ) + "0\r\nTrailer: value\r\n\r\n"
+
+        headers = dict(self.headers, **{"Transfer-Encoding": "chunked"})
+        rv = self.tc.post(
+            url,
+            input_stream=StringIO.StringIO(chunked(form, 1000)),
+            content_type="multipart/form-data; boundary={}".format(boundary),
+            headers=headers
+        )
+        self.assertEqual(rv.status_code, 201)
+        uploaded_file = os.path.join(
+            TestFilesAPI.root, "user_dirs", TestFilesAPI.user_test,
+            "chunked_file.txt"
+        )
+        try:
+            with open(uploaded_file, "rb") as f:
+                self.assertEqual(f.read(), content)
+        finally:
+            os.remove(uploaded_file)
+
+        # broken chunk sizes
+        rv = self.tc.post(
+            url.replace("chunked_file", "broken_file"),
+            input_stream=StringIO.StringIO("zz\r\n" + form),
+            content_type="multipart/form-data; boundary={}".format(boundary),
+            headers=headers
+        )
+        self.assertEqual(rv.status_code, 400)
+
     def test_fail_auth_put(self):
         # fail authentication
         with open(TestFilesAPI.demo_file1, "r") as f:
@@ -284,6 +430,221 @@ class TestFilesAPI(unittest.TestCase):
             )
             self.assertEqual(rv.status_code, 400)
 
+    def test_delta_put(self):
+        cls = TestFilesAPI
+        backup = os.path.join(
+            cls.root, "user_dirs", cls.user_test, "backup_random_file.txt"
+        )
+        shutil.copy(cls.test_file_name, backup)
+        url = "{}{}{}".format(_API_PREFIX, cls.url_radix, "random_file.txt")
+        with open(cls.test_file_name, "rb") as f:
+            base = f.read()
+
+        # block signatures of the server version
+        rv = self.tc.get(url + "?signatures=1", headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        signatures = json.loads(rv.data)
+        self.assertEqual(signatures["md5"], hashlib.md5(base).hexdigest())
+        self.assertEqual(signatures["blocks"][0], [
+            zlib.adler32(base[:signatures["block_size"]]) & 0xffffffff,
+            hashlib.md5(base[:signatures["block_size"]]).hexdigest()
+        ])
+
+        # delta copying the old content and appending a line
+        content = base + "appended line\n"
+        delta = (
+            "C" + server.DELTA_COPY.pack(0, len(base)) +
+            "L" + server.DELTA_LITERAL.pack(14) + "appended line\n"
+        )
+
+        def put_delta(base_md5, delta=delta, size=len(content)):
+            return self.tc.put(
+                url,
+                data={
+                    "file_content": (StringIO.StringIO(delta), "file.txt"),
+                    "file_encoding": "rsync-delta",
+                    "base_md5": base_md5,
+                    "file_size": size,
+                    "file_md5": hashlib.md5(content).hexdigest()
+                },
+                headers=self.headers
+            )
+
+        try:
+            # the server version changed meanwhile
+            rv = put_delta(hashlib.md5("old content").hexdigest())
+            self.assertEqual(rv.status_code, 412)
+
+            # unknown operation
+            rv = put_delta(signatures["md5"], "X" + delta)
+            self.assertEqual(rv.status_code, 400)
+
+            # bigger than the size announced
+            rv = put_delta(signatures["md5"], size=len(content) - 1)
+            self.assertEqual(rv.status_code, 413)
+            rv = put_delta(signatures["md5"], size=None)
+            self.assertEqual(rv.status_code, 400)
+
+            rv = put_delta(signatures["md5"])
+            self.assertEqual(rv.status_code, 201)
+            with open(cls.test_file_name, "rb") as f:
+                self.assertEqual(f.read(), content)
+        finally:
+            shutil.move(backup, cls.test_file_name)
+
+    def test_chunked_upload(self):
+        chunks_url = "{}chunks/".format(_API_PREFIX)
+        url = "{}{}{}".format(
+            _API_PREFIX, TestFilesAPI.url_radix, "chunked_file.txt"
+        )
+        uploaded_file = os.path.join(
+            TestFilesAPI.root, "user_dirs", TestFilesAPI.user_test,
+            "chunked_file.txt"
+        )
+        chunks = ["first chunk\n", "second chunk\n"]
+        md5s = [hashlib.md5(chunk).hexdigest() for chunk in chunks]
+        content = chunks[0] + chunks[1] + chunks[0]
+        copy_url = url.replace("chunked_file", "chunked_copy")
+        copy_file = uploaded_file.replace("chunked_file", "chunked_copy")
+
+        def post_manifest(url=url, chunk_md5s=md5s + md5s[:1], content=content,
+                          size=None):
+            return self.tc.post(
+                url,
+                data={
+                    "file_content": (
+                        StringIO.StringIO("\n".join(chunk_md5s)), "file.txt"
+                    ),
+                    "file_encoding": "chunks",
+                    "file_size": len(content) if size is None else size,
+                    "file_md5": hashlib.md5(content).hexdigest()
+                },
+                headers=self.headers
+            )
+
+        try:
+            # the store lacks every chunk, once
+            rv = self.tc.post(
+                chunks_url, data={"chunks": md5s + md5s[:1]}, headers=self.headers
+            )
+            self.assertEqual(json.loads(rv.data), {"missing": md5s})
+
+            # a chunk not uploaded yet
+            rv = post_manifest()
+            self.assertEqual(rv.status_code, 412)
+
+            rv = self.tc.put(
+                chunks_url + md5s[0], data=chunks[0], headers=self.headers
+            )
+            self.assertEqual(rv.status_code, 201)
+            # the others in a single body, compressed
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            gzipped = compressor.compress(chunks[1]) + compressor.flush()
+            rv = self.tc.put(
+                chunks_url,
+                data={
+                    "file_content": (StringIO.StringIO(gzipped), "chunks"),
+                    "chunks": "{}:{}".format(md5s[1], len(chunks[1])),
+                    "file_encoding": "gzip",
+                    "file_size": len(chunks[1])
+                },
+                headers=self.headers
+            )
+            self.assertEqual(rv.status_code, 201)
+            rv = self.tc.post(
+                chunks_url, data={"chunks": md5s}, headers=self.headers
+            )
+            self.assertEqual(json.loads(rv.data), {"missing": []})
+
+            # bigger than the size announced
+            rv = post_manifest(size=len(content) - 1)
+            self.assertEqual(rv.status_code, 413)
+
+            rv = post_manifest()
+            self.assertEqual(rv.status_code, 201)
+            with open(uploaded_file, "rb") as f:
+                self.assertEqual(f.read(), content)
+            manifest = server.manifest_path(
+                TestFilesAPI.user_test, hashlib.md5(content).hexdigest()
+            )
+            self.assertEqual(
+                server.read_manifest(TestFilesAPI.user_test, hashlib.md5(content).hexdigest()),
+                [(md5s[0], len(chunks[0])), (md5s[1], len(chunks[1])), (md5s[0], len(chunks[0]))]
+            )
+
+            # the stored file keeps the bytes, the store where they are
+            for chunk_md5 in md5s:
+                self.assertFalse(os.path.exists(
+                    server.chunk_path(TestFilesAPI.user_test, chunk_md5)
+                ))
+            rv = self.tc.post(
+                chunks_url, data={"chunks": md5s}, headers=self.headers
+            )
+            self.assertEqual(json.loads(rv.data), {"missing": []})
+            # another file made of them
+            rv = post_manifest(
+                copy_url, md5s[::-1], chunks[1] + chunks[0]
+            )
+            self.assertEqual(rv.status_code, 201)
+            with open(copy_file, "rb") as f:
+                self.assertEqual(f.read(), chunks[1] + chunks[0])
+
+            # a new chunk, kept for the grace time once its file is deleted
+            chunk_file = server.chunk_path(TestFilesAPI.user_test, "a" * 32)
+            server.store_file(chunk_file, "new chunk")
+            rv = self.tc.post(
+                _API_PREFIX + "actions/delete",
+                data={"path": "chunked_file.txt"},
+                headers=self.headers
+            )
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(os.path.exists(manifest))
+            # the chunks of the copy point to it
+            rv = self.tc.post(
+                chunks_url, data={"chunks": md5s}, headers=self.headers
+            )
+            self.assertEqual(json.loads(rv.data), {"missing": []})
+            self.assertTrue(os.path.exists(chunk_file))
+
+            # the last file deleted, the store is swept
+            old = time.time() - server.CHUNKS_GRACE_TIME - 1
+            os.utime(chunk_file, (old, old))
+            rv = self.tc.post(
+                _API_PREFIX + "actions/delete",
+                data={"path": "chunked_copy.txt"},
+                headers=self.headers
+            )
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(os.path.exists(chunk_file))
+            rv = self.tc.post(
+                chunks_url, data={"chunks": md5s}, headers=self.headers
+            )
+            self.assertEqual(json.loads(rv.data), {"missing": md5s})
+        finally:
+            for path in (uploaded_file, copy_file):
+                if os.path.exists(path):
+                    os.remove(path)
+            shutil.rmtree(server.CHUNKS_DIRECTORY, ignore_errors=True)
+
+        # chunk not matching its md5
+        rv = self.tc.put(chunks_url + md5s[0], data="other", headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        rv = self.tc.put(
+            chunks_url,
+            data={
+                "file_content": (StringIO.StringIO("other"), "chunks"),
+                "chunks": "{}:5".format(md5s[0])
+            },
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 400)
+
+        # not an md5
+        rv = self.tc.post(
+            chunks_url, data={"chunks": ["../../user_data"]}, headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 400)
+
     def test_to_md5(self):
         cls = TestFilesAPI
         # setup
@@ -624,6 +985,55 @@ class TestActionsAPI(unittest.TestCase):
         )
         self.assertEqual(received.status_code, 404)
 
+    def test_actions_move_dir(self):
+        cls = TestActionsAPI
+        url = "{}{}{}".format(_API_PREFIX, cls.url_radix, "move")
+        data = {"file_src": "demo1", "file_dest": "project/sub/demo1"}
+        self.tc.post(url, data=data, headers=self.headers)
+        user_paths = server.User.users[cls.user_test].paths
+        demo1_md5 = user_paths["project/sub/demo1"][1]
+
+        # move the whole directory
+        data = {"file_src": "project", "file_dest": "renamed/project"}
+        received = self.tc.post(url, data=data, headers=self.headers)
+        self.assertEqual(received.status_code, 201)
+        # check the disk
+        self.assertFalse(
+            os.path.exists(os.path.join(cls.test_folder, "project"))
+        )
+        self.assertTrue(
+            os.path.isfile(
+                os.path.join(cls.test_folder, "renamed/project/sub/demo1")
+            )
+        )
+        # check the structure, the files keep their md5
+        for path in ["project", "project/sub", "project/sub/demo1"]:
+            self.assertNotIn(path, user_paths)
+        self.assertEqual(
+            user_paths["renamed/project/sub/demo1"],
+            [
+                "changeman/renamed/project/sub/demo1",
+                demo1_md5,
+                user_paths["renamed/project/sub/demo1"][2]
+            ]
+        )
+        self.assertIsNone(user_paths["renamed/project/sub"][1])
+        self.assertEqual(
+            user_paths.tree.dirs,
+            server.MerkleTree.from_paths(user_paths).dirs
+        )
+
+        # a directory can't be moved over an existing path or copied
+        data = {"file_src": "renamed", "file_dest": "demo2"}
+        received = self.tc.post(url, data=data, headers=self.headers)
+        self.assertEqual(received.status_code, 409)
+        received = self.tc.post(
+            "{}{}{}".format(_API_PREFIX, cls.url_radix, "copy"),
+            data={"file_src": "renamed", "file_dest": "copied"},
+            headers=self.headers
+        )
+        self.assertEqual(received.status_code, 400)
+
 
 class TestUser(unittest.TestCase):
     root = os.path.join(
@@ -980,6 +1390,257 @@ class TestShare(unittest.TestCase):
         )
 
 
+class TestTree(unittest.TestCase):
+    root = os.path.join(
+        os.path.dirname(__file__),
+        "demo_test/test_share"
+    )
+
+    @classmethod
+    def setUpClass(cls):
+        cls.demo_file1 = create_temporary_file()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink(cls.demo_file1)
+
+    def setUp(self):
+        shutil.copy(
+            os.path.join(TestTree.root, "demo_user_data.json"),
+            os.path.join(TestTree.root, "user_data.json")
+        )
+        server_setup(TestTree.root)
+        self.tc = server.app.test_client()
+        self.owner = "Emilio@me.it"
+        self.headers = make_headers(self.owner, "password")
+
+    def tearDown(self):
+        os.remove(server.USERS_DATA)
+
+    def get_node(self, path="", recursive=False):
+        url = "{}tree/{}".format(_API_PREFIX, path)
+        if recursive:
+            url += "?recursive=true"
+        return self.tc.get(url, headers=self.headers)
+
+    def test_merkle_tree(self):
+        # the same hashes of the client daemon
+        paths = {
+            "": ["user", None, 0],
+            "sub_dir_1": ["user/sub_dir_1", None, 0],
+            "sub_dir_1/test_file_1.txt":
+                ["user/sub_dir_1/test_file_1.txt", "fea80f2db003d4ebc4536023814aa885", 0],
+            "sub_dir_2/test_file_2.txt":
+                ["user/sub_dir_2/test_file_2.txt", "81bcb26fd4acfaa5d0acc7eef1d3013a", 0],
+            "sub_dir_2/test_file_3.txt":
+                ["user/sub_dir_2/test_file_3.txt", "d1e2ac797b8385e792ac1e31db4a81f9", 0],
+        }
+        user_paths = server.UserPaths(paths)
+        self.assertEqual(
+            user_paths.tree.dirs[""]["hash"],
+            "d588da0ff655f6dce68e6cd2beaf088c"
+        )
+
+        # incremental changes are equal to a new tree
+        user_paths["sub_dir_3/new.txt"] = ["user/sub_dir_3/new.txt", "a" * 32, 0]
+        del user_paths["sub_dir_2/test_file_3.txt"]
+        user_paths["sub_dir_1"] = ["user/sub_dir_1", None, 1]
+        self.assertEqual(
+            user_paths.tree.dirs,
+            server.MerkleTree.from_paths(user_paths).dirs
+        )
+
+        # the directories left empty are removed
+        del user_paths["sub_dir_3/new.txt"]
+        self.assertNotIn("sub_dir_3", user_paths.tree.dirs)
+
+        # sorted by path, "sub_dir_1/..." after "sub_dir-1.txt" as in a sort of the paths
+        user_paths["sub_dir-1.txt"] = ["user/sub_dir-1.txt", "b" * 32, 0]
+        user_paths["sub_dir_10/a.txt"] = ["user/sub_dir_10/a.txt", "c" * 32, 0]
+        self.assertEqual(
+            [path for path, _ in user_paths.tree.iter_sorted()],
+            sorted(path for path, meta in user_paths.items() if meta[1])
+        )
+
+        # the other dict methods keep the tree updated too
+        user_paths.update({"sub_dir_4/a.txt": ["user/sub_dir_4/a.txt", "d" * 32, 0]})
+        user_paths.setdefault("sub_dir_5/a.txt", ["user/sub_dir_5/a.txt", "e" * 32, 0])
+        user_paths.pop("sub_dir-1.txt")
+        user_paths.popitem()
+        self.assertIsInstance(user_paths["sub_dir_4/a.txt"], server.PathMeta)
+        self.assertEqual(
+            user_paths.tree.dirs,
+            server.MerkleTree.from_paths(user_paths).dirs
+        )
+        user_paths.clear()
+        self.assertEqual(
+            user_paths.tree.dirs,
+            server.MerkleTree.from_paths({}).dirs
+        )
+
+    def test_path_meta(self):
+        meta = server.PathMeta(u"user/dir/file.txt", u"a" * 32, 1.5)
+        # read as the list it replaces
+        self.assertEqual(meta, ["user/dir/file.txt", "a" * 32, 1.5])
+        self.assertEqual(meta[1], "a" * 32)
+        server_path, md5, timestamp = meta
+        self.assertEqual(server_path, "user/dir/file.txt")
+        self.assertNotEqual(meta, ["user/dir/file.txt", None, 1.5])
+        # ascii strings as str, the directory shared
+        self.assertIsInstance(meta.name, str)
+        self.assertIsInstance(meta.md5, str)
+        other = server.PathMeta(u"user/dir/other.txt", None, 2)
+        self.assertIs(other.server_dir, meta.server_dir)
+        self.assertEqual(
+            server.PathMeta(u"user/\xe8.txt", None, 0)[0], u"user/\xe8.txt")
+
+        # the users data are saved as lists and loaded as PathMeta
+        u = server.User.users[self.owner]
+        self.assertIsInstance(u.paths["ciao.txt"], server.PathMeta)
+        self.assertIsInstance(u.paths.keys()[0], str)
+        paths = dict((path, list(meta)) for path, meta in u.paths.items())
+        server.User.save_users()
+        with open(server.USERS_DATA) as f:
+            self.assertEqual(json.load(f)["users"][self.owner]["paths"], paths)
+        server.User.users = {}
+        server.User.user_class_init()
+        u = server.User.users[self.owner]
+        self.assertEqual(u.paths, paths)
+        self.assertEqual(u.paths.tree.dirs, server.MerkleTree.from_paths(paths).dirs)
+        self.assertEqual(meta[-1], 1.5)
+        self.assertEqual(meta[:2], ["user/dir/file.txt", "a" * 32])
+
+        # the directories no path has anymore are dropped, once they doubled
+        for i in range(len(server.PathMeta.server_dirs) * 2):
+            server.PathMeta("gone_{}/file.txt".format(i), None, 0)
+        self.assertIn("gone_0/", server.PathMeta.server_dirs)
+        server.PathMeta.prune_server_dirs(server.User.users)
+        self.assertNotIn("gone_0/", server.PathMeta.server_dirs)
+        self.assertIn(
+            u.paths["ciao.txt"].server_dir, server.PathMeta.server_dirs)
+        # not again until they double
+        server.PathMeta("gone_again/file.txt", None, 0)
+        server.PathMeta.prune_server_dirs(server.User.users)
+        self.assertIn("gone_again/", server.PathMeta.server_dirs)
+
+    def test_poll_interval(self):
+        settings = create_temporary_file("[sync]\npoll_interval = 15\n")
+        default_settings = server.SERVER_SETTINGS_INI
+        server.SERVER_SETTINGS_INI = settings
+        try:
+            server.server_config_init()
+            received = self.get_node()
+            self.assertEqual(received.headers["X-Poll-Interval"], "15")
+        finally:
+            server.SERVER_SETTINGS_INI = default_settings
+            server.app.config["POLL_INTERVAL"] = server.POLL_INTERVAL
+            os.remove(settings)
+
+    def test_get_tree(self):
+        u = server.User.users[self.owner]
+
+        # root node
+        received = self.get_node()
+        self.assertEqual(received.status_code, 200)
+        self.assertEqual(
+            received.headers["X-Poll-Interval"], str(server.POLL_INTERVAL))
+        node = json.loads(received.data)
+        self.assertEqual(node["hash"], u.paths.tree.dirs[""]["hash"])
+        self.assertEqual(node["timestamp"], u.timestamp)
+        self.assertEqual(
+            sorted(node["dirs"]),
+            ["can_write", "changing", "shared_directory"]
+        )
+        self.assertEqual(
+            node["dirs"]["shared_directory"],
+            u.paths.tree.dirs["shared_directory"]["hash"]
+        )
+        self.assertEqual(
+            node["files"]["ciao.txt"]["md5"],
+            u.paths["ciao.txt"][1]
+        )
+        self.assertEqual(
+            node["files"]["ciao.txt"]["size"],
+            os.path.getsize(os.path.join(
+                server.USERS_DIRECTORIES, self.owner, "ciao.txt"))
+        )
+        self.assertNotIn("shared_directory/interesting_file.txt", node["files"])
+
+        # sub directory node
+        received = self.get_node("shared_directory")
+        self.assertEqual(received.status_code, 200)
+        node = json.loads(received.data)
+        self.assertEqual(node["files"].keys(), ["interesting_file.txt"])
+        self.assertEqual(node["dirs"], {})
+
+        # recursive node
+        received = self.get_node(recursive=True)
+        node = json.loads(received.data)
+        self.assertIn("shared_directory/interesting_file.txt", node["files"])
+        self.assertIn("ciao.txt", node["files"])
+        self.assertEqual(node["dirs"], {})
+
+        # not a directory
+        self.assertEqual(self.get_node("ciao.txt").status_code, 404)
+        self.assertEqual(self.get_node("not_a_dir").status_code, 404)
+
+    def test_stream_snapshot(self):
+        u = server.User.users[self.owner]
+        received = self.tc.get(
+            "{}files/?format=ndjson".format(_API_PREFIX), headers=self.headers)
+        self.assertEqual(received.status_code, 200)
+        self.assertEqual(received.mimetype, server.NDJSON_MIMETYPE)
+        lines = [json.loads(line) for line in received.data.splitlines()]
+        self.assertEqual(lines[0], {"timestamp": u.timestamp})
+        files = lines[1:]
+        self.assertEqual(
+            [f["path"] for f in files],
+            sorted(path for path, meta in u.paths.items() if meta[1])
+        )
+        ciao = [f for f in files if f["path"] == "ciao.txt"][0]
+        self.assertEqual(ciao["md5"], u.paths["ciao.txt"][1])
+        self.assertEqual(ciao["timestamp"], u.paths["ciao.txt"][2])
+        self.assertEqual(
+            ciao["size"],
+            os.path.getsize(os.path.join(
+                server.USERS_DIRECTORIES, self.owner, "ciao.txt"))
+        )
+
+        # only the files of a directory
+        received = self.tc.get(
+            "{}files/?format=ndjson&prefix=shared_directory".format(_API_PREFIX),
+            headers=self.headers)
+        lines = [json.loads(line) for line in received.data.splitlines()]
+        self.assertEqual(lines[0], {"timestamp": u.timestamp})
+        self.assertEqual(
+            [f["path"] for f in lines[1:]],
+            ["shared_directory/interesting_file.txt"]
+        )
+        received = self.tc.get(
+            "{}files/?format=ndjson&prefix=not_a_dir".format(_API_PREFIX),
+            headers=self.headers)
+        self.assertEqual(received.status_code, 404)
+
+    def test_tree_follows_changes(self):
+        root_hash = json.loads(self.get_node().data)["hash"]
+        url = "{}files/{}".format(_API_PREFIX, "new_dir/new_file.txt")
+        with open(TestTree.demo_file1, "r") as f:
+            received = self.tc.post(url, data=get_data(f), headers=self.headers)
+        self.assertEqual(received.status_code, 201)
+
+        node = json.loads(self.get_node().data)
+        self.assertNotEqual(node["hash"], root_hash)
+        self.assertIn("new_dir", node["dirs"])
+
+        received = self.tc.post(
+            "{}actions/delete".format(_API_PREFIX),
+            data={"path": "new_dir/new_file.txt"},
+            headers=self.headers
+        )
+        self.assertEqual(received.status_code, 200)
+        self.assertEqual(json.loads(self.get_node().data)["hash"], root_hash)
+
+
 class EmailTest(unittest.TestCase):
 
     def mock_mail_init(self):